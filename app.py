@@ -1,17 +1,73 @@
+import atexit
+import os
+import signal
+import sys
 from flask import Flask
+import gevent
+import gevent.lock
+from gevent import pywsgi
+from geventwebsocket.handler import WebSocketHandler
+from werkzeug.serving import run_with_reloader
 from flask_cors import CORS
-from flask_graphql import GraphQLView
+from flask_sockets import Sockets
+from graphql_ws.gevent import GeventSubscriptionServer
 from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from controller import Base
+from events import commits, track_changes
 from graphqlserver import schema
+from objectstore import ObjectStore
+from output import PixelStrip
+from querycache import DocumentCache, PersistedQueryView
+from renderservice import RenderService
+from responsecache import ResponseCache
+from writecoalescer import WriteCoalescer, enable_wal
 
-engine = create_engine('sqlite:///data.sqlite3', convert_unicode=True)
-session = scoped_session(sessionmaker(autocommit=False,
-                                      autoflush=False,
-                                      bind=engine))
+DATABASE_URL = 'sqlite:///data.sqlite3'
+TARGET_FPS = 60.0
+# Render devices in parallel, one worker process per core
+RENDER_PROCESSES = os.cpu_count() or 1
+# Animated scenes are baked here and played back instead of rendered
+CLIP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clip-cache')
+# Real-time (SCHED_RR) priority of the render process, when it's allowed one
+RENDER_PRIORITY = 10
+# Seconds over which updates are coalesced into one commit
+WRITE_WINDOW = 0.1
+# Parsed and validated GraphQL documents kept around
+DOCUMENT_CACHE_SIZE = 256
+# Results of read queries kept around
+RESPONSE_CACHE_SIZE = 128
+
+engine = create_engine(DATABASE_URL, convert_unicode=True)
+enable_wal(engine)
+session_factory = sessionmaker(autocommit=False,
+                               autoflush=False,
+                               bind=engine)
+# Requests are greenlets on one thread, so each greenlet needs a session of its own
+session = scoped_session(session_factory, scopefunc=gevent.getcurrent)
 Base.metadata.create_all(engine)
+# Publish committed changes to GraphQL subscriptions
+track_changes(session_factory)
+
+# Rendering runs in a process of its own, so API load doesn't affect frame pacing
+renderer = RenderService(DATABASE_URL, fps=TARGET_FPS, processes=RENDER_PROCESSES, clip_dir=CLIP_DIR, priority=RENDER_PRIORITY)
+
+
+# Any committed change may affect what the devices show
+commits.subscribe(renderer.notify)
+
+# Bursts of updates (e.g. dragging a colour stop) are committed together
+writes = WriteCoalescer(session_factory, window=WRITE_WINDOW, schedule=gevent.spawn_later, lock=gevent.lock.BoundedSemaphore)
+atexit.register(writes.close)
+
+# Reads are served from memory, kept up to date by the committed changes
+store = ObjectStore(sessionmaker(bind=engine, expire_on_commit=False), writes)
+store.load()
+commits.subscribe(store.apply_changes)
+# Read queries are answered again from their last result while what they read is unchanged
+responses = ResponseCache(DocumentCache(DOCUMENT_CACHE_SIZE), store, RESPONSE_CACHE_SIZE)
+
 
 app = Flask(__name__)
 app.debug = True
@@ -19,19 +75,49 @@ CORS(app)
 
 app.add_url_rule(
     '/graphql',
-    view_func=GraphQLView.as_view(
+    view_func=PersistedQueryView.as_view(
         'graphql',
         schema=schema,
-        get_context=lambda: {'session': session},
+        backend=responses,
+        get_context=lambda: {'session': session, 'store': store, 'writes': store, 'responses': responses, 'renderer': renderer},
         graphiql=True  # for having the GraphiQL interface
     )
 )
 
 
+class SubscriptionServer(GeventSubscriptionServer):
+    # Give subscription resolvers the same context as /graphql queries
+    def get_graphql_params(self, connection_context, payload):
+        params = super().get_graphql_params(connection_context, payload)
+        return dict(params, context_value=connection_context.request_context)
+
+
+sockets = Sockets(app)
+subscription_server = SubscriptionServer(schema)
+app.app_protocol = lambda environ_path_info: 'graphql-ws'
+
+
+@sockets.route('/subscriptions')
+def subscriptions(ws):
+    subscription_server.handle(ws, {'session': session, 'store': store})
+    return []
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     session.remove()
 
 
 if __name__ == '__main__':
-    app.run()
+    # Stopping the service should write pending updates too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # With the reloader on, only render from the process that serves requests
+    if PixelStrip is not None and (not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        renderer.start()
+        atexit.register(renderer.stop)
+    # WebSocket-capable server, so that /subscriptions works next to /graphql
+    server = pywsgi.WSGIServer(('127.0.0.1', 5000), app, handler_class=WebSocketHandler)
+    if app.debug:
+        run_with_reloader(server.serve_forever)
+    else:
+        server.serve_forever()
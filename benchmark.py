@@ -0,0 +1,266 @@
+"""
+Benchmarks for the render pipeline and the GraphQL API
+Builds a synthetic scene from the controller models (N layers, M colour stops
+per gradient, K keyframes per animation) in an in-memory SQLite database, times
+full-frame rendering of P pixels against a fake strip and times representative
+schema queries and mutations. Results are written as JSON so that runs of
+different versions can be compared with --compare.
+
+  python benchmark.py --layers 8 --stops 16 --keyframes 8 --pixels 600 -o before.json
+  python benchmark.py --layers 8 --stops 16 --keyframes 8 --pixels 600 --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from statistics import mean, median
+from time import perf_counter, time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from controller import Base, Scene, Layer, Color, Gradient, ColorStop, ColorAnimation, ColorKeyframe, StaticDimension, DimensionAnimation, DimensionKeyframe, Clock, Device
+from graphqlserver import schema
+from output import pack_frame, write_frame
+from renderer import GradientLUTCache, render_frame
+from renderplan import load_scene_plan
+
+
+"""
+Stands in for rpi_ws281x's PixelStrip
+"""
+class FakeStrip:
+  def __init__(self, count: int) -> None:
+    self.pixels = [0] * count
+    self.shows = 0
+
+  def numPixels(self) -> int:
+    return len(self.pixels)
+
+  def setPixelColor(self, i: int, color: int) -> None:
+    self.pixels[i] = color
+
+  def show(self) -> None:
+    self.shows += 1
+
+
+def synthetic_color(i: int) -> Color:
+  return Color(red=float(i * 37 % 256), green=float(i * 91 % 256), blue=float(i * 53 % 256),
+               white=0.0, opacity=0.5 + (i % 2) * 0.5)
+
+
+def synthetic_clock(duration: float) -> Clock:
+  return Clock(name='clock', start=time(), duration=duration)
+
+
+def synthetic_keyframes(cls, count: int, value):
+  return [cls(value=value(i), position=i / max(count - 1, 1)) for i in range(count)]
+
+
+"""
+Builds a scene that cycles through gradient, colour animation and plain colour
+layers, with alternating static and animated left offsets
+"""
+def build_scene(session, layers: int, stops: int, keyframes: int) -> Scene:
+  scene = Scene(name='benchmark')
+  for i in range(layers):
+    kind = i % 3
+    if kind == 0:
+      image = Gradient(colorstops=synthetic_keyframes(ColorStop, stops, synthetic_color))
+    elif kind == 1:
+      image = ColorAnimation(keyframes=synthetic_keyframes(ColorKeyframe, keyframes, synthetic_color))
+      image.sensor = synthetic_clock(10.0)
+      image.repeat = 1.0
+    else:
+      image = synthetic_color(i)
+    if i % 2:
+      left = DimensionAnimation(keyframes=synthetic_keyframes(DimensionKeyframe, keyframes, lambda k: k / max(keyframes, 1)))
+      left.sensor = synthetic_clock(5.0)
+      left.repeat = 1.0
+    else:
+      left = StaticDimension(value=i / max(layers, 1))
+    scene.layers.append(Layer(image=image, left=left, size=StaticDimension(value=0.25), repeat=2.0))
+  session.add(scene)
+  session.add(Device(name='benchmark', led_count=0, gpio_pin=18, led_strip=0, scene=scene))
+  session.commit()
+  return scene
+
+
+"""
+Calls function `runs` times and summarises the durations in milliseconds
+"""
+def measure(function, runs: int) -> dict:
+  durations = []
+  for _ in range(runs):
+    started = perf_counter()
+    function()
+    durations.append((perf_counter() - started) * 1000)
+  return {
+    'runs': runs,
+    'min_ms': min(durations),
+    'median_ms': median(durations),
+    'mean_ms': mean(durations),
+  }
+
+
+def execute(session, document: str, **variables):
+  result = schema.execute(document, context_value={'session': session}, variables=variables)
+  if result.errors:
+    raise RuntimeError(result.errors)
+  return result
+
+
+SCENE_QUERY = '''
+query scene($id: ID!) {
+  scene(id: $id) {
+    id
+    name
+    layers {
+      id
+      repeat
+      size { ... on StaticDimension { id value } ... on DimensionAnimation { id repeat keyframes { id position value } } }
+      left { ... on StaticDimension { id value } ... on DimensionAnimation { id repeat keyframes { id position value } } }
+      image {
+        ... on Color { id red green blue white opacity }
+        ... on ColorAnimation { id repeat keyframes { id position value { id red green blue white opacity } } }
+        ... on Gradient { id colorstops { id position value { id red green blue white opacity } } }
+      }
+    }
+  }
+}
+'''
+
+SCENES_QUERY = '{ scenes { id name layers { id repeat } } }'
+
+DEVICES_QUERY = '{ devices { id name ledCount scene { id name } } }'
+
+UPDATE_COLOR_STOP = '''
+mutation updateColorStop($id: ID!, $position: Float) {
+  updateColorStop(id: $id, fields: { position: $position }) { result { id position } }
+}
+'''
+
+CREATE_SCENE = 'mutation { createScene(fields: { name: "benchmark" }) { result { id } } }'
+
+DELETE_SCENE = 'mutation deleteScene($id: ID!) { deleteScene(id: $id) { result { id } } }'
+
+
+def benchmark_render(session, scene: Scene, pixels: int, runs: int) -> dict:
+  results = {}
+  results['compile'] = measure(lambda: load_scene_plan(session, scene.id), runs)
+  plan = load_scene_plan(session, scene.id)
+  t = time()
+  results['render'] = measure(lambda: render_frame(plan, pixels, t), runs)
+  luts = GradientLUTCache()
+  results['render_lut'] = measure(lambda: render_frame(plan, pixels, t, luts), runs)
+  frame = render_frame(plan, pixels, t)
+  results['pack'] = measure(lambda: pack_frame(frame), runs)
+  strip = FakeStrip(pixels)
+
+  def full_frame():
+    write_frame(strip, pack_frame(render_frame(plan, pixels, t, luts)))
+    strip.show()
+  results['frame'] = measure(full_frame, runs)
+  # The per-pixel ORM path, for comparison
+  results['orm_pixel_loop'] = measure(
+    lambda: scene.getColorsAtPositions([(i + 0.5) / pixels for i in range(pixels)], t),
+    max(1, runs // 10))
+  return results
+
+
+def benchmark_api(session, scene: Scene, runs: int) -> dict:
+  results = {}
+  results['query_scene'] = measure(lambda: execute(session, SCENE_QUERY, id=scene.id), runs)
+  results['query_scenes'] = measure(lambda: execute(session, SCENES_QUERY), runs)
+  results['query_devices'] = measure(lambda: execute(session, DEVICES_QUERY), runs)
+  stop = scene.layers[0].image.colorstops[0]
+  positions = iter(range(runs))
+  results['mutation_update_color_stop'] = measure(
+    lambda: execute(session, UPDATE_COLOR_STOP, id=stop.id, position=next(positions) % 2 * 0.01), runs)
+
+  def create_and_delete():
+    created = execute(session, CREATE_SCENE).data['createScene']['result']['id']
+    execute(session, DELETE_SCENE, id=created)
+  results['mutation_create_delete_scene'] = measure(create_and_delete, runs)
+  return results
+
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(args) -> dict:
+  engine = create_engine('sqlite://')
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  scene = build_scene(session, args.layers, args.stops, args.keyframes)
+  results = benchmark_render(session, scene, args.pixels, args.runs)
+  results.update(benchmark_api(session, scene, args.runs))
+  return {
+    'revision': git_revision(),
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'parameters': {
+      'layers': args.layers,
+      'stops': args.stops,
+      'keyframes': args.keyframes,
+      'pixels': args.pixels,
+      'runs': args.runs,
+    },
+    'results': results,
+  }
+
+
+"""
+Prints the median of each benchmark against a previous report
+Returns the names of the benchmarks that got slower than threshold allows
+"""
+def compare(report: dict, baseline: dict, threshold: float) -> list:
+  regressions = []
+  if baseline.get('parameters') != report['parameters']:
+    print('warning: baseline was run with different parameters', file=sys.stderr)
+  for name, result in report['results'].items():
+    before = baseline.get('results', {}).get(name)
+    if before is None:
+      continue
+    ratio = result['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+    print('{:32} {:10.3f} ms -> {:10.3f} ms  x{:.2f}'.format(name, before['median_ms'], result['median_ms'], ratio), file=sys.stderr)
+    if ratio > threshold:
+      regressions.append(name)
+  return regressions
+
+
+def main() -> int:
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--layers', type=int, default=8, help='number of layers (N)')
+  parser.add_argument('--stops', type=int, default=16, help='colour stops per gradient (M)')
+  parser.add_argument('--keyframes', type=int, default=8, help='keyframes per animation (K)')
+  parser.add_argument('--pixels', type=int, default=600, help='pixels per frame (P)')
+  parser.add_argument('--runs', type=int, default=100, help='runs per benchmark')
+  parser.add_argument('-o', '--output', help='write the JSON report here instead of stdout')
+  parser.add_argument('--compare', help='previous JSON report to compare against')
+  parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio counted as a regression')
+  args = parser.parse_args()
+
+  report = run(args)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(report, json.load(f), args.threshold)
+    if regressions:
+      print('regressions: ' + ', '.join(regressions), file=sys.stderr)
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
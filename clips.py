@@ -0,0 +1,167 @@
+"""
+Baked frame clips
+An animated scene only changes while one of its clocks is running through its
+keyframes: every animation clamps to its first keyframe before that and to its
+final value after it. A clip is every frame of that active window, rendered once
+and packed for the strip, so playing a scene back is just indexing into a
+memory-mapped file instead of evaluating the scene graph.
+
+File layout: a fixed header followed by frame_count x led_count packed uint32
+pixels (0xWWRRGGBB, as written to the strip)
+
+  python clips.py SCENE_ID LED_COUNT -o scene.clip --fps 60
+"""
+import argparse
+import hashlib
+import logging
+import os
+import struct
+import sys
+from dataclasses import dataclass
+from math import floor
+from typing import Optional, Tuple
+import numpy as np
+from output import pack_frame
+from renderer import GradientLUTCache, render_frame
+from renderplan import AnimationPlan, ScenePlan
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'LEDCLIP1'
+# magic, plan key, LED count, frame count, frames per second, time of frame 0
+HEADER = struct.Struct('<8s20sIIdd')
+# Longer windows are rendered live instead of baked
+MAX_CLIP_BYTES = 64 * 1024 * 1024
+CLIP_SUFFIX = '.clip'
+
+
+"""
+Identifies what a clip was baked from: any change to the scene changes its plan
+and so its key, which is how clips are invalidated
+"""
+def clip_key(plan: ScenePlan, led_count: int, fps: float) -> bytes:
+  return hashlib.sha1(repr((plan, led_count, fps)).encode()).digest()
+
+
+def clip_path(directory: str, key: bytes) -> str:
+  return os.path.join(directory, key.hex() + CLIP_SUFFIX)
+
+
+def _animations(plan: ScenePlan):
+  for layer in plan.layers:
+    for part in (layer.image, layer.size, layer.left):
+      if isinstance(part, AnimationPlan):
+        yield part
+
+
+"""
+Times (start, end) between which the scene can change, or None if it never does
+An animation's sensor value only matters between its first keyframe and the
+earlier of its last keyframe and its repeat; outside that it clamps. Past its
+repeat an animation shows its value at 1.0, so when that differs from its value
+at the repeat, the jump is part of the window too.
+"""
+def active_window(plan: ScenePlan) -> Optional[Tuple[float, float]]:
+  window = None
+  for animation in _animations(plan):
+    positions = animation.keyframes.positions
+    clock = animation.sensor
+    first, last = positions[0], min(positions[-1], animation.repeat)
+    if animation.keyframes.blend(animation.repeat) != animation.keyframes.blend(1.0):
+      first, last = min(first, animation.repeat), max(last, animation.repeat)
+    times = sorted((clock.start + first * clock.duration, clock.start + max(first, last) * clock.duration))
+    window = tuple(times) if window is None else (min(window[0], times[0]), max(window[1], times[1]))
+  return window
+
+
+"""
+Renders the scene's active window at fps into a clip file at path
+The first frame lies just before the window and the last one just past it, so
+clamping to them shows the initial and the final state. Returns False, without
+writing anything, for scenes that never change or whose window would make the
+clip larger than max_bytes.
+"""
+def bake_clip(plan: ScenePlan, led_count: int, fps: float, path: str, max_bytes: int = MAX_CLIP_BYTES) -> bool:
+  window = active_window(plan)
+  if window is None:
+    return False
+  frame_count = floor((window[1] - window[0]) * fps) + 3
+  start = window[0] - 1.0 / fps
+  if frame_count * led_count * 4 > max_bytes:
+    return False
+  luts = GradientLUTCache()
+  temporary = path + '.tmp'
+  with open(temporary, 'wb') as f:
+    f.write(HEADER.pack(MAGIC, clip_key(plan, led_count, fps), led_count, frame_count, fps, start))
+    packed = np.empty(led_count, dtype=np.uint32)
+    for i in range(frame_count):
+      pack_frame(render_frame(plan, led_count, start + i / fps, luts), out=packed)
+      f.write(packed.tobytes())
+  # Readers only ever see complete clips
+  os.replace(temporary, path)
+  return True
+
+
+@dataclass
+class Clip:
+  key: bytes
+  led_count: int
+  fps: float
+  start: float
+  # (frame_count, led_count) memory-mapped packed frames
+  frames: np.ndarray
+
+  """
+  Packed frame for time t; times outside the clip clamp to its first or last frame
+  """
+  def frame(self, t: float) -> np.ndarray:
+    index = int(floor((t - self.start) * self.fps + 0.5))
+    return self.frames[min(max(index, 0), len(self.frames) - 1)]
+
+
+"""
+Memory-maps a clip file, or returns None if it is missing or was baked from
+something else
+"""
+def open_clip(path: str, key: Optional[bytes] = None) -> Optional[Clip]:
+  try:
+    with open(path, 'rb') as f:
+      header = f.read(HEADER.size)
+  except FileNotFoundError:
+    return None
+  if len(header) != HEADER.size:
+    return None
+  magic, baked_key, led_count, frame_count, fps, start = HEADER.unpack(header)
+  if magic != MAGIC or (key is not None and baked_key != key):
+    return None
+  frames = np.memmap(path, dtype=np.uint32, mode='r', offset=HEADER.size, shape=(frame_count, led_count))
+  return Clip(baked_key, led_count, fps, start, frames)
+
+
+def main() -> int:
+  from sqlalchemy import create_engine
+  from sqlalchemy.orm import sessionmaker
+  from renderplan import load_scene_plan
+
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('scene', type=int, help='ID of the scene to bake')
+  parser.add_argument('leds', type=int, help='number of LEDs to render')
+  parser.add_argument('-o', '--output', required=True, help='clip file to write')
+  parser.add_argument('--fps', type=float, default=60.0, help='frames per second')
+  parser.add_argument('--database', default='sqlite:///data.sqlite3', help='database URL')
+  args = parser.parse_args()
+  logging.basicConfig(format='%(message)s')
+
+  session = sessionmaker(bind=create_engine(args.database))()
+  plan = load_scene_plan(session, args.scene)
+  if plan is None:
+    logger.error('Scene %s not found', args.scene)
+    return 1
+  if not bake_clip(plan, args.leds, args.fps, args.output):
+    logger.error('Nothing to bake: scene %s is static or its animations run too long', args.scene)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,144 @@
+"""
+Set-based cloning
+Copying an object through deepcopy walks its relationships one lazy load at a
+time and builds the whole copy in Python before flushing it row by row.
+clone() copies rows and everything they own (whatever their relationships
+cascade deletes to: a scene's layers, their images and dimensions, colour
+stops and keyframes with their colours, sensors...) with a handful of
+statements per table, whatever the size of the tree:
+- the IDs of the rows to copy are collected level by level with
+  INSERT ... SELECT into temporary tables, one per table, that give each of
+  them a new ID past the table's last one
+- each table is then copied with one INSERT ... SELECT that swaps IDs and
+  foreign keys for the new ones; foreign keys to rows that weren't copied
+  (e.g. the scene of a cloned layer) are kept
+Single-table polymorphism needs no special handling: subclass rows are copied
+with their discriminator, and the relationships of every subclass are
+followed.
+"""
+from typing import Dict, Iterable, List
+from sqlalchemy import Column, Integer, MetaData, Table, and_, func, inspect, null, select
+from controller import Scene
+from events import CREATED, record_change
+
+
+def _owned_relationships(model) -> List:
+  relationships = []
+  seen = set()
+  pending = [inspect(model)]
+  visited = set()
+  while pending:
+    mapper = pending.pop(0)
+    if mapper in visited:
+      continue
+    visited.add(mapper)
+    # Relationships of polymorphic subclasses, e.g. the colour stops of a gradient
+    for submapper in mapper.self_and_descendants:
+      for relationship in submapper.relationships:
+        if relationship.cascade.delete and relationship not in seen:
+          seen.add(relationship)
+          relationships.append(relationship)
+          pending.append(relationship.mapper)
+  return relationships
+
+
+def _id_map(connection, metadata: MetaData, table: Table) -> Table:
+  id_map = Table('clone_' + table.name, metadata,
+                 # Allocated as max(new) + 1, starting from the seed row
+                 Column('new', Integer, primary_key=True),
+                 Column('old', Integer, unique=True),
+                 prefixes=['TEMPORARY'])
+  id_map.create(connection)
+  seed = select([func.coalesce(func.max(_primary_key(table)), 0), null()])
+  connection.execute(id_map.insert().from_select(['new', 'old'], seed))
+  return id_map
+
+
+def _primary_key(table: Table) -> Column:
+  return list(table.primary_key.columns)[0]
+
+
+"""
+Adds the rows that a relationship leads to from the rows already collected;
+returns how many were new
+"""
+def _collect(connection, relationship, id_maps: Dict[Table, Table]) -> int:
+  parent = relationship.parent.local_table
+  target = relationship.mapper.local_table.alias()
+  joined = parent.join(id_maps[parent], _primary_key(parent) == id_maps[parent].c.old)
+  on = [local == target.corresponding_column(remote) for local, remote in relationship.local_remote_pairs]
+  joined = joined.join(target, and_(*on))
+  rows = select([target.corresponding_column(_primary_key(relationship.mapper.local_table))]).select_from(joined)
+  target_map = id_maps[relationship.mapper.local_table]
+  return connection.execute(target_map.insert().prefix_with('OR IGNORE').from_select(['old'], rows)).rowcount
+
+
+def _copy(connection, table: Table, id_maps: Dict[Table, Table]) -> None:
+  id_map = id_maps[table]
+  joined = table.join(id_map, _primary_key(table) == id_map.c.old)
+  values = []
+  for column in table.columns:
+    if column is _primary_key(table):
+      values.append(id_map.c.new)
+      continue
+    referenced = [key.column.table for key in column.foreign_keys if key.column.table in id_maps]
+    if not referenced:
+      values.append(column)
+      continue
+    remapped = id_maps[referenced[0]].alias()
+    joined = joined.outerjoin(remapped, remapped.c.old == column)
+    values.append(func.coalesce(remapped.c.new, column))
+  connection.execute(table.insert().from_select([column.name for column in table.columns],
+                                                select(values).select_from(joined)))
+
+
+"""
+Copies the rows of model with the given IDs, along with everything they own,
+in the session's transaction; returns the IDs of the copies by original ID
+IDs that don't exist are left out.
+"""
+def clone(session, model, ids: Iterable[int]) -> Dict[int, int]:
+  connection = session.connection()
+  relationships = _owned_relationships(model)
+  tables = [inspect(model).local_table] + [relationship.mapper.local_table for relationship in relationships]
+  metadata = MetaData()
+  id_maps: Dict[Table, Table] = {}
+  try:
+    for table in tables:
+      if table not in id_maps:
+        id_maps[table] = _id_map(connection, metadata, table)
+    root = inspect(model).local_table
+    roots = select([_primary_key(root)]).where(_primary_key(root).in_([int(id) for id in ids]))
+    connection.execute(id_maps[root].insert().from_select(['old'], roots))
+    # Tables come back at several levels (colours are images, and the values of
+    # the colour stops of gradients, which are images too), so go over the
+    # relationships until they don't lead anywhere new
+    while sum(_collect(connection, relationship, id_maps) for relationship in relationships):
+      pass
+    for table in id_maps:
+      _copy(connection, table, id_maps)
+    copies = select([id_maps[root].c.old, id_maps[root].c.new]).where(id_maps[root].c.old.isnot(None))
+    return dict(connection.execute(copies).fetchall())
+  finally:
+    for id_map in id_maps.values():
+      id_map.drop(connection)
+
+
+"""
+Copies a scene with everything in it and commits the copy, named name if given
+"""
+def duplicate_scene(session, id, name=None) -> Scene:
+  try:
+    copies = clone(session, Scene, [id])
+    if int(id) not in copies:
+      raise ValueError('Scene {} does not exist'.format(id))
+    if name is not None:
+      # Set without the ORM, so that the copy is only reported as created
+      session.query(Scene).filter(Scene.id == copies[int(id)]).update({Scene.name: name}, synchronize_session=False)
+    scene = session.query(Scene).get(copies[int(id)])
+    record_change(session, CREATED, scene)
+    session.commit()
+  except Exception:
+    session.rollback()
+    raise
+  return scene
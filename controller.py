@@ -1,15 +1,26 @@
 from __future__ import annotations
-from bisect import bisect
 from dataclasses import dataclass, field
-from typing import List, Union, Any
+from typing import Callable, List, Optional, Union, Any
+from threading import local
 from time import time
 from functools import total_ordering
 from copy import copy, deepcopy
+import numpy as np
 from sqlalchemy import Column, Integer, Float, String, ForeignKey, MetaData, Table
 from sqlalchemy.orm import relationship, RelationshipProperty, ColumnProperty
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 from graphqlutils import input_to_dictionary, AnimationType, DimensionType
 
+"""
+Commits the updates still held by the context's WriteCoalescer ("writes")
+Mutations that commit on their own call it first, so that they read what those
+updates change and a later coalesced commit doesn't revert what they write
+"""
+def flush_writes(context: dict) -> None:
+  writes = context.get('writes')
+  if writes is not None:
+    writes.flush()
+
 @as_declarative()
 class Base(object):
   @declared_attr
@@ -55,6 +66,7 @@ class Base(object):
   """
   @classmethod
   def create(cls, root, info, fields):
+    flush_writes(info.context)
     value = input_to_dictionary(fields)
     orm_object = cls(**value)
     info.context['session'].add(orm_object)
@@ -66,14 +78,25 @@ class Base(object):
   The ID of the object to be updated should be under the "id" argument
   The updates should be under the "fields" argument
   Note: only the fields specified are updated
+  Column updates are handed to the context's WriteCoalescer ("writes") when it
+  has one (or to an ObjectStore, which passes them on to its own): the returned
+  object shows them right away, and they are committed together with the other
+  updates of the same moment; other updates commit the pending ones first
   """
   @classmethod
   def update(cls, root, info, id, fields):
     value = input_to_dictionary(fields)
+    writes = info.context.get('writes')
+    coalesced = writes is not None and all(key in cls.__mapper__.column_attrs for key in value)
+    if not coalesced:
+      flush_writes(info.context)
     orm_object = info.context['session'].query(cls).filter(cls.id == id).one()
     for key in value:
       setattr(orm_object, key, fields[key])
-    info.context['session'].commit()
+    if coalesced:
+      writes.update(cls, orm_object.id, {key: fields[key] for key in value})
+    else:
+      info.context['session'].commit()
     return orm_object
 
   """
@@ -82,6 +105,7 @@ class Base(object):
   """
   @classmethod
   def delete(cls, root, info, id):
+    flush_writes(info.context)
     orm_object = info.context['session'].query(cls).filter(cls.id == id).one()
     info.context['session'].delete(orm_object)
     info.context['session'].commit()
@@ -104,6 +128,7 @@ class Keyframe:
   """
   @classmethod
   def create(cls, root, info, animation_id, fields):
+    flush_writes(info.context)
     value = input_to_dictionary(fields)
     orm_object = cls(animation_id=animation_id, **value)
     info.context['session'].add(orm_object)
@@ -111,13 +136,27 @@ class Keyframe:
     return orm_object
 
 
+# Index of the first keyframe after a position, as bisect.bisect on their
+# positions, without building a list of them (bisect's key argument needs
+# Python 3.10)
+def _bisect_position(keyframes: List[Keyframe], position: float) -> int:
+  low, high = 0, len(keyframes)
+  while low < high:
+    middle = (low + high) // 2
+    if position < keyframes[middle].position:
+      high = middle
+    else:
+      low = middle + 1
+  return low
+
+
 def blend(keyframes: List[Keyframe], position: float):
   if position < keyframes[0].position:
     return keyframes[0].value
   if position >= keyframes[-1].position:
     return keyframes[-1].value
   # Find the index of the keyframe after the current position
-  i: int = bisect(keyframes, Keyframe(None, position))
+  i: int = _bisect_position(keyframes, position)
   # Find the distance between the current position and the previous keyframe
   # as a percentage of the position between the two keyframes
   distance: float = (position - keyframes[i - 1].position) / \
@@ -126,12 +165,76 @@ def blend(keyframes: List[Keyframe], position: float):
   return (1 - distance) * keyframes[i - 1].value + distance * keyframes[i].value
 
 
+"""
+Batched counterpart of blend: interpolates keyframes at every position at once
+The keyframes are pre-packed into a sorted array of positions and an array of
+values, either of shape (n,) or (n, channels) (e.g. RGBWA colours)
+Same clamping semantics as blend at both ends
+"""
+def blend_many(positions: np.ndarray, keyframe_positions: np.ndarray, keyframe_values: np.ndarray) -> np.ndarray:
+  positions = np.asarray(positions, dtype=np.float64)
+  if len(keyframe_positions) == 1:
+    return np.broadcast_to(keyframe_values[0], positions.shape + keyframe_values.shape[1:]).copy()
+  # Index of the keyframe after each position, as bisect would find it,
+  # kept in range so that both ends clamp to the first or last keyframe
+  after = np.clip(np.searchsorted(keyframe_positions, positions, side='right'),
+                  1, len(keyframe_positions) - 1)
+  before = after - 1
+  start = keyframe_positions[before]
+  span = keyframe_positions[after] - start
+  distance = np.divide(positions - start, span, out=np.ones_like(positions), where=span > 0)
+  np.clip(distance, 0.0, 1.0, out=distance)
+  # Broadcast the weighting over the value channels
+  distance = distance.reshape(distance.shape + (1,) * (keyframe_values.ndim - 1))
+  return (1 - distance) * keyframe_values[before] + distance * keyframe_values[after]
+
+
 class DimensionKeyframe(Keyframe, Base):
   animation_id = Column(Integer, ForeignKey('dimension.id'))
   value = Column(Float)
   position = Column(Float)
 
 
+"""
+Frame-time render context
+Inside `with FrameContext(t):` every Sensor and Animation is evaluated at the
+single frame time t, once, and that value is reused for the rest of the frame
+however many pixels and arithmetic operators ask for it, so all pixels of a
+frame see the same time.
+Outside of a frame, values are computed from the current time on every access.
+"""
+class FrameContext:
+  _active = local()
+
+  def __init__(self, t: Optional[float] = None) -> None:
+    self.t = time() if t is None else t
+    # id(object) -> (object, value); the object is held so its id can't be reused mid-frame
+    self._values = {}
+    self._previous: Optional[FrameContext] = None
+
+  def __enter__(self) -> FrameContext:
+    self._previous = FrameContext.current()
+    FrameContext._active.context = self
+    return self
+
+  def __exit__(self, *exc_info) -> None:
+    FrameContext._active.context = self._previous
+    self._previous = None
+    self._values.clear()
+
+  # Innermost active context on this thread, if any
+  @classmethod
+  def current(cls) -> Optional[FrameContext]:
+    return getattr(cls._active, 'context', None)
+
+  # Value of obj for this frame, computed on first use
+  def memoize(self, obj, compute: Callable[[], Any]):
+    entry = self._values.get(id(obj))
+    if entry is None:
+      entry = self._values[id(obj)] = (obj, compute())
+    return entry[1]
+
+
 @total_ordering
 class MathProxyMixin:
   def __mul__(self, other):
@@ -196,7 +299,10 @@ class Clock(Sensor):
   duration = Column(Float)
 
   def currentValue(self):
-    return (time() - self.start) / self.duration
+    context = FrameContext.current()
+    if context is None:
+      return (time() - self.start) / self.duration
+    return context.memoize(self, lambda: (context.t - self.start) / self.duration)
 
   """
   Create mutation resolver for GraphQL
@@ -206,6 +312,7 @@ class Clock(Sensor):
   """
   @classmethod
   def create(cls, root, info, animation_id, animation_type, fields):
+    flush_writes(info.context)
     animation = None
     value = input_to_dictionary(fields)
     orm_object = cls(animation_id=animation_id, **value)
@@ -235,6 +342,12 @@ class Animation(MathProxyMixin):
     return relationship(Sensor, cascade='all, delete-orphan', single_parent=True)
 
   def currentValue(self):
+    context = FrameContext.current()
+    if context is None:
+      return self._blend()
+    return context.memoize(self, self._blend)
+
+  def _blend(self):
     pos = self.sensor.currentValue()
 
     return blend(self.keyframes, pos if pos <= self.repeat else 1.0)
@@ -255,6 +368,7 @@ class Dimension(Base):
   """
   @classmethod
   def create(cls, root, info, layer_id, dimension_type, fields):
+    flush_writes(info.context)
     layer = info.context['session'].query(Layer).filter(Layer.id == layer_id).one()
     value = input_to_dictionary(fields)
     orm_object = cls(**value)
@@ -308,6 +422,7 @@ class Image(Base):
   """
   @classmethod
   def create(cls, root, info, layer_id, fields):
+    flush_writes(info.context)
     layer = info.context['session'].query(Layer).filter(Layer.id == layer_id).one()
     value = input_to_dictionary(fields)
     orm_object = cls(**value)
@@ -316,6 +431,68 @@ class Image(Base):
     return layer
 
 
+"""
+Unmapped RGBWA value used for all intermediate compositing maths
+Same premultiplied space as Color, but allocating one doesn't go through
+SQLAlchemy instrumentation, so the render path can create them freely
+"""
+class ColorValue:
+  __slots__ = ('red', 'green', 'blue', 'white', 'opacity')
+
+  def __init__(self, red: float = 0.0, green: float = 0.0, blue: float = 0.0, white: float = 0.0, opacity: float = 1.0) -> None:
+    self.red = red
+    self.green = green
+    self.blue = blue
+    self.white = white
+    self.opacity = opacity
+
+  def __repr__(self) -> str:
+    return 'ColorValue({}, {}, {}, {}, {})'.format(self.red, self.green, self.blue, self.white, self.opacity)
+
+  def __eq__(self, other) -> bool:
+    if not isinstance(other, ColorValue):
+      return NotImplemented
+    return (self.red, self.green, self.blue, self.white, self.opacity) == \
+      (other.red, other.green, other.blue, other.white, other.opacity)
+
+  # Converts to WS281x Color object
+  def toWS281xColor(self) -> int:
+    return int(self.white) << 24 | \
+      int(self.red) << 16 | \
+      int(self.green) << 8 | \
+      int(self.blue)
+
+  def __int__(self) -> int:
+    return self.toWS281xColor()
+
+  # Converts back to a persistable Color
+  def toColor(self) -> Color:
+    return Color(red=self.red, green=self.green, blue=self.blue, white=self.white, opacity=self.opacity)
+
+  def __mul__(self, scale: Union[float, int]) -> ColorValue:
+    if not isinstance(scale, (float, int)):
+      raise NotImplementedError
+    return ColorValue(self.red * scale, self.green * scale, self.blue * scale,
+                      self.white * scale, self.opacity * scale)
+
+  def __add__(self, other: Union[Color, ColorValue]) -> ColorValue:
+    if not isinstance(other, (Color, ColorValue)):
+      raise NotImplementedError
+    return ColorValue(self.red + other.red, self.green + other.green, self.blue + other.blue,
+                      self.white + other.white, self.opacity + other.opacity)
+
+  def __rmul__(self, other):
+    return self.__mul__(other)
+
+  def __radd__(self, other):
+    return self.__add__(other)
+
+  # Returns a new instance of transparent black
+  @classmethod
+  def transparent(cls):
+    return cls(0.0, 0.0, 0.0, 0.0, 0.0)
+
+
 class Color(Image):
   __tablename__ = None
 
@@ -350,28 +527,23 @@ class Color(Image):
   def __int__(self) -> int:
     return self.toWS281xColor()
 
+  # Converts to the lightweight value type used for compositing
+  def toValue(self) -> ColorValue:
+    return ColorValue(self.red, self.green, self.blue, self.white, self.opacity)
+
   # Implement basic arithmetic operations
-  def __mul__(self, scale: Union[float, int]) -> Color:
+  # Results are ColorValues, so no mapped Color is allocated per operation
+  def __mul__(self, scale: Union[float, int]) -> ColorValue:
     if not isinstance(scale, (float, int)):
       raise NotImplementedError
-    result = Color.transparent()
-    result.red = self.red * scale
-    result.green = self.green * scale
-    result.blue = self.blue * scale
-    result.white = self.white * scale
-    result.opacity = self.opacity * scale
-    return result
-
-  def __add__(self, other: Color) -> Color:
-    if not isinstance(other, Color):
+    return ColorValue(self.red * scale, self.green * scale, self.blue * scale,
+                      self.white * scale, self.opacity * scale)
+
+  def __add__(self, other: Union[Color, ColorValue]) -> ColorValue:
+    if not isinstance(other, (Color, ColorValue)):
       raise NotImplementedError
-    result = Color.transparent()
-    result.red = self.red + other.red
-    result.green = self.green + other.green
-    result.blue = self.blue + other.blue
-    result.white = self.white + other.white
-    result.opacity = self.opacity + other.opacity
-    return result
+    return ColorValue(self.red + other.red, self.green + other.green, self.blue + other.blue,
+                      self.white + other.white, self.opacity + other.opacity)
 
   def __rmul__(self, other):
     return self.__mul__(other)
@@ -423,6 +595,7 @@ class ColorStop(Keyframe, Base):
   """
   @classmethod
   def create(cls, root, info, gradient_id, fields):
+    flush_writes(info.context)
     value = input_to_dictionary(fields)
     orm_object = cls(gradient_id=gradient_id, **value)
     info.context['session'].add(orm_object)
@@ -455,25 +628,56 @@ class Layer(Base):
                       cascade='all, delete-orphan', single_parent=True)
   repeat = Column(Float)
 
-  def getColorAtPosition(self, pos: float) -> Color:
-    if (pos - self.left) / self.size <= self.repeat:
-      return self.image.getColorAtPosition(((pos - self.left) % self.size) / self.size)
+  def getColorAtPosition(self, pos: float) -> Union[Color, ColorValue]:
+    # Read each dimension once; within a FrameContext this is a memo lookup
+    left = self.left.currentValue()
+    size = self.size.currentValue()
+    if (pos - left) / size <= self.repeat:
+      return self.image.getColorAtPosition(((pos - left) % size) / size)
     else:
-      return Color.transparent()
+      return ColorValue.transparent()
 
 
 class Scene(Base):
   name = Column(String)
   layers = relationship(Layer, cascade='all, delete-orphan')
 
-  def getColorAtPosition(self, pos: float) -> Color:
-    # Start with an opaque black background
-    result = Color(red=0.0, green=0.0, blue=0.0)
-    # Blend colours layer by layer
-    for layer in self.layers:
+  def getColorAtPosition(self, pos: float) -> ColorValue:
+    if FrameContext.current() is None:
+      # A lone pixel is a frame of its own
+      with FrameContext():
+        return self.getColorAtPosition(pos)
+    # Blend colours front to back: `remaining` is how much of the layers below
+    # still shows through, so once it reaches 0 they needn't be evaluated at all
+    result = ColorValue.transparent()
+    remaining = 1.0
+    for layer in reversed(self.layers):
       color = layer.getColorAtPosition(pos)
-      result = result * (1.0 - color.opacity) + color
-    return result
+      result = result + color * remaining
+      remaining *= 1.0 - color.opacity
+      if remaining == 0.0:
+        return result
+    # Finish on an opaque black background
+    return result + ColorValue(0.0, 0.0, 0.0, 0.0, 1.0) * remaining
+
+  """
+  Colours at every position for one frame at time t (default: now)
+  Sensors and animations are evaluated once for the whole frame
+  """
+  def getColorsAtPositions(self, positions: List[float], t: Optional[float] = None) -> List[ColorValue]:
+    with FrameContext(t):
+      return [self.getColorAtPosition(pos) for pos in positions]
+
+  """
+  Renders the whole scene for n_pixels evenly spaced LEDs at time t
+  Returns an (n_pixels, 5) array of premultiplied RGBWA values
+  Note: this compiles the scene on every call; render loops should compile it
+  once with renderplan.compile_scene and call renderer.render_frame directly
+  """
+  def render_frame(self, n_pixels: int, t: float):
+    from renderplan import compile_scene
+    from renderer import render_frame
+    return render_frame(compile_scene(self), n_pixels, t)
 
 
 class Device(Base):
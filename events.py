@@ -0,0 +1,183 @@
+"""
+Change events
+Sessions registered with track_changes collect what each flush creates, updates
+and deletes, and once the transaction commits, publish the ChangeEvents of the
+commit, one per changed row, as a tuple on `commits` (an Rx Subject) and one by
+one on `changes`. Every event names the scenes whose
+rendering it affects, so subscribers can follow a scene without knowing how its
+layers, images, dimensions, keyframes and sensors hang together.
+Rolled back changes are never published.
+"""
+import logging
+from dataclasses import dataclass
+from typing import FrozenSet, Set
+from rx import Observable
+from rx.subjects import Subject
+from sqlalchemy import event, inspect, or_
+from controller import Device, Scene, Layer, Image, ColorStop, ColorKeyframe, ColorAnimation, Dimension, DimensionKeyframe, DimensionAnimation, Sensor
+
+logger = logging.getLogger(__name__)
+
+CREATED = 'created'
+UPDATED = 'updated'
+DELETED = 'deleted'
+
+
+@dataclass(frozen=True)
+class ChangeEvent:
+  action: str
+  # Model class name, e.g. 'ColorStop'
+  entity: str
+  id: int
+  # Scenes the change affects; for a device, the scene it shows
+  scene_ids: FrozenSet[int]
+  # Names of the changed columns and relationships of an updated row
+  fields: FrozenSet[str] = frozenset()
+
+
+# Tuple of the ChangeEvents of each commit
+commits = Subject()
+# Every committed ChangeEvent
+changes = commits.flat_map(lambda batch: Observable.from_(batch))
+
+
+def _layer_scene_ids(session, condition) -> Set[int]:
+  return {scene_id for scene_id, in session.query(Layer.scene_id).filter(condition) if scene_id is not None}
+
+
+def image_scene_ids(session, image_id: int) -> Set[int]:
+  scene_ids = _layer_scene_ids(session, Layer.image_id == image_id)
+  # Colours can also be the value of a colour stop or a colour keyframe
+  for gradient_id, in session.query(ColorStop.gradient_id).filter(ColorStop.color_id == image_id):
+    if gradient_id is not None:
+      scene_ids |= image_scene_ids(session, gradient_id)
+  for animation_id, in session.query(ColorKeyframe.animation_id).filter(ColorKeyframe.color_id == image_id):
+    if animation_id is not None:
+      scene_ids |= image_scene_ids(session, animation_id)
+  return scene_ids
+
+
+def dimension_scene_ids(session, dimension_id: int) -> Set[int]:
+  return _layer_scene_ids(session, or_(Layer.size_id == dimension_id, Layer.left_id == dimension_id))
+
+
+def sensor_scene_ids(session, sensor_id: int) -> Set[int]:
+  scene_ids = set()
+  for image_id, in session.query(ColorAnimation.id).filter(ColorAnimation.sensor_id == sensor_id):
+    scene_ids |= image_scene_ids(session, image_id)
+  for dimension_id, in session.query(DimensionAnimation.id).filter(DimensionAnimation.sensor_id == sensor_id):
+    scene_ids |= dimension_scene_ids(session, dimension_id)
+  return scene_ids
+
+
+"""
+Scenes an object belongs to, found through the rows currently in the database
+"""
+def scene_ids_of(session, obj) -> Set[int]:
+  if isinstance(obj, Scene):
+    return {obj.id}
+  if isinstance(obj, (Layer, Device)):
+    return {obj.scene_id} if obj.scene_id is not None else set()
+  if isinstance(obj, Image):
+    return image_scene_ids(session, obj.id)
+  if isinstance(obj, ColorStop):
+    return image_scene_ids(session, obj.gradient_id) if obj.gradient_id is not None else set()
+  if isinstance(obj, ColorKeyframe):
+    return image_scene_ids(session, obj.animation_id) if obj.animation_id is not None else set()
+  if isinstance(obj, Dimension):
+    return dimension_scene_ids(session, obj.id)
+  if isinstance(obj, DimensionKeyframe):
+    return dimension_scene_ids(session, obj.animation_id) if obj.animation_id is not None else set()
+  if isinstance(obj, Sensor):
+    return sensor_scene_ids(session, obj.id)
+  return set()
+
+
+def changed_fields(obj) -> FrozenSet[str]:
+  return frozenset(attr.key for attr in inspect(obj).attrs if attr.history.has_changes())
+
+
+def _event(session, action: str, obj) -> ChangeEvent:
+  with session.no_autoflush:
+    scene_ids = scene_ids_of(session, obj)
+  fields = changed_fields(obj) if action == UPDATED else frozenset()
+  return ChangeEvent(action, type(obj).__name__, obj.id, frozenset(scene_ids), fields)
+
+
+def _pending(session) -> list:
+  return session.info.setdefault('change_events', [])
+
+
+"""
+Reports a row that was written without going through the ORM (e.g. by
+INSERT ... SELECT) as changed by the session's transaction
+"""
+def record_change(session, action: str, obj) -> None:
+  _pending(session).append(_event(session, action, obj))
+
+
+"""
+Rows the flush will delete because they were removed from a delete-orphan
+relationship (e.g. a layer taken out of scene.layers), and everything that
+cascades from them
+"""
+def orphans(session) -> list:
+  found = []
+  for obj in session.dirty:
+    state = inspect(obj)
+    for relationship in state.mapper.relationships:
+      if relationship.cascade.delete_orphan:
+        # Unloaded relationships have a blank history
+        removed = state.attrs[relationship.key].history.deleted or ()
+        found.extend(child for child in removed if child is not None and inspect(child).persistent)
+  for orphan in list(found):
+    found.extend(child for child, _, _, _ in inspect(orphan).mapper.cascade_iterator('delete', inspect(orphan)))
+  return found
+
+
+# Deleted rows have to be traced to their scenes while they still exist
+def _before_flush(session, flush_context, instances) -> None:
+  # By state, as keyframes compare (and don't hash) by position
+  deleted = {inspect(obj): obj for obj in session.deleted}
+  for obj in orphans(session):
+    deleted.setdefault(inspect(obj), obj)
+  _pending(session).extend(_event(session, DELETED, obj) for obj in deleted.values())
+
+
+# New rows only have IDs and foreign keys once they are flushed
+def _after_flush(session, flush_context) -> None:
+  pending = _pending(session)
+  pending.extend(_event(session, CREATED, obj) for obj in session.new)
+  pending.extend(_event(session, UPDATED, obj) for obj in session.dirty if session.is_modified(obj))
+
+
+def _after_commit(session) -> None:
+  session.info['committed_events'] = session.info.pop('change_events', [])
+
+
+"""
+Publishes committed changes once the transaction is over, so that subscribers
+can already read through the session; whatever is still pending then was
+rolled back
+"""
+def _after_transaction_end(session, transaction) -> None:
+  if transaction.parent is None:
+    session.info.pop('change_events', None)
+    committed = tuple(session.info.pop('committed_events', ()))
+    if committed:
+      try:
+        commits.on_next(committed)
+      except Exception:
+        # A failing subscriber mustn't fail the mutation that already committed
+        logger.exception('Change event subscriber failed')
+
+
+"""
+Publishes the committed changes of every session made by target (a
+sessionmaker, or a Session class)
+"""
+def track_changes(target) -> None:
+  event.listen(target, 'before_flush', _before_flush)
+  event.listen(target, 'after_flush', _after_flush)
+  event.listen(target, 'after_commit', _after_commit)
+  event.listen(target, 'after_transaction_end', _after_transaction_end)
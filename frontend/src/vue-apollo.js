@@ -11,17 +11,21 @@ const AUTH_TOKEN = 'apollo-token'
 // Http endpoint
 const httpEndpoint = process.env.VUE_APP_GRAPHQL_HTTP || 'http://localhost:5000/graphql'
 
+// Websocket endpoint for subscriptions
+const wsEndpoint = process.env.VUE_APP_GRAPHQL_WS || 'ws://localhost:5000/subscriptions'
+
 // Config
 const defaultOptions = {
   // You can use `https` for secure connection (recommended in production)
   httpEndpoint,
   // You can use `wss` for secure connection (recommended in production)
   // Use `null` to disable subscriptions
-  wsEndpoint: null,
+  wsEndpoint,
   // LocalStorage token
   tokenName: AUTH_TOKEN,
-  // Enable Automatic Query persisting with Apollo Engine
-  persisting: false,
+  // Enable Automatic Query persisting: queries the server has seen are sent
+  // as their hash only
+  persisting: true,
   // Use websockets for everything (no HTTP)
   // You need to pass a `wsEndpoint` for this to work
   websocketsOnly: false,
@@ -1,8 +1,14 @@
 from copy import deepcopy
-from graphene import Mutation, ObjectType, Schema, String, Float, Argument, Field, ID, Union, List, Enum
+from graphene import Mutation, ObjectType, InputObjectType, Schema, String, Float, Int, Argument, Field, InputField, ID, Union, List, Enum
+from rx import Observable
 from graphene_sqlalchemy import SQLAlchemyObjectType, SQLAlchemyConnectionField
-from controller import Device as DeviceModel, Scene as SceneModel, Animation as AnimationModel, Layer as LayerModel, Color as ColorModel, ColorAnimation as ColorAnimationModel, Gradient as GradientModel, ColorStop as ColorStopModel, ColorKeyframe as ColorKeyframeModel, DimensionAnimation as DimensionAnimationModel, StaticDimension as StaticDimensionModel, Clock as ClockModel, DimensionKeyframe as DimensionKeyframeModel
-from graphqlutils import SQLAlchemyInputObjectType, AnimationType, DimensionType
+from controller import flush_writes, Device as DeviceModel, Scene as SceneModel, Animation as AnimationModel, Layer as LayerModel, Color as ColorModel, ColorAnimation as ColorAnimationModel, Gradient as GradientModel, ColorStop as ColorStopModel, ColorKeyframe as ColorKeyframeModel, DimensionAnimation as DimensionAnimationModel, StaticDimension as StaticDimensionModel, Clock as ClockModel, DimensionKeyframe as DimensionKeyframeModel
+from events import DELETED, UPDATED, changes, commits
+from graphqlutils import SQLAlchemyInputObjectType, AnimationType, DimensionType, eager_load_options
+from clone import duplicate_scene
+from loaders import load_related, loaders_for, reset_loaders
+from responsecache import depends_on, uncacheable
+from scenedocument import upsert_scene
 
 class Device(SQLAlchemyObjectType):
   class Meta:
@@ -43,6 +49,7 @@ class SetScene(Mutation):
 
   @staticmethod
   def mutate(root, info, device_id, scene_id=None):
+    flush_writes(info.context)
     device_object = info.context['session'].query(DeviceModel).filter(DeviceModel.id == device_id).one()
     if scene_id:
       device_object.scene = info.context['session'].query(SceneModel).filter(SceneModel.id == scene_id).one()
@@ -54,6 +61,10 @@ class SetScene(Mutation):
 class Scene(SQLAlchemyObjectType):
   class Meta:
     model = SceneModel
+  layers = List(lambda: Layer)
+
+  def resolve_layers(self, info):
+    return load_related(self, 'layers', loaders_for(info.context).layers, self.id)
 
 class SceneInput(SQLAlchemyInputObjectType):
   class Meta:
@@ -119,6 +130,10 @@ class DimensionAnimation(SQLAlchemyObjectType):
   class Meta:
     model = DimensionAnimationModel
     exclude_fields = ('identity', 'sensor_id')
+  keyframes = List(lambda: DimensionKeyframe)
+
+  def resolve_keyframes(self, info):
+    return load_related(self, 'keyframes', loaders_for(info.context).dimension_keyframes, self.id)
 
 class DimensionAnimationInput(SQLAlchemyInputObjectType):
   class Meta:
@@ -238,6 +253,13 @@ class ColorAnimation(SQLAlchemyObjectType):
     model = ColorAnimationModel
     exclude_fields = ('identity', 'sensor_id')
   sensor = Field(Sensor)
+  keyframes = List(lambda: ColorKeyframe)
+
+  def resolve_sensor(self, info):
+    return load_related(self, 'sensor', loaders_for(info.context).sensors, self.sensor_id)
+
+  def resolve_keyframes(self, info):
+    return load_related(self, 'keyframes', loaders_for(info.context).color_keyframes, self.id)
 
 class ColorAnimationInput(SQLAlchemyInputObjectType):
   class Meta:
@@ -264,6 +286,10 @@ class ColorKeyframe(SQLAlchemyObjectType):
   class Meta:
     model = ColorKeyframeModel
     exclude_fields = ('animation_id', 'color_id')
+  value = Field(Color)
+
+  def resolve_value(self, info):
+    return load_related(self, 'value', loaders_for(info.context).images, self.color_id)
 
 class ColorKeyframeInput(SQLAlchemyInputObjectType):
   class Meta:
@@ -297,6 +323,10 @@ class Gradient(SQLAlchemyObjectType):
   class Meta:
     model = GradientModel
     exclude_fields = ('identity',)
+  colorstops = List(lambda: ColorStop)
+
+  def resolve_colorstops(self, info):
+    return load_related(self, 'colorstops', loaders_for(info.context).colorstops, self.id)
 
 class CreateGradient(Mutation):
   class Arguments:
@@ -310,6 +340,10 @@ class ColorStop(SQLAlchemyObjectType):
   class Meta:
     model = ColorStopModel
     exclude_fields = ('gradient_id', 'color_id')
+  value = Field(Color)
+
+  def resolve_value(self, info):
+    return load_related(self, 'value', loaders_for(info.context).images, self.color_id)
 
 class ColorStopInput(SQLAlchemyInputObjectType):
   class Meta:
@@ -353,6 +387,15 @@ class Layer(SQLAlchemyObjectType):
   size = Field(Dimension)
   left = Field(Dimension)
 
+  def resolve_image(self, info):
+    return load_related(self, 'image', loaders_for(info.context).images, self.image_id)
+
+  def resolve_size(self, info):
+    return load_related(self, 'size', loaders_for(info.context).dimensions, self.size_id)
+
+  def resolve_left(self, info):
+    return load_related(self, 'left', loaders_for(info.context).dimensions, self.left_id)
+
 class LayerInput(SQLAlchemyInputObjectType):
   class Meta:
     model = LayerModel
@@ -382,28 +425,343 @@ class DeleteLayer(Mutation):
       result=LayerModel.delete(root, info, id))
 
 
+class ColorDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = ColorModel
+    exclude_fields = ('identity',)
+    skip_registry = True
+  id = ID()
+
+class ClockDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = ClockModel
+    exclude_fields = ('identity',)
+    skip_registry = True
+  id = ID()
+
+class ColorStopDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = ColorStopModel
+    exclude_fields = ('gradient_id', 'color_id', 'value')
+    skip_registry = True
+  id = ID()
+  value = InputField(ColorDocument)
+
+class GradientDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = GradientModel
+    exclude_fields = ('identity', 'colorstops')
+    skip_registry = True
+  id = ID()
+  colorstops = List(ColorStopDocument)
+
+class ColorKeyframeDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = ColorKeyframeModel
+    exclude_fields = ('animation_id', 'color_id', 'value')
+    skip_registry = True
+  id = ID()
+  value = InputField(ColorDocument)
+
+class ColorAnimationDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = ColorAnimationModel
+    exclude_fields = ('identity', 'sensor_id', 'sensor', 'keyframes')
+    skip_registry = True
+  id = ID()
+  sensor = InputField(ClockDocument)
+  keyframes = List(ColorKeyframeDocument)
+
+# Exactly one of the fields must be set
+class ImageDocument(InputObjectType):
+  color = InputField(ColorDocument)
+  gradient = InputField(GradientDocument)
+  color_animation = InputField(ColorAnimationDocument)
+
+class StaticDimensionDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = StaticDimensionModel
+    exclude_fields = ('identity',)
+    skip_registry = True
+  id = ID()
+
+class DimensionKeyframeDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = DimensionKeyframeModel
+    exclude_fields = ('animation_id',)
+    skip_registry = True
+  id = ID()
+
+class DimensionAnimationDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = DimensionAnimationModel
+    exclude_fields = ('identity', 'sensor_id', 'sensor', 'keyframes')
+    skip_registry = True
+  id = ID()
+  sensor = InputField(ClockDocument)
+  keyframes = List(DimensionKeyframeDocument)
+
+# Exactly one of the fields must be set
+class DimensionDocument(InputObjectType):
+  static = InputField(StaticDimensionDocument)
+  animation = InputField(DimensionAnimationDocument)
+
+class LayerDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = LayerModel
+    exclude_fields = ('scene_id', 'image_id', 'size_id', 'left_id', 'image', 'size', 'left')
+    skip_registry = True
+  id = ID()
+  image = InputField(ImageDocument)
+  size = InputField(DimensionDocument)
+  left = InputField(DimensionDocument)
+
+class SceneDocument(SQLAlchemyInputObjectType):
+  class Meta:
+    model = SceneModel
+    exclude_fields = ('layers',)
+    skip_registry = True
+  id = ID()
+  layers = List(LayerDocument)
+
+"""
+Creates a scene, or updates the one with the document's ID, from a whole nested
+scene document in a single commit (see scenedocument)
+"""
+class UpsertScene(Mutation):
+  class Arguments:
+    scene = Argument(SceneDocument, required=True)
+  result = Field(Scene)
+
+  @staticmethod
+  def mutate(root, info, scene):
+    flush_writes(info.context)
+    return UpsertScene(result=upsert_scene(info.context['session'], scene))
+
+"""
+Copies a scene with all its layers, e.g. to start a new one from a template,
+with a few INSERT ... SELECT statements however big it is (see clone)
+"""
+class DuplicateScene(Mutation):
+  class Arguments:
+    id = ID(required=True)
+    # Name of the copy, the original's if left out
+    name = String()
+  result = Field(Scene)
+
+  @staticmethod
+  def mutate(root, info, id, name=None):
+    flush_writes(info.context)
+    return DuplicateScene(result=duplicate_scene(info.context['session'], id, name))
+
+
+class RenderTiming(ObjectType):
+  calls = Int()
+  total_ms = Float()
+  mean_ms = Float()
+
+  @staticmethod
+  def fields_from(timing):
+    return dict(calls=timing.calls, total_ms=timing.seconds * 1000, mean_ms=timing.mean_seconds * 1000)
+
+class LayerRenderTiming(RenderTiming):
+  layer_id = ID()
+
+class TypeRenderTiming(RenderTiming):
+  type_name = String()
+
+class RenderProfile(ObjectType):
+  scene_id = ID()
+  frames = Int()
+  pixels = Int()
+  total = Field(RenderTiming)
+  layers = List(LayerRenderTiming)
+  types = List(TypeRenderTiming)
+
+
+class ResponseCacheStats(ObjectType):
+  hits = Int()
+  misses = Int()
+  size = Int()
+
+
+class RenderStatus(ObjectType):
+  rendered = Int()
+  dropped = Int()
+  late = Int()
+  unchanged = Int()
+  restarts = Int()
+
+
+# Most frames renderProfile has the render process profile at a time
+MAX_PROFILE_FRAMES = 300
+
+
 class RootQuery(ObjectType):
   devices = List(Device)
   device = Field(Device, id=ID(required=True))
   scenes = List(Scene)
   scene = Field(Scene, id=ID(required=True))
+  render_profile = Field(RenderProfile, scene_id=ID(required=True), frames=Int())
+  response_cache = Field(ResponseCacheStats)
+  render_status = Field(RenderStatus)
 
+  # Reads are answered from the context's ObjectStore ("store") when it has one,
+  # noting what they read so that the response can be cached (see responsecache)
   def resolve_devices(self, info):
-    query = Device.get_query(info)
+    # Devices show their scenes
+    depends_on(info.context, DeviceModel)
+    depends_on(info.context, SceneModel)
+    store = info.context.get('store')
+    if store is not None:
+      return store.all(DeviceModel)
+    query = Device.get_query(info).options(*eager_load_options(info, DeviceModel))
     return query.all()
 
   def resolve_device(self, info, id):
-    query = Device.get_query(info)
+    depends_on(info.context, DeviceModel, id)
+    depends_on(info.context, SceneModel)
+    store = info.context.get('store')
+    if store is not None:
+      return store.get(DeviceModel, id)
+    query = Device.get_query(info).options(*eager_load_options(info, DeviceModel))
     return query.filter(DeviceModel.id == id).one_or_none()
 
   def resolve_scenes(self, info):
-    query = Scene.get_query(info)
+    depends_on(info.context, SceneModel)
+    store = info.context.get('store')
+    if store is not None:
+      return store.all(SceneModel)
+    query = Scene.get_query(info).options(*eager_load_options(info, SceneModel))
     return query.all()
 
   def resolve_scene(self, info, id):
-    query = Scene.get_query(info)
+    depends_on(info.context, SceneModel, id)
+    store = info.context.get('store')
+    if store is not None:
+      return store.get(SceneModel, id)
+    query = Scene.get_query(info).options(*eager_load_options(info, SceneModel))
     return query.filter(SceneModel.id == id).one_or_none()
 
+  """
+  Has the render process profile the given number of frames it shows, and
+  returns where the time of the scene's frames went in the last profile it sent
+  back (null until there is one, or when no device showed the scene then)
+  """
+  def resolve_render_profile(self, info, scene_id, frames=60):
+    uncacheable(info.context)
+    if not 1 <= frames <= MAX_PROFILE_FRAMES:
+      raise ValueError('frames must be between 1 and {}'.format(MAX_PROFILE_FRAMES))
+    renderer = info.context.get('renderer')
+    if renderer is None:
+      return None
+    renderer.request_profile(frames)
+    profile = renderer.profile(scene_id)
+    if profile is None:
+      return None
+    return RenderProfile(
+      scene_id=profile.scene_id,
+      frames=profile.total.calls,
+      pixels=profile.pixels,
+      total=RenderTiming(**RenderTiming.fields_from(profile.total)),
+      layers=[LayerRenderTiming(layer_id=layer_id, **RenderTiming.fields_from(timing))
+              for layer_id, timing in profile.layers],
+      types=[TypeRenderTiming(type_name=name, **RenderTiming.fields_from(timing))
+             for name, timing in sorted(profile.types.items())],
+    )
+
+  # For monitoring: how often read queries were answered from the cache
+  def resolve_response_cache(self, info):
+    uncacheable(info.context)
+    responses = info.context.get('responses')
+    return ResponseCacheStats(**responses.stats()) if responses is not None else None
+
+  # Frame counters of the render process, or null when it isn't running
+  def resolve_render_status(self, info):
+    uncacheable(info.context)
+    renderer = info.context.get('renderer')
+    status = renderer.status() if renderer is not None else None
+    return RenderStatus(**status) if status is not None else None
+
+
+class DeviceChange(ObjectType):
+  action = String()
+  id = ID()
+  # The device as it is after the change, or null once deleted
+  device = Field(Device)
+
+  def resolve_device(self, info):
+    # The context lives as long as the subscription, the loaders only one push
+    reset_loaders(info.context)
+    if self.action == DELETED:
+      return None
+    store = info.context.get('store')
+    if store is not None:
+      return store.get(DeviceModel, self.id)
+    return info.context['session'].query(DeviceModel).filter(DeviceModel.id == self.id).one_or_none()
+
+class EntityChange(ObjectType):
+  action = String()
+  # Type name and ID of the row that changed, e.g. a ColorStop of one of the layers
+  entity = String()
+  entity_id = ID()
+
+class SceneChange(ObjectType):
+  # created or deleted when the scene itself was, updated otherwise
+  action = String()
+  scene_id = ID()
+  changes = List(EntityChange)
+  # The scene as it is after the change, or null once deleted
+  scene = Field(Scene)
+
+  def resolve_scene(self, info):
+    reset_loaders(info.context)
+    if self.action == DELETED:
+      return None
+    store = info.context.get('store')
+    if store is not None:
+      return store.get(SceneModel, self.scene_id)
+    return info.context['session'].query(SceneModel).filter(SceneModel.id == self.scene_id).one_or_none()
+
+  """
+  One SceneChange per scene touched by a commit
+  """
+  @staticmethod
+  def from_commit(batch):
+    scenes = {}
+    for change in batch:
+      if change.entity == 'Device':
+        continue
+      for scene_id in sorted(change.scene_ids):
+        scene = scenes.setdefault(scene_id, SceneChange(action=UPDATED, scene_id=scene_id, changes=[]))
+        if change.entity == 'Scene':
+          scene.action = change.action
+        scene.changes.append(EntityChange(action=change.action, entity=change.entity, entity_id=change.id))
+    return list(scenes.values())
+
+
+class RootSubscription(ObjectType):
+  device_changed = Field(DeviceChange, id=ID())
+  scene_changed = Field(SceneChange, id=ID())
+
+  """
+  Pushes every created, updated and deleted device (or only the given one),
+  including changes to which scene it shows
+  """
+  def resolve_device_changed(self, info, id=None):
+    return changes \
+      .filter(lambda change: change.entity == 'Device' and (id is None or change.id == int(id))) \
+      .map(lambda change: DeviceChange(action=change.action, id=change.id))
+
+  """
+  Pushes a change to a scene (or only the given one) once per commit that
+  creates, updates or deletes the scene or anything in it
+  """
+  def resolve_scene_changed(self, info, id=None):
+    return commits \
+      .flat_map(lambda batch: Observable.from_([
+        scene for scene in SceneChange.from_commit(batch) if id is None or scene.scene_id == int(id)]))
+
 
 class RootMutation(ObjectType):
   createDevice = CreateDevice.Field()
@@ -413,6 +771,8 @@ class RootMutation(ObjectType):
   createScene = CreateScene.Field()
   updateScene = UpdateScene.Field()
   deleteScene = DeleteScene.Field()
+  upsertScene = UpsertScene.Field()
+  duplicateScene = DuplicateScene.Field()
   createClock = CreateClock.Field()
   updateClock = UpdateClock.Field()
   createDimensionAnimation = CreateDimensionAnimation.Field()
@@ -438,4 +798,4 @@ class RootMutation(ObjectType):
   deleteLayer = DeleteLayer.Field()
 
 
-schema = Schema(query=RootQuery, mutation=RootMutation)
+schema = Schema(query=RootQuery, mutation=RootMutation, subscription=RootSubscription)
@@ -1,4 +1,6 @@
+import re
 from graphene import InputObjectType, Field, Enum
+from graphql.language import ast
 from graphql_relay.node.node import from_global_id
 from graphene.relay import Connection, Node
 from graphene.types.inputobjecttype import InputObjectTypeOptions
@@ -7,6 +9,9 @@ from graphene_sqlalchemy.types import construct_fields
 from graphene_sqlalchemy.enums import enum_for_field, sort_argument_for_object_type, sort_enum_for_object_type
 from graphene_sqlalchemy.registry import Registry
 from graphene_sqlalchemy.utils import is_mapped_class, is_mapped_instance, get_query
+from sqlalchemy import inspect
+from sqlalchemy import orm
+from sqlalchemy.orm import with_polymorphic
 from sqlalchemy.orm.exc import NoResultFound
 
 def input_to_dictionary(user_input):
@@ -207,3 +212,80 @@ class AnimationType(Enum):
 class DimensionType(Enum):
   LEFT = 'left'
   SIZE = 'size'
+
+
+def _snake_case(name):
+  return re.sub(r'([A-Z])', lambda match: '_' + match.group(1).lower(), name)
+
+
+def _type_model(info, type_name, model):
+  graphene_type = getattr(info.schema.get_type(type_name), 'graphene_type', None)
+  type_model = getattr(getattr(graphene_type, '_meta', None), 'model', None)
+  # Conditions on unions or on other branches of the hierarchy don't narrow the model
+  if type_model is not None and issubclass(type_model, model):
+    return type_model
+  return model
+
+
+"""
+(model, field) pairs of a selection set, with fragments expanded; fields inside
+fragments on a subtype of model come with that subtype
+"""
+def _selected_fields(info, selection_set, model):
+  for selection in selection_set.selections:
+    if isinstance(selection, ast.Field):
+      yield model, selection
+    else:
+      fragment = info.fragments[selection.name.value] if isinstance(selection, ast.FragmentSpread) else selection
+      fragment_model = _type_model(info, fragment.type_condition.name.value, model) if fragment.type_condition else model
+      yield from _selected_fields(info, fragment.selection_set, fragment_model)
+
+
+def _eager_load_options(info, selection_sets, model, entity, parent):
+  # Relationships selected more than once (e.g. by several fragments) are
+  # loaded once, for all their selections
+  selected = {}
+  for selection_set in selection_sets:
+    for field_model, field in _selected_fields(info, selection_set, model):
+      relationship = inspect(field_model).relationships.get(_snake_case(field.name.value))
+      if relationship is None or field.selection_set is None:
+        continue
+      if issubclass(model, relationship.parent.class_):
+        # Inherited from model itself
+        field_model = model
+      selected.setdefault((field_model, relationship), []).append(field.selection_set)
+  options = []
+  for (field_model, relationship), field_selection_sets in selected.items():
+    if field_model is model:
+      owner = entity
+    elif entity is model:
+      owner = field_model
+    else:
+      # Subtype attributes are reached through the parent's polymorphic alias
+      owner = getattr(entity, field_model.__name__)
+    attribute = getattr(owner, relationship.key)
+    target = relationship.mapper
+    if len(target.self_and_descendants) > 1:
+      # Load every subtype's columns, so that fragments on any of them can be followed
+      target_entity = with_polymorphic(target.class_, '*', aliased=True)
+      option = parent.selectinload(attribute.of_type(target_entity))
+    else:
+      target_entity = target.class_
+      option = parent.selectinload(attribute) if relationship.uselist else parent.joinedload(attribute)
+    options.append(option)
+    options += _eager_load_options(info, field_selection_sets, target.class_, target_entity, option)
+  return options
+
+
+"""
+Loader options that eagerly load the relationships the current field's
+selection set asks for, and only those
+Collections and polymorphic relationships (images, dimensions, sensors) are
+loaded with one SELECT ... IN per level, other many-to-one relationships are
+joined in.
+"""
+def eager_load_options(info, model):
+  selection_sets = [field.selection_set for field in info.field_asts if field.selection_set is not None]
+  # Paths start from the unbound options (orm.selectinload...), as paths bound
+  # to Load(model) drop what follows a polymorphic alias
+  return _eager_load_options(info, selection_sets, model, model, orm)
@@ -0,0 +1,102 @@
+"""
+Per-request batched loading of scene relationships
+Resolving a nested query through lazy relationships costs one query per object:
+a scene's layers, each layer's image and dimensions, each gradient's colour
+stops, each stop's colour... The DataLoaders here collect every key asked for
+while one level of the query is resolved and fetch them in one IN query, so a
+whole scene takes one query per level, whatever its size.
+Loaders cache what they load, so they must not outlive a request: get them
+through loaders_for(info.context). Relationships that the root query already
+loaded eagerly are used as they are (see load_related).
+"""
+from collections import defaultdict
+from promise import Promise
+from promise.dataloader import DataLoader
+from sqlalchemy import inspect
+from sqlalchemy.orm import with_polymorphic
+from controller import Layer, Image, Dimension, ColorStop, ColorKeyframe, DimensionKeyframe, Sensor
+
+
+"""
+Loads rows by primary key; missing rows load as None
+Rows of polymorphic models are loaded with the columns of all their subclasses,
+so reading those doesn't cost another query per row
+"""
+class RowLoader(DataLoader):
+  def __init__(self, session, model) -> None:
+    super().__init__()
+    self.session = session
+    self.model = model
+
+  def batch_load_fn(self, ids):  # pylint: disable=method-hidden
+    entity = with_polymorphic(self.model, '*')
+    rows = {row.id: row for row in self.session.query(entity).filter(entity.id.in_(ids))}
+    return Promise.resolve([rows.get(id) for id in ids])
+
+
+"""
+Loads the children of parents by foreign key, as one list per parent
+"""
+class ChildrenLoader(DataLoader):
+  def __init__(self, session, model, parent_key, order_by) -> None:
+    super().__init__()
+    self.session = session
+    self.model = model
+    self.parent_key = parent_key
+    self.order_by = order_by
+
+  def batch_load_fn(self, parent_ids):  # pylint: disable=method-hidden
+    children = defaultdict(list)
+    query = self.session.query(self.model).filter(self.parent_key.in_(parent_ids)).order_by(self.order_by)
+    for child in query:
+      children[getattr(child, self.parent_key.key)].append(child)
+    return Promise.resolve([children[parent_id] for parent_id in parent_ids])
+
+
+class Loaders:
+  def __init__(self, session) -> None:
+    # Scene ID -> layers
+    self.layers = ChildrenLoader(session, Layer, Layer.scene_id, Layer.id)
+    # Colours, colour animations and gradients, by ID
+    self.images = RowLoader(session, Image)
+    self.dimensions = RowLoader(session, Dimension)
+    # Gradient ID -> colour stops
+    self.colorstops = ChildrenLoader(session, ColorStop, ColorStop.gradient_id, ColorStop.position)
+    # Colour animation ID -> keyframes
+    self.color_keyframes = ChildrenLoader(session, ColorKeyframe, ColorKeyframe.animation_id, ColorKeyframe.position)
+    # Dimension animation ID -> keyframes
+    self.dimension_keyframes = ChildrenLoader(session, DimensionKeyframe, DimensionKeyframe.animation_id, DimensionKeyframe.position)
+    self.sensors = RowLoader(session, Sensor)
+
+
+def loaders_for(context: dict) -> Loaders:
+  loaders = context.get('loaders')
+  if loaders is None:
+    loaders = context['loaders'] = Loaders(context['session'])
+  return loaders
+
+
+"""
+Drops the loaders of a context that is reused between executions (like that of
+a subscription), so the next one doesn't see what the previous one loaded
+"""
+def reset_loaders(context: dict) -> None:
+  context.pop('loaders', None)
+
+
+"""
+Loads the row a foreign key points at, or resolves to None without a query
+when the key is null
+"""
+def load_optional(loader: DataLoader, id):
+  return loader.load(id) if id is not None else None
+
+
+"""
+Value of a relationship of obj that was eagerly loaded with it, or otherwise
+loads it by key through loader
+"""
+def load_related(obj, key: str, loader: DataLoader, id):
+  if key not in inspect(obj).unloaded:
+    return getattr(obj, key)
+  return load_optional(loader, id)
@@ -0,0 +1,165 @@
+"""
+Resident object store
+The working set (devices, and scenes with their whole tree of layers, images,
+dimensions, colour stops and keyframes) is small, so it is loaded once at
+startup into a session of its own and kept there, and RootQuery reads are
+answered from it without going to the database.
+The store follows the committed change events: the scenes and devices a commit
+touches are reloaded together when it is published. The server runs requests
+and commits on gevent's loop and reading the store never yields, so a request
+sees the store as it was between two commits.
+Column updates handed to update() show at once and are written in the
+background by a WriteCoalescer.
+Every scene and device has a revision, which changes whenever what the store
+shows of it does, so that what was read from it can be cached (see
+responsecache).
+"""
+from collections import defaultdict
+from itertools import count
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from controller import ColorAnimation, ColorKeyframe, ColorStop, Device, DimensionAnimation, DimensionKeyframe, Gradient, Scene
+from events import scene_ids_of
+from renderplan import scene_loader_options
+from writecoalescer import WriteCoalescer
+
+# Rows kept in position order in a collection of their parent:
+# model -> (parent model, foreign key attribute, collection)
+POSITIONED = {
+  ColorStop: (Gradient, 'gradient_id', 'colorstops'),
+  ColorKeyframe: (ColorAnimation, 'animation_id', 'keyframes'),
+  DimensionKeyframe: (DimensionAnimation, 'animation_id', 'keyframes'),
+}
+
+
+class ObjectStore:
+  """
+  session_factory should make sessions that don't expire objects on commit
+  (expire_on_commit=False), or every reload would empty the store
+  """
+  def __init__(self, session_factory, writes: Optional[WriteCoalescer] = None) -> None:
+    self.session = session_factory()
+    self.writes = writes
+    # Model -> ID -> object
+    self._objects: Dict[type, Dict[int, object]] = {Device: {}, Scene: {}}
+    # (model, ID) -> column values handed to writes, which may not be committed yet
+    self._unwritten: Dict[Tuple[type, int], dict] = {}
+    # (model, ID) -> revision; (model, None) changes with any of the model's objects
+    self._revisions: Dict[Tuple[type, Optional[int]], int] = defaultdict(int)
+    self._next_revision = count(1)
+
+  def _reload(self, model, ids: Optional[Iterable[int]] = None) -> None:
+    query = self.session.query(model).populate_existing()
+    if model is Scene:
+      query = query.options(*scene_loader_options())
+    objects = self._objects[model]
+    if ids is None:
+      objects.clear()
+      objects.update((obj.id, obj) for obj in query)
+    else:
+      ids = set(ids)
+      found = {obj.id: obj for obj in query.filter(model.id.in_(ids))}
+      for id in ids:
+        if id in found:
+          objects[id] = found[id]
+        else:
+          objects.pop(id, None)
+    if model is Device:
+      # Loading the scenes along with the devices would reset their layers
+      for device in objects.values():
+        set_committed_value(device, 'scene', self._objects[Scene].get(device.scene_id))
+
+  # Ends the read transaction, so that the store doesn't hold on to a snapshot
+  # of the database (and WAL checkpoints aren't held back)
+  def _end_read(self) -> None:
+    self.session.commit()
+
+  def load(self) -> None:
+    self._reload(Scene)
+    self._reload(Device)
+    self._end_read()
+
+  def all(self, model) -> list:
+    return [obj for _, obj in sorted(self._objects[model].items())]
+
+  def get(self, model, id):
+    return self._objects[model].get(int(id))
+
+  """
+  Revision of an object, or of all the objects of a model when id is None
+  """
+  def revision(self, model, id: Optional[int] = None) -> int:
+    return self._revisions[(model, int(id) if id is not None else None)]
+
+  def _touch(self, model, ids: Iterable[int]) -> None:
+    for id in ids:
+      revision = next(self._next_revision)
+      self._revisions[(model, id)] = revision
+      self._revisions[(model, None)] = revision
+
+  """
+  Reloads what a commit changed; subscribe it to events.commits
+  """
+  def apply_changes(self, changes) -> None:
+    scene_ids = set()
+    device_ids = set()
+    for change in changes:
+      scene_ids |= change.scene_ids
+      if change.entity == Scene.__name__:
+        scene_ids.add(change.id)
+      elif change.entity == Device.__name__:
+        device_ids.add(change.id)
+    if scene_ids:
+      self._reload(Scene, scene_ids)
+    if device_ids:
+      self._reload(Device, device_ids)
+    self._show_unwritten()
+    self._touch(Scene, scene_ids)
+    self._touch(Device, device_ids)
+    self._end_read()
+
+  def _resident(self, model, id):
+    mapper = inspect(model)
+    return self.session.identity_map.get(mapper.identity_key_from_primary_key([id]))
+
+  # Sets column values as if they were loaded, and moves a row whose position
+  # changed to its place among its siblings
+  def _show(self, obj, values: dict) -> None:
+    for key, value in values.items():
+      set_committed_value(obj, key, value)
+    if 'position' in values and type(obj) in POSITIONED:
+      parent_model, foreign_key, collection = POSITIONED[type(obj)]
+      parent = self._resident(parent_model, getattr(obj, foreign_key))
+      if parent is not None and collection in parent.__dict__:
+        set_committed_value(parent, collection, sorted(getattr(parent, collection), key=lambda row: row.position))
+
+  # Reloads bring back the database's values of rows whose updates are still
+  # waiting to be written; until they are, the updates are shown instead
+  def _show_unwritten(self) -> None:
+    for (model, id), values in list(self._unwritten.items()):
+      obj = self._resident(model, id)
+      if obj is None or all(getattr(obj, key) == value for key, value in values.items()):
+        del self._unwritten[(model, id)]
+        continue
+      self._show(obj, values)
+
+  """
+  Shows new column values of a row right away and has writes commit them
+  """
+  def update(self, model, id: int, values: dict) -> None:
+    obj = self._resident(model, id)
+    if obj is not None:
+      self._show(obj, values)
+      self._unwritten.setdefault((model, id), {}).update(values)
+      self._touch(Scene, scene_ids_of(self.session, obj))
+      if isinstance(obj, Device):
+        self._touch(Device, [obj.id])
+      self._end_read()
+    self.writes.update(model, id, values)
+
+  """
+  Commits the updates still waiting in writes
+  """
+  def flush(self) -> None:
+    self.writes.flush()
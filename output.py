@@ -0,0 +1,72 @@
+"""
+Output stage: turns rendered RGBWA frames into the packed 32-bit words the
+rpi_ws281x driver keeps for each LED, and writes a whole frame to a strip in
+one bulk copy instead of one setPixelColor call per LED.
+"""
+import ctypes
+import numpy as np
+
+try:
+  from rpi_ws281x import PixelStrip, ws
+except ImportError:  # Not running on a Pi
+  PixelStrip = ws = None
+
+
+"""
+Packs an (n, 5) premultiplied RGBWA frame into an array of n uint32 words in
+the driver's 0xWWRRGGBB layout (the driver reorders the bytes into GRBW, RGBW,
+etc. for the configured strip type when it sends them out)
+Channels are rounded and clamped to 0-255 in the same pass.
+A strip is black where it is off, so what an LED shows for a premultiplied
+colour is that colour composited over black: the premultiplied channels
+themselves. Dividing by opacity and scaling back onto black cancels out, so
+partially transparent pixels are written as-is and fully transparent ones are
+black, rather than brightened to their unpremultiplied value.
+"""
+def pack_frame(frame: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+  channels = np.rint(frame[:, :4])
+  np.clip(channels, 0, 255, out=channels)
+  channels = channels.astype(np.uint32)
+  red, green, blue, white = channels.T
+  if out is None:
+    out = np.empty(len(frame), dtype=np.uint32)
+  np.left_shift(white, 24, out=out)
+  out |= red << 16
+  out |= green << 8
+  out |= blue
+  return out
+
+
+# The driver channel whose LED buffer an rpi_ws281x strip sends out, or None
+# for other strips; PixelStrip doesn't expose it, so releases that keep it
+# elsewhere get the setPixelColor path rather than an error
+def _channel(strip):
+  if PixelStrip is None or not isinstance(strip, PixelStrip):
+    return None
+  return getattr(strip, '_channel', None)
+
+
+"""
+Copies a packed frame into the strip's LED buffer
+For rpi_ws281x strips this is a single memmove into the driver's channel
+buffer; other strip-like objects fall back to setPixelColor per LED
+Doesn't call show()
+"""
+def write_frame(strip, packed: np.ndarray) -> None:
+  count = min(len(packed), strip.numPixels())
+  packed = np.ascontiguousarray(packed[:count], dtype=np.uint32)
+  channel = _channel(strip)
+  if channel is not None:
+    leds = ws.ws2811_channel_t_leds_get(channel)
+    ctypes.memmove(int(leds), packed.ctypes.data, packed.nbytes)
+  else:
+    for i, color in enumerate(packed.tolist()):
+      strip.setPixelColor(i, color)
+
+
+"""
+Packs a rendered frame, writes it to the strip and shows it
+"""
+def show_frame(strip, frame: np.ndarray) -> None:
+  write_frame(strip, pack_frame(frame))
+  strip.show()
@@ -0,0 +1,127 @@
+"""
+Opt-in render profiling
+A RenderProfiler passed to renderer.render_frame records how long each scene,
+each layer and each image/dimension type took and how often it ran. When no
+profiler is passed, the render path only pays for an `is None` check per layer.
+The render process profiles the frames it actually shows on request (see
+RenderDaemon.profile); render workers send their timings back to it to be
+merged, and it reports a SceneProfile per scene.
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Tuple
+from renderplan import ColorPlan, GradientPlan, AnimationPlan, StaticDimensionPlan
+
+
+@dataclass
+class Timing:
+  calls: int = 0
+  seconds: float = 0.0
+
+  @property
+  def mean_seconds(self) -> float:
+    return self.seconds / self.calls if self.calls else 0.0
+
+
+"""
+Where the time of a scene's profiled frames went
+"""
+@dataclass
+class SceneProfile:
+  scene_id: int
+  # LEDs the scene was rendered for
+  pixels: int
+  total: Timing
+  # (layer ID, timing) in the scene's layer order; layers behind an opaque one
+  # are never rendered
+  layers: List[Tuple[int, Timing]]
+  # Image or dimension type name -> timing
+  types: Dict[str, Timing]
+
+
+def image_type_name(image) -> str:
+  if isinstance(image, ColorPlan):
+    return 'Color'
+  if isinstance(image, GradientPlan):
+    return 'Gradient'
+  if isinstance(image, AnimationPlan):
+    return 'ColorAnimation'
+  return type(image).__name__
+
+
+def dimension_type_name(dimension) -> str:
+  if isinstance(dimension, StaticDimensionPlan):
+    return 'StaticDimension'
+  if isinstance(dimension, AnimationPlan):
+    return 'DimensionAnimation'
+  return type(dimension).__name__
+
+
+class RenderProfiler:
+  def __init__(self) -> None:
+    self._lock = Lock()
+    # Scene ID -> timing of whole frames
+    self.scenes: Dict[int, Timing] = defaultdict(Timing)
+    # (scene ID, layer ID) -> timing of the layer, including its image and dimensions
+    self.layers: Dict[Tuple[int, int], Timing] = defaultdict(Timing)
+    # (scene ID, image or dimension type name) -> timing of evaluating that type
+    self.types: Dict[Tuple[int, str], Timing] = defaultdict(Timing)
+
+  @staticmethod
+  def _add(timing: Timing, seconds: float) -> None:
+    timing.calls += 1
+    timing.seconds += seconds
+
+  def record_scene(self, scene_id: int, seconds: float) -> None:
+    with self._lock:
+      self._add(self.scenes[scene_id], seconds)
+
+  def record_layer(self, scene_id: int, layer_id: int, seconds: float) -> None:
+    with self._lock:
+      self._add(self.layers[(scene_id, layer_id)], seconds)
+
+  def record_type(self, scene_id: int, type_name: str, seconds: float) -> None:
+    with self._lock:
+      self._add(self.types[(scene_id, type_name)], seconds)
+
+  """
+  Breakdown for one scene:
+  (frame timing, {layer ID: timing}, {type name: timing})
+  """
+  def profile(self, scene_id: int):
+    with self._lock:
+      return (
+        Timing(**vars(self.scenes[scene_id])) if scene_id in self.scenes else Timing(),
+        {layer_id: Timing(**vars(timing)) for (scene, layer_id), timing in self.layers.items() if scene == scene_id},
+        {name: Timing(**vars(timing)) for (scene, name), timing in self.types.items() if scene == scene_id},
+      )
+
+  """
+  Copy of everything recorded, which can be pickled (e.g. by a render worker)
+  and added to another profiler with merge()
+  """
+  def timings(self) -> tuple:
+    with self._lock:
+      return tuple({key: Timing(**vars(timing)) for key, timing in timings.items()}
+                   for timings in (self.scenes, self.layers, self.types))
+
+  def merge(self, timings: tuple) -> None:
+    with self._lock:
+      for own, other in zip((self.scenes, self.layers, self.types), timings):
+        for key, timing in other.items():
+          own[key].calls += timing.calls
+          own[key].seconds += timing.seconds
+
+  """
+  Breakdown for the scene of a plan rendered for a number of pixels
+  """
+  def scene_profile(self, plan, pixels: int) -> SceneProfile:
+    total, layers, types = self.profile(plan.id)
+    return SceneProfile(plan.id, pixels, total, [(layer.id, layers.get(layer.id, Timing())) for layer in plan.layers], types)
+
+  def reset(self) -> None:
+    with self._lock:
+      self.scenes.clear()
+      self.layers.clear()
+      self.types.clear()
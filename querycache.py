@@ -0,0 +1,116 @@
+"""
+Parsed document cache and persisted queries
+The frontend sends the same few documents over and over, and parsing and
+validating them against the schema costs more than running most of them.
+DocumentCache is a GraphQL backend that keeps the most recently used documents
+parsed and validated, by the SHA-256 hash of their text.
+The hash is also the one of Apollo's automatic persisted queries (the
+`persisting` option of vue-apollo): the client sends only the hash of a
+document it sent before, and the full document again if the server answers
+PersistedQueryNotFound. PersistedQueryView resolves these hashes through the
+cache, so a document is persisted for as long as it stays in it.
+"""
+from collections import OrderedDict
+from functools import partial
+from hashlib import sha256
+import json
+from threading import Lock
+from typing import Optional
+from flask import request
+from flask_graphql import GraphQLView
+from graphql import parse
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.validation import validate
+from graphql_server import HttpQueryError
+
+
+def document_hash(document_string: str) -> str:
+  return sha256(document_string.encode('utf-8')).hexdigest()
+
+
+def _invalid(errors, *args, **kwargs) -> ExecutionResult:
+  return ExecutionResult(errors=errors, invalid=True)
+
+
+class DocumentCache(GraphQLBackend):
+  def __init__(self, size: int = 256) -> None:
+    self.size = size
+    # Hash -> document, least recently used first
+    self._documents: OrderedDict = OrderedDict()
+    self._lock = Lock()
+
+  def _get(self, key: str) -> Optional[GraphQLDocument]:
+    with self._lock:
+      document = self._documents.get(key)
+      if document is not None:
+        self._documents.move_to_end(key)
+      return document
+
+  """
+  The document with a given text, parsed and validated the first time it's
+  seen; documents that don't validate execute to their validation errors
+  """
+  def document_from_string(self, schema, document_string: str) -> GraphQLDocument:
+    key = document_hash(document_string)
+    document = self._get(key)
+    if document is not None and document.schema is schema:
+      return document
+    # Syntax errors are raised, and not cached
+    document_ast = parse(document_string)
+    errors = validate(schema, document_ast)
+    run = partial(_invalid, errors) if errors else partial(execute, schema, document_ast)
+    document = GraphQLDocument(schema=schema, document_string=document_string, document_ast=document_ast, execute=run)
+    with self._lock:
+      self._documents[key] = document
+      self._documents.move_to_end(key)
+      while len(self._documents) > self.size:
+        self._documents.popitem(last=False)
+    return document
+
+  """
+  Text of the cached document with a given hash, if it's still cached
+  """
+  def query_for_hash(self, key: str) -> Optional[str]:
+    document = self._get(key)
+    return document.document_string if document is not None else None
+
+
+class PersistedQueryView(GraphQLView):
+  """
+  backend must be a DocumentCache, or have its query_for_hash (like a
+  ResponseCache around one)
+  """
+  def parse_body(self):
+    if request.method.lower() == 'get':
+      # Apollo can send hashed queries as GET requests, with the parameters
+      # in the query string
+      data = dict(request.args.items())
+    else:
+      data = super().parse_body()
+    if isinstance(data, list):
+      return [self.resolve_persisted_query(entry) for entry in data]
+    return self.resolve_persisted_query(data)
+
+  def resolve_persisted_query(self, data):
+    extensions = data.get('extensions') or {}
+    if isinstance(extensions, str):
+      try:
+        extensions = json.loads(extensions)
+      except ValueError:
+        raise HttpQueryError(400, 'Extensions are invalid JSON.')
+    persisted = extensions.get('persistedQuery')
+    if not persisted:
+      return data
+    key = persisted.get('sha256Hash')
+    query = data.get('query')
+    if query:
+      # Executing the document caches it under its hash
+      if document_hash(query) != key:
+        raise HttpQueryError(400, 'provided sha does not match query')
+      return data
+    query = self.get_backend().query_for_hash(key)
+    if query is None:
+      # The client sends the whole document again on this one
+      raise HttpQueryError(200, 'PersistedQueryNotFound')
+    return dict(data, query=query)
@@ -0,0 +1,431 @@
+"""
+Long-running render service
+Renders every device's scene at a fixed target frame rate on a monotonic
+schedule. Each frame has a deadline one period after it starts; frames that
+finish after their deadline are counted as late, and frame slots that have
+already passed when the previous frame finishes are dropped rather than queued,
+so a slow frame never makes the following ones pile up.
+With processes > 0, devices are rendered in parallel by a RenderPool.
+Scenes without animations are only rendered again after a change to their
+plan, and strips are only shown when their frame actually changed.
+With a clip directory, animated scenes are baked into clips in the background
+and then played back from them instead of being rendered.
+Committed changes passed to notify() are applied before the next frame by
+patching the affected scene plans rather than reloading everything.
+On request, the frames the loop shows are profiled as they are rendered (or
+played back) and the breakdown is handed back per scene (see profile()).
+"""
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from time import monotonic, perf_counter, time
+from typing import Callable, Dict, Optional, Tuple
+import numpy as np
+from clips import CLIP_SUFFIX, Clip, bake_clip, clip_key, clip_path, open_clip
+from controller import Device
+from output import PixelStrip, ws, pack_frame, show_frame, write_frame
+from profiler import RenderProfiler
+from renderer import CHANNELS, OPACITY, GradientLUTCache, gradient_luts, render_frame
+from renderplan import ScenePlan, load_scene_plan, patch_scene_plan
+from renderpool import RenderPool
+
+logger = logging.getLogger(__name__)
+
+# GPIO pins driven by the second PWM channel
+PWM1_PINS = (13, 19, 41, 45, 53)
+
+
+@dataclass
+class FrameStats:
+  rendered: int = 0
+  dropped: int = 0
+  late: int = 0
+  # Device frames whose show() was skipped because nothing changed
+  unchanged: int = 0
+
+
+"""
+Everything needed to render one device, detached from the session
+"""
+@dataclass
+class DeviceOutput:
+  device_id: int
+  led_count: int
+  strip: object
+  plan: Optional[ScenePlan] = None
+  # Wiring the strip was opened with, to tell when it has to be reopened
+  wiring: tuple = field(default=())
+  # Last packed frame shown on the strip
+  shown: Optional[np.ndarray] = None
+  # Whether the plan changed since the strip was last shown
+  dirty: bool = True
+  # Rendered static layers of the current plan, by layer ID
+  static_layers: dict = field(default_factory=dict)
+  # Baked clip of the current plan, played instead of rendering
+  clip: Optional[Clip] = None
+  # (clip key, bake in progress) for the current plan
+  baking: Optional[Tuple[bytes, Future]] = None
+
+  @property
+  def is_static(self) -> bool:
+    return self.plan is None or self.plan.is_static
+
+
+"""
+Opens the rpi_ws281x strip for a Device row
+"""
+def open_strip(device: Device):
+  if PixelStrip is None:
+    raise RuntimeError('rpi_ws281x is not installed')
+  channel = 1 if device.gpio_pin in PWM1_PINS else 0
+  strip = PixelStrip(device.led_count, device.gpio_pin, channel=channel,
+                     strip_type=device.led_strip if device.led_strip is not None else ws.SK6812W_STRIP)
+  strip.begin()
+  return strip
+
+
+def blank_frame(n_pixels: int) -> np.ndarray:
+  frame = np.zeros((n_pixels, CHANNELS))
+  frame[:, OPACITY] = 1.0
+  return frame
+
+
+class RenderDaemon:
+  def __init__(self, session_factory: Callable, fps: float = 60.0, open_strip: Callable = open_strip, luts: Optional[GradientLUTCache] = gradient_luts, processes: int = 0, clip_dir: Optional[str] = None) -> None:
+    self.session_factory = session_factory
+    self.fps = fps
+    self.open_strip = open_strip
+    self.luts = luts
+    self.processes = processes
+    self.clip_dir = clip_dir
+    self.pool: Optional[RenderPool] = None
+    self._baker: Optional[ThreadPoolExecutor] = None
+    self.stats = FrameStats()
+    self.outputs: Dict[int, DeviceOutput] = {}
+    self._reload = Event()
+    self._stopped = Event()
+    # Batches of committed change events waiting to be applied
+    self._changes = deque()
+    # Set by reload() and stop() to wake an idle render loop
+    self._wake = Event()
+    self._stats_lock = Lock()
+    # (frames, callback) of the profile to run once the current one is done
+    self._profile_request: Optional[Tuple[int, Callable]] = None
+    # [profiler, frames left, callback] of the profile running
+    self._profiling: Optional[list] = None
+
+  @property
+  def period(self) -> float:
+    return 1.0 / self.fps
+
+  """
+  Reads every Device row and compiles each device's scene
+  Strips are only reopened when a device's wiring changes, and render workers
+  are only sent plans that actually changed
+  """
+  def load(self) -> None:
+    if self.processes and self.pool is None:
+      self.pool = RenderPool(self.processes)
+    session = self.session_factory()
+    try:
+      outputs = {}
+      for device in session.query(Device).all():
+        wiring = (device.led_count, device.gpio_pin, device.led_strip)
+        output = self.outputs.get(device.id)
+        if output is None or output.wiring != wiring:
+          output = DeviceOutput(device.id, device.led_count, self.open_strip(device), wiring=wiring)
+          changed = True
+        else:
+          changed = False
+        try:
+          plan = load_scene_plan(session, device.scene_id) if device.scene_id is not None else None
+        except Exception:
+          # Keep showing what the device showed before rather than stopping
+          # every device
+          logger.exception('Could not load scene %s of device %s', device.scene_id, device.id)
+          session.rollback()
+          plan = output.plan
+        if changed or plan != output.plan:
+          self._set_plan(output, plan)
+        outputs[device.id] = output
+    finally:
+      session.close()
+    if self.clip_dir is not None:
+      self._prune_clips(outputs.values())
+    # Turn off strips whose device is gone
+    for device_id, output in self.outputs.items():
+      if device_id not in outputs:
+        if self.pool is not None:
+          self.pool.remove(device_id)
+        show_frame(output.strip, blank_frame(output.led_count))
+    self.outputs = outputs
+
+  def _set_plan(self, output: DeviceOutput, plan: Optional[ScenePlan]) -> None:
+    output.plan = plan
+    output.dirty = True
+    # Renders of layers that are still in the plan stay valid
+    layer_ids = {layer.id for layer in plan.layers} if plan is not None else set()
+    output.static_layers = {layer_id: cached for layer_id, cached in output.static_layers.items() if layer_id in layer_ids}
+    output.clip = None
+    output.baking = None
+    if self.pool is not None:
+      self.pool.assign(output.device_id, output.led_count, plan)
+    if self.clip_dir is not None and not output.is_static:
+      self._find_clip(output)
+
+  """
+  Brings the outputs up to date with one commit's change events
+  Changes to devices reload everything; changes inside scenes patch the plans
+  of the devices that show them, and only scenes whose structure changed are
+  compiled again
+  """
+  def apply_changes(self, changes) -> None:
+    if any(change.entity == 'Device' for change in changes):
+      self.load()
+      return
+    scene_ids = set()
+    for change in changes:
+      scene_ids |= change.scene_ids
+    plans = {}
+    session = self.session_factory()
+    try:
+      for output in self.outputs.values():
+        if output.plan is None or output.plan.id not in scene_ids:
+          continue
+        scene_id = output.plan.id
+        if scene_id not in plans:
+          try:
+            plan = patch_scene_plan(session, output.plan, changes)
+            plans[scene_id] = plan if plan is not None else load_scene_plan(session, scene_id)
+          except Exception:
+            logger.exception('Could not update scene %s, keeping its last plan', scene_id)
+            session.rollback()
+            plans[scene_id] = output.plan
+        if plans[scene_id] is not output.plan:
+          self._set_plan(output, plans[scene_id])
+    finally:
+      session.close()
+    if self.clip_dir is not None:
+      self._prune_clips(self.outputs.values())
+
+  """
+  Hands the render loop a tuple of committed change events (see events.commits)
+  Safe to call from any thread
+  """
+  def notify(self, changes) -> None:
+    self._changes.append(changes)
+    self._wake.set()
+
+  """
+  Plays an existing clip of the output's plan or starts baking one
+  """
+  def _find_clip(self, output: DeviceOutput) -> None:
+    key = clip_key(output.plan, output.led_count, self.fps)
+    output.clip = open_clip(clip_path(self.clip_dir, key), key)
+    if output.clip is None:
+      if self._baker is None:
+        os.makedirs(self.clip_dir, exist_ok=True)
+        self._baker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='clip-baker')
+      output.baking = (key, self._baker.submit(self._bake, output, output.plan, key))
+
+  def _bake(self, output: DeviceOutput, plan: ScenePlan, key: bytes) -> Optional[Clip]:
+    # Skip bakes that a newer change has already made pointless
+    if output.baking is None or output.baking[0] != key:
+      return None
+    path = clip_path(self.clip_dir, key)
+    if bake_clip(plan, output.led_count, self.fps, path):
+      return open_clip(path, key)
+    return None
+
+  """
+  Deletes clips that no device's current plan uses any more
+  """
+  def _prune_clips(self, outputs) -> None:
+    keep = set()
+    for output in outputs:
+      if output.clip is not None:
+        keep.add(clip_path(self.clip_dir, output.clip.key))
+      if output.baking is not None:
+        keep.add(clip_path(self.clip_dir, output.baking[0]))
+    if not os.path.isdir(self.clip_dir):
+      return
+    for name in os.listdir(self.clip_dir):
+      path = os.path.join(self.clip_dir, name)
+      if name.endswith(CLIP_SUFFIX) and path not in keep:
+        os.remove(path)
+
+  # Switches outputs whose bake has finished over to their clip
+  def _collect_clips(self) -> None:
+    for output in self.outputs.values():
+      if output.baking is not None and output.baking[1].done():
+        future = output.baking[1]
+        output.baking = None
+        if future.exception() is None:
+          output.clip = future.result()
+
+  """
+  Asks the render loop to reload devices and scenes before its next frame
+  Safe to call from any thread
+  """
+  def reload(self) -> None:
+    self._reload.set()
+    self._wake.set()
+
+  """
+  Profiles the next frames the loop shows, static scenes included, and calls
+  callback with a profiler.SceneProfile per scene ID shown on a device
+  Safe to call from any thread; a request made while a profile is running
+  replaces any earlier one still waiting for it
+  """
+  def profile(self, frames: int, callback: Callable) -> None:
+    self._profile_request = (frames, callback)
+    self._wake.set()
+
+  def _profiler(self) -> Optional[RenderProfiler]:
+    if self._profiling is None and self._profile_request is not None:
+      (frames, callback), self._profile_request = self._profile_request, None
+      self._profiling = [RenderProfiler(), frames, callback]
+    return self._profiling[0] if self._profiling is not None else None
+
+  def _profiled(self) -> None:
+    self._profiling[1] -= 1
+    if self._profiling[1] > 0:
+      return
+    profiler, _, callback = self._profiling
+    self._profiling = None
+    callback({output.plan.id: profiler.scene_profile(output.plan, output.led_count)
+              for output in self.outputs.values() if output.plan is not None})
+
+  def stop(self) -> None:
+    self._stopped.set()
+    self._wake.set()
+
+  # Nothing animates, every strip already shows its latest frame and no profile
+  # is waiting for frames
+  @property
+  def idle(self) -> bool:
+    return (self._profiling is None and self._profile_request is None and
+            all(output.is_static and not output.dirty for output in self.outputs.values()))
+
+  """
+  Renders one frame on every device that needs it and shows the ones that changed
+  Static scenes are skipped once they have been shown, and scenes with a baked
+  clip are read from it
+  """
+  def render(self, t: float) -> None:
+    self._collect_clips()
+    profiler = self._profiler()
+    # Profiled frames render every device, to time static scenes too
+    pending = [output for output in self.outputs.values() if profiler is not None or output.dirty or not output.is_static]
+    if pending:
+      self._render(pending, t, profiler)
+    if profiler is not None:
+      self._profiled()
+
+  def _render(self, pending: list, t: float, profiler: Optional[RenderProfiler]) -> None:
+    frames = {}
+    for output in pending:
+      if output.clip is not None:
+        started = perf_counter()
+        frames[output.device_id] = output.clip.frame(t)
+        if profiler is not None:
+          # Played back rather than rendered, so there are no layers to time
+          profiler.record_scene(output.plan.id, perf_counter() - started)
+    live = [output for output in pending if output.clip is None]
+    if self.pool is not None:
+      if live:
+        frames.update(self.pool.render(t, [output.device_id for output in live], profiler))
+    else:
+      for output in live:
+        try:
+          if output.plan is None:
+            frame = blank_frame(output.led_count)
+          else:
+            frame = render_frame(output.plan, output.led_count, t, self.luts, profiler, static_layers=output.static_layers)
+        except Exception:
+          # Blank the device until its scene changes, and go on with the others
+          logger.exception('Rendering device %s failed, blanking it', output.device_id)
+          output.plan = None
+          frame = blank_frame(output.led_count)
+        frames[output.device_id] = pack_frame(frame)
+    unchanged = 0
+    for output in pending:
+      packed = frames[output.device_id]
+      output.dirty = False
+      if output.shown is not None and np.array_equal(packed, output.shown):
+        unchanged += 1
+        continue
+      write_frame(output.strip, packed)
+      output.strip.show()
+      output.shown = packed.copy()
+    with self._stats_lock:
+      self.stats.unchanged += unchanged
+
+  """
+  Snapshot of the frame counters
+  """
+  def frame_stats(self) -> FrameStats:
+    with self._stats_lock:
+      return FrameStats(self.stats.rendered, self.stats.dropped, self.stats.late, self.stats.unchanged)
+
+  """
+  Runs the render loop until stop() is called
+  """
+  def run(self) -> None:
+    try:
+      self._run()
+    finally:
+      if self.pool is not None:
+        self.pool.close()
+        self.pool = None
+      if self._baker is not None:
+        self._baker.shutdown(wait=False)
+        self._baker = None
+
+  # Errors that get past the per-device handling (e.g. the database being
+  # unavailable) are logged, and the loop carries on with what it has
+  def _step(self, step: Callable, *args) -> None:
+    try:
+      step(*args)
+    except Exception:
+      logger.exception('Render loop step %s failed', step.__name__)
+
+  def _run(self) -> None:
+    self._step(self.load)
+    period = self.period
+    start = monotonic()
+    frame = 0
+    woken = False
+    while not self._stopped.is_set():
+      if self._reload.is_set():
+        self._reload.clear()
+        self._changes.clear()
+        self._step(self.load)
+      while self._changes:
+        self._step(self.apply_changes, self._changes.popleft())
+      if self.idle:
+        # Sleep until something changes
+        self._wake.wait()
+        self._wake.clear()
+        woken = True
+        continue
+      if woken:
+        # Start a fresh schedule so the idle time isn't counted as dropped frames
+        woken = False
+        start = monotonic()
+        frame = 0
+      self._step(self.render, time())
+      finished = monotonic()
+      deadline = start + (frame + 1) * period
+      # Next frame slot that hasn't started yet; any slots in between are dropped
+      next_frame = max(frame + 1, int((finished - start) // period) + 1)
+      with self._stats_lock:
+        self.stats.rendered += 1
+        if finished > deadline:
+          self.stats.late += 1
+        self.stats.dropped += next_frame - frame - 1
+      frame = next_frame
+      self._stopped.wait(max(0.0, start + frame * period - monotonic()))
@@ -0,0 +1,247 @@
+"""
+Vectorized renderer for compiled scene plans.
+Every layer is evaluated over all pixel positions at once with NumPy instead of
+once per LED, which is what makes full frame rates possible on a Pi.
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import perf_counter
+from typing import Optional, Tuple
+import numpy as np
+from controller import blend_many
+from profiler import RenderProfiler, image_type_name, dimension_type_name
+from renderplan import ScenePlan, LayerPlan, ImagePlan, ColorPlan, GradientPlan, AnimationPlan, KeyframesPlan
+
+# Number of channels in a rendered frame (red, green, blue, white, opacity)
+CHANNELS = 5
+OPACITY = 4
+
+
+"""
+Positions of the centres of n evenly spaced pixels, in the 0-1 space of a scene
+"""
+def pixel_positions(n_pixels: int) -> np.ndarray:
+  return (np.arange(n_pixels, dtype=np.float64) + 0.5) / n_pixels
+
+
+"""
+Interpolates keyframes at every position in one searchsorted-plus-lerp pass
+"""
+def interpolate(keyframes: KeyframesPlan, positions: np.ndarray) -> np.ndarray:
+  return blend_many(positions, keyframes.position_array, keyframes.value_array)
+
+
+"""
+Bounded LRU cache of precomputed gradient lookup tables, keyed by gradient ID
+A static gradient renders the same colours every frame, so instead of blending
+its colour stops per pixel per frame, it is sampled once into a table of
+`resolution` entries and rendering just indexes into it.
+A table is rebuilt when the gradient is rendered from a plan with different
+colour stops than the ones it was built from, so the render process's tables
+follow the plans it patches from committed changes without being told.
+"""
+class GradientLUTCache:
+  def __init__(self, resolution: int = 1024, max_entries: int = 64) -> None:
+    self.resolution = resolution
+    self.max_entries = max_entries
+    # Gradient ID -> (colour stops the table was built from, table)
+    self._tables = OrderedDict()
+    self._lock = Lock()
+
+  def lookup(self, gradient: GradientPlan) -> np.ndarray:
+    with self._lock:
+      entry = self._tables.get(gradient.id)
+      if entry is not None and (entry[0] is gradient.colorstops or entry[0] == gradient.colorstops):
+        self._tables.move_to_end(gradient.id)
+        return entry[1]
+    table = blend_many(np.linspace(0.0, 1.0, self.resolution),
+                       gradient.colorstops.position_array, gradient.colorstops.value_array)
+    with self._lock:
+      self._tables[gradient.id] = (gradient.colorstops, table)
+      self._tables.move_to_end(gradient.id)
+      while len(self._tables) > self.max_entries:
+        self._tables.popitem(last=False)
+    return table
+
+  # Samples the nearest table entry for each 0-1 position
+  def sample(self, gradient: GradientPlan, positions: np.ndarray) -> np.ndarray:
+    table = self.lookup(gradient)
+    indices = np.rint(np.clip(positions, 0.0, 1.0) * (self.resolution - 1)).astype(np.intp)
+    return table[indices]
+
+  def invalidate(self, gradient_id: int) -> None:
+    with self._lock:
+      self._tables.pop(gradient_id, None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._tables.clear()
+
+  def __len__(self) -> int:
+    return len(self._tables)
+
+
+# Shared by whatever renders in this process; a table is rebuilt once its
+# gradient's plan has different colour stops
+gradient_luts = GradientLUTCache()
+
+
+"""
+Colours of an image at the given 0-1 positions within it, as an (n, 5) array
+Gradients are sampled from luts when a cache is given
+"""
+def render_image(image: ImagePlan, positions: np.ndarray, t: float, luts: Optional[GradientLUTCache] = None) -> np.ndarray:
+  if isinstance(image, GradientPlan):
+    if luts is not None:
+      return luts.sample(image, positions)
+    return interpolate(image.colorstops, positions)
+  if isinstance(image, ColorPlan):
+    color = image.color
+  elif isinstance(image, AnimationPlan):
+    color = image.currentValue(t)
+  else:
+    raise ValueError('Unsupported image plan: {}'.format(type(image).__name__))
+  return np.broadcast_to(np.array(color, dtype=np.float64), (len(positions), CHANNELS))
+
+
+"""
+Calls function, recording how long it took against a type name
+"""
+def _profiled(profiler: RenderProfiler, scene_id: int, type_name: str, function, *args):
+  started = perf_counter()
+  try:
+    return function(*args)
+  finally:
+    profiler.record_type(scene_id, type_name, perf_counter() - started)
+
+
+"""
+Current size and left offset of a layer, timed by type when a profiler is given
+"""
+def layer_dimensions(layer: LayerPlan, t: float, profiler: Optional[RenderProfiler] = None, scene_id: Optional[int] = None) -> Tuple[float, float]:
+  if profiler is None:
+    return layer.size.currentValue(t), layer.left.currentValue(t)
+  return (_profiled(profiler, scene_id, dimension_type_name(layer.size), layer.size.currentValue, t),
+          _profiled(profiler, scene_id, dimension_type_name(layer.left), layer.left.currentValue, t))
+
+
+"""
+Index range [start, stop) of the sorted pixel positions that a layer covers
+A layer covers every position where (pos - left) / size <= repeat, which is a
+prefix of the pixels for a positive size and a suffix for a negative one, so the
+range is found by binary search instead of by testing every pixel.
+A layer with zero size covers nothing.
+"""
+def layer_span(positions: np.ndarray, size: float, left: float, repeat: float) -> Tuple[int, int]:
+  n = len(positions)
+  if size == 0 or n == 0:
+    return 0, 0
+  covers = lambda i: (positions[i] - left) / size <= repeat
+  edge = int(np.searchsorted(positions, left + repeat * size, side='right' if size > 0 else 'left'))
+  # Settle rounding at the edge against the exact test
+  if size > 0:
+    while edge < n and covers(edge):
+      edge += 1
+    while edge > 0 and not covers(edge - 1):
+      edge -= 1
+    return 0, edge
+  while edge > 0 and covers(edge - 1):
+    edge -= 1
+  while edge < n and not covers(edge):
+    edge += 1
+  return edge, n
+
+
+"""
+Colours of a layer's image at the given pixel positions, which must be covered
+by the layer
+"""
+def render_covered(layer: LayerPlan, positions: np.ndarray, size: float, left: float, t: float, luts: Optional[GradientLUTCache] = None, profiler: Optional[RenderProfiler] = None, scene_id: Optional[int] = None) -> np.ndarray:
+  local = ((positions - left) % size) / size
+  if profiler is None:
+    return render_image(layer.image, local, t, luts)
+  return _profiled(profiler, scene_id, image_type_name(layer.image), render_image, layer.image, local, t, luts)
+
+
+"""
+Renders one layer over all pixel positions
+Pixels outside the layer's span are transparent black
+When a profiler is given, the dimensions and the image are timed by type
+"""
+def render_layer(layer: LayerPlan, positions: np.ndarray, t: float, luts: Optional[GradientLUTCache] = None, profiler: Optional[RenderProfiler] = None, scene_id: Optional[int] = None) -> np.ndarray:
+  size, left = layer_dimensions(layer, t, profiler, scene_id)
+  start, stop = layer_span(positions, size, left, layer.repeat)
+  result = np.zeros((len(positions), CHANNELS))
+  if start < stop:
+    result[start:stop] = render_covered(layer, positions[start:stop], size, left, t, luts, profiler, scene_id)
+  return result
+
+
+"""
+Renders a whole frame of a scene plan at time t
+Returns an (n_pixels, 5) array of premultiplied RGBWA values, composited over
+an opaque black background
+Layers are composited front to back: each layer only touches the pixels in its
+span that are not yet hidden by an opaque layer above it, and rendering stops
+as soon as every pixel is opaque, so the cost follows the visible covered
+pixels rather than layers x pixels.
+Gradients are sampled from precomputed lookup tables when luts is given, and
+timings are recorded per scene, layer and type when a profiler is given.
+When static_layers is given, the span and colours of layers without animations
+are only rendered once and kept there (by layer ID) for the following frames.
+"""
+def render_frame(plan: ScenePlan, n_pixels: int, t: float, luts: Optional[GradientLUTCache] = None, profiler: Optional[RenderProfiler] = None, static_layers: Optional[dict] = None) -> np.ndarray:
+  if profiler is not None:
+    frame_started = perf_counter()
+  positions = pixel_positions(n_pixels)
+  result = np.zeros((n_pixels, CHANNELS))
+  # How much of whatever lies below still shows through each pixel
+  transmittance = np.ones(n_pixels)
+  visible = n_pixels
+  for layer in reversed(plan.layers):
+    if visible == 0:
+      break
+    if profiler is not None:
+      started = perf_counter()
+    cached = None
+    if static_layers is not None and layer.is_static:
+      cached = static_layers.get(layer.id)
+      if cached is not None and cached[0] is not layer and cached[0] == layer:
+        # Same layer in a patched (or unpickled) plan
+        cached = static_layers[layer.id] = (layer,) + cached[1:]
+      # Only reuse a layer rendered from this very plan at this size
+      if cached is None or cached[0] is not layer or cached[1] != n_pixels:
+        size, left = layer_dimensions(layer, t, profiler, plan.id)
+        start, stop = layer_span(positions, size, left, layer.repeat)
+        colors = render_covered(layer, positions[start:stop], size, left, t, luts, profiler, plan.id)
+        cached = static_layers[layer.id] = (layer, n_pixels, start, stop, colors)
+      _, _, start, stop, colors = cached
+    else:
+      size, left = layer_dimensions(layer, t, profiler, plan.id)
+      start, stop = layer_span(positions, size, left, layer.repeat)
+    if start < stop:
+      window = transmittance[start:stop]
+      shown = window != 0.0
+      if shown.all():
+        if cached is None:
+          colors = render_covered(layer, positions[start:stop], size, left, t, luts, profiler, plan.id)
+        # Premultiplied "over", seen from above
+        result[start:stop] += window[:, None] * colors
+        window *= 1.0 - colors[:, OPACITY]
+        visible -= int(np.count_nonzero(window == 0.0))
+      elif shown.any():
+        pixels = np.flatnonzero(shown) + start
+        if cached is None:
+          colors = render_covered(layer, positions[pixels], size, left, t, luts, profiler, plan.id)
+        else:
+          colors = colors[pixels - start]
+        result[pixels] += transmittance[pixels, None] * colors
+        transmittance[pixels] *= 1.0 - colors[:, OPACITY]
+        visible -= int(np.count_nonzero(transmittance[pixels] == 0.0))
+    if profiler is not None:
+      profiler.record_layer(plan.id, layer.id, perf_counter() - started)
+  # Whatever still shows through lands on the opaque black background
+  result[:, OPACITY] += transmittance
+  if profiler is not None:
+    profiler.record_scene(plan.id, perf_counter() - frame_started)
+  return result
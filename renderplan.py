@@ -0,0 +1,534 @@
+"""
+Render plans are detached, immutable snapshots of a scene.
+A plan is compiled once from the ORM objects and then rendered without touching
+the database, so the render loop never needs a session and never pays for
+attribute instrumentation, lazy loads or polymorphic lookups.
+"""
+from __future__ import annotations
+from bisect import bisect
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import Optional, Tuple, Union
+import numpy as np
+from sqlalchemy.orm import selectinload, with_polymorphic
+from controller import Scene, Layer, Image, Color, Gradient, ColorAnimation, ColorStop, ColorKeyframe, Dimension, StaticDimension, DimensionAnimation, DimensionKeyframe, Sensor, Clock
+from events import CREATED, UPDATED, DELETED
+
+# RGBWA tuple, in the same premultiplied space as the Color model
+RGBWA = Tuple[float, float, float, float, float]
+
+TRANSPARENT: RGBWA = (0.0, 0.0, 0.0, 0.0, 0.0)
+BLACK: RGBWA = (0.0, 0.0, 0.0, 0.0, 1.0)
+
+
+@dataclass(frozen=True)
+class ClockPlan:
+  id: int
+  start: float
+  duration: float
+
+  def currentValue(self, t: float) -> float:
+    return (t - self.start) / self.duration
+
+
+"""
+Keyframe positions and values packed side by side, sorted by position
+(used for colour stops as well as animation keyframes)
+"""
+@dataclass(frozen=True)
+class KeyframesPlan:
+  # IDs of the keyframes or colour stops, to patch them in place
+  ids: Tuple[int, ...]
+  positions: Tuple[float, ...]
+  values: Tuple[Union[float, RGBWA], ...]
+
+  # Same semantics as controller.blend
+  def blend(self, position: float):
+    positions = self.positions
+    if position < positions[0]:
+      return self.values[0]
+    if position >= positions[-1]:
+      return self.values[-1]
+    i = bisect(positions, position)
+    distance = (position - positions[i - 1]) / (positions[i] - positions[i - 1])
+    before, after = self.values[i - 1], self.values[i]
+    if isinstance(before, tuple):
+      return tuple((1 - distance) * b + distance * a for b, a in zip(before, after))
+    return (1 - distance) * before + distance * after
+
+  # The same keyframes as arrays, for the vectorized renderer
+  @cached_property
+  def position_array(self) -> np.ndarray:
+    return np.array(self.positions, dtype=np.float64)
+
+  # Shape (n,) for dimension values or (n, 5) for RGBWA values
+  @cached_property
+  def value_array(self) -> np.ndarray:
+    return np.array(self.values, dtype=np.float64)
+
+
+@dataclass(frozen=True)
+class StaticDimensionPlan:
+  id: int
+  value: float
+
+  def currentValue(self, t: float) -> float:
+    return self.value
+
+
+"""
+Keyframes driven by a sensor, used both for DimensionAnimation (float values)
+and ColorAnimation (RGBWA values)
+"""
+@dataclass(frozen=True)
+class AnimationPlan:
+  id: int
+  sensor: ClockPlan
+  repeat: float
+  keyframes: KeyframesPlan
+
+  def currentValue(self, t: float):
+    pos = self.sensor.currentValue(t)
+    return self.keyframes.blend(pos if pos <= self.repeat else 1.0)
+
+  def getColorAtPosition(self, pos: float, t: float) -> RGBWA:
+    return self.currentValue(t)
+
+
+@dataclass(frozen=True)
+class ColorPlan:
+  id: int
+  color: RGBWA
+
+  def getColorAtPosition(self, pos: float, t: float) -> RGBWA:
+    return self.color
+
+
+@dataclass(frozen=True)
+class GradientPlan:
+  id: int
+  colorstops: KeyframesPlan
+
+  def getColorAtPosition(self, pos: float, t: float) -> RGBWA:
+    return self.colorstops.blend(pos)
+
+
+DimensionPlan = Union[StaticDimensionPlan, AnimationPlan]
+ImagePlan = Union[ColorPlan, GradientPlan, AnimationPlan]
+
+
+@dataclass(frozen=True)
+class LayerPlan:
+  id: int
+  image: ImagePlan
+  size: DimensionPlan
+  left: DimensionPlan
+  repeat: float
+
+  # A layer that no sensor-driven animation reaches renders the same every frame
+  @cached_property
+  def is_static(self) -> bool:
+    return not any(isinstance(part, AnimationPlan) for part in (self.image, self.size, self.left))
+
+  def getColorAtPosition(self, pos: float, t: float) -> RGBWA:
+    size = self.size.currentValue(t)
+    left = self.left.currentValue(t)
+    if (pos - left) / size <= self.repeat:
+      return self.image.getColorAtPosition(((pos - left) % size) / size, t)
+    return TRANSPARENT
+
+
+@dataclass(frozen=True)
+class ScenePlan:
+  id: int
+  name: str
+  layers: Tuple[LayerPlan, ...]
+
+  @cached_property
+  def is_static(self) -> bool:
+    return all(layer.is_static for layer in self.layers)
+
+  # Composited front to back, stopping at the first layer that makes the pixel opaque
+  def getColorAtPosition(self, pos: float, t: float) -> RGBWA:
+    result = TRANSPARENT
+    remaining = 1.0
+    for layer in reversed(self.layers):
+      color = layer.getColorAtPosition(pos, t)
+      result = tuple(r + remaining * c for r, c in zip(result, color))
+      remaining *= 1.0 - color[4]
+      if remaining == 0.0:
+        return result
+    return tuple(r + remaining * b for r, b in zip(result, BLACK))
+
+
+"""
+Loader options that fetch a scene's whole tree, including every polymorphic
+image, dimension and sensor subtype, with one SELECT per relationship level
+instead of one lazy load per object
+"""
+def scene_loader_options():
+  images = with_polymorphic(Image, '*')
+  sensors = with_polymorphic(Sensor, '*')
+  layers = selectinload(Scene.layers)
+  image = layers.selectinload(Layer.image.of_type(images))
+  options = [
+    image.selectinload(images.Gradient.colorstops).selectinload(ColorStop.value),
+    image.selectinload(images.ColorAnimation.keyframes).selectinload(ColorKeyframe.value),
+    image.selectinload(images.ColorAnimation.sensor.of_type(sensors)),
+  ]
+  for relationship in (Layer.size, Layer.left):
+    dimensions = with_polymorphic(Dimension, '*')
+    dimension = layers.selectinload(relationship.of_type(dimensions))
+    options.append(dimension.selectinload(dimensions.DimensionAnimation.keyframes))
+    options.append(dimension.selectinload(dimensions.DimensionAnimation.sensor.of_type(sensors)))
+  return options
+
+
+def compile_color(color: Color) -> RGBWA:
+  # Mirror the defaults applied by Color.__init__
+  return (
+    color.red or 0.0,
+    color.green or 0.0,
+    color.blue or 0.0,
+    color.white if color.white is not None else 0.0,
+    color.opacity if color.opacity is not None else 1.0,
+  )
+
+
+def compile_sensor(sensor: Sensor) -> ClockPlan:
+  if isinstance(sensor, Clock):
+    return ClockPlan(id=sensor.id, start=sensor.start, duration=sensor.duration)
+  raise ValueError('Unsupported sensor type: {}'.format(type(sensor).__name__))
+
+
+def compile_keyframes(keyframes, value=lambda v: v) -> KeyframesPlan:
+  return KeyframesPlan(
+    ids=tuple(keyframe.id for keyframe in keyframes),
+    positions=tuple(keyframe.position for keyframe in keyframes),
+    values=tuple(value(keyframe.value) for keyframe in keyframes),
+  )
+
+
+def compile_animation(animation, value=lambda v: v) -> AnimationPlan:
+  return AnimationPlan(
+    id=animation.id,
+    sensor=compile_sensor(animation.sensor),
+    repeat=animation.repeat if animation.repeat is not None else 1.0,
+    keyframes=compile_keyframes(animation.keyframes, value),
+  )
+
+
+def compile_dimension(dimension: Dimension) -> DimensionPlan:
+  if isinstance(dimension, StaticDimension):
+    return StaticDimensionPlan(id=dimension.id, value=dimension.value)
+  if isinstance(dimension, DimensionAnimation):
+    return compile_animation(dimension)
+  raise ValueError('Unsupported dimension type: {}'.format(type(dimension).__name__))
+
+
+def compile_image(image: Image) -> ImagePlan:
+  if isinstance(image, Color):
+    return ColorPlan(id=image.id, color=compile_color(image))
+  if isinstance(image, Gradient):
+    return GradientPlan(id=image.id, colorstops=compile_keyframes(image.colorstops, compile_color))
+  if isinstance(image, ColorAnimation):
+    return compile_animation(image, compile_color)
+  raise ValueError('Unsupported image type: {}'.format(type(image).__name__))
+
+
+def is_renderable_sensor(sensor: Optional[Sensor]) -> bool:
+  if isinstance(sensor, Clock):
+    return sensor.start is not None and sensor.duration is not None and sensor.duration > 0
+  return False
+
+
+def is_renderable(layer: Layer) -> bool:
+  if layer.image is None or layer.size is None or layer.left is None:
+    return False
+  if isinstance(layer.image, Gradient) and not layer.image.colorstops:
+    return False
+  for part in (layer.image, layer.size, layer.left):
+    if isinstance(part, StaticDimension) and part.value is None:
+      return False
+    if isinstance(part, (ColorAnimation, DimensionAnimation)) and \
+        (not is_renderable_sensor(part.sensor) or not part.keyframes):
+      return False
+  return True
+
+
+"""
+Compiles an already loaded scene into a ScenePlan
+Layers that are still missing an image, a dimension, colour stops or keyframes
+(e.g. while they are being built in the editor) are left out of the plan
+"""
+def compile_scene(scene: Scene) -> ScenePlan:
+  return ScenePlan(
+    id=scene.id,
+    name=scene.name,
+    layers=tuple(
+      LayerPlan(
+        id=layer.id,
+        image=compile_image(layer.image),
+        size=compile_dimension(layer.size),
+        left=compile_dimension(layer.left),
+        repeat=layer.repeat if layer.repeat is not None else 1.0,
+      )
+      for layer in scene.layers if is_renderable(layer)
+    ),
+  )
+
+
+"""
+Loads the scene with the given ID in a fixed number of queries and compiles it
+Returns None if there is no such scene
+"""
+def load_scene_plan(session, scene_id: int) -> Optional[ScenePlan]:
+  scene = session.query(Scene).options(*scene_loader_options()) \
+    .filter(Scene.id == scene_id).one_or_none()
+  if scene is None:
+    return None
+  return compile_scene(scene)
+
+
+
+class Unpatchable(Exception):
+  pass
+
+
+"""
+Keyframes with one keyframe replaced or added (if its ID is new), or removed
+when position is None, kept sorted by position
+"""
+def patch_keyframes(keyframes: KeyframesPlan, id: int, position: Optional[float] = None, value=None) -> KeyframesPlan:
+  entries = [entry for entry in zip(keyframes.ids, keyframes.positions, keyframes.values) if entry[0] != id]
+  if position is not None:
+    entries.append((id, position, value))
+  if not entries:
+    # The layer stops being renderable
+    raise Unpatchable()
+  entries.sort(key=lambda entry: entry[1])
+  ids, positions, values = zip(*entries)
+  return KeyframesPlan(ids=ids, positions=positions, values=values)
+
+
+"""
+Calls patch_part with the given parts ('image', 'size', 'left') of every layer
+patch_part returns the part to use instead, or None to keep it
+Returns the patched plan and whether any part was replaced; layers where
+nothing was replaced stay the very same objects
+"""
+def _patch_parts(plan: ScenePlan, parts, patch_part) -> Tuple[ScenePlan, bool]:
+  found = False
+  layers = []
+  for layer in plan.layers:
+    changes = {}
+    for name in parts:
+      patched = patch_part(getattr(layer, name))
+      if patched is not None:
+        changes[name] = patched
+    if changes:
+      found = True
+      layer = replace(layer, **changes)
+    layers.append(layer)
+  if not found:
+    return plan, False
+  return replace(plan, layers=tuple(layers)), True
+
+
+@dataclass(frozen=True)
+class KeyframeKind:
+  model: type
+  # Foreign key to the image or dimension the keyframe belongs to
+  parent_key: str
+  parent_type: type
+  # Field of the parent plan holding the keyframes
+  field: str
+  parts: Tuple[str, ...]
+  compile_value: object
+
+
+KEYFRAME_KINDS = {
+  'ColorStop': KeyframeKind(ColorStop, 'gradient_id', GradientPlan, 'colorstops', ('image',), compile_color),
+  'ColorKeyframe': KeyframeKind(ColorKeyframe, 'animation_id', AnimationPlan, 'keyframes', ('image',), compile_color),
+  'DimensionKeyframe': KeyframeKind(DimensionKeyframe, 'animation_id', AnimationPlan, 'keyframes', ('size', 'left'), lambda value: value),
+}
+
+
+"""
+Moves a keyframe row into place: it is added to or updated in the keyframes of
+its parent and removed from any other parent's (row None removes it everywhere)
+"""
+def _patch_keyframe_row(plan: ScenePlan, kind: KeyframeKind, id: int, row) -> Tuple[ScenePlan, bool]:
+  parent_id = None
+  if row is not None:
+    if row.value is None:
+      raise Unpatchable()
+    parent_id = getattr(row, kind.parent_key)
+    position, value = row.position, kind.compile_value(row.value)
+
+  def patch_part(part):
+    if not isinstance(part, kind.parent_type):
+      return None
+    keyframes = getattr(part, kind.field)
+    if parent_id is not None and part.id == parent_id:
+      return replace(part, **{kind.field: patch_keyframes(keyframes, id, position, value)})
+    if id in keyframes.ids:
+      return replace(part, **{kind.field: patch_keyframes(keyframes, id)})
+    return None
+  return _patch_parts(plan, kind.parts, patch_part)
+
+
+def _patch_keyframe(session, plan: ScenePlan, change) -> ScenePlan:
+  kind = KEYFRAME_KINDS[change.entity]
+  row = None if change.action == DELETED else _get(session, kind.model, change.id)
+  plan, found = _patch_keyframe_row(plan, kind, change.id, row)
+  if change.action == CREATED and not found:
+    # The first keyframe or stop can make a layer renderable
+    raise Unpatchable()
+  return plan
+
+
+def _patch_scene(session, plan: ScenePlan, row: Scene) -> ScenePlan:
+  return replace(plan, name=row.name)
+
+
+def _patch_layer(session, plan: ScenePlan, row: Layer) -> ScenePlan:
+  repeat = row.repeat if row.repeat is not None else 1.0
+  return replace(plan, layers=tuple(replace(layer, repeat=repeat) if layer.id == row.id else layer
+                                    for layer in plan.layers))
+
+
+# A colour is either the image of a layer or the value of a stop or keyframe
+def _patch_color(session, plan: ScenePlan, row: Color) -> ScenePlan:
+  for kind in (KEYFRAME_KINDS['ColorStop'], KEYFRAME_KINDS['ColorKeyframe']):
+    for owner in session.query(kind.model).filter(kind.model.color_id == row.id):
+      plan, _ = _patch_keyframe_row(plan, kind, owner.id, owner)
+  color = compile_color(row)
+
+  def patch_part(image):
+    if isinstance(image, ColorPlan) and image.id == row.id:
+      return replace(image, color=color)
+    return None
+  return _patch_parts(plan, ('image',), patch_part)[0]
+
+
+def _patch_static_dimension(session, plan: ScenePlan, row: StaticDimension) -> ScenePlan:
+  if row.value is None:
+    # Its layer is left out of the plan now
+    raise Unpatchable()
+
+  def patch_part(dimension):
+    if isinstance(dimension, StaticDimensionPlan) and dimension.id == row.id:
+      return replace(dimension, value=row.value)
+    return None
+  plan, found = _patch_parts(plan, ('size', 'left'), patch_part)
+  if not found:
+    # Its layer may have been left out of the plan until now
+    raise Unpatchable()
+  return plan
+
+
+def _patch_animation(session, plan: ScenePlan, row) -> ScenePlan:
+  repeat = row.repeat if row.repeat is not None else 1.0
+
+  def patch_part(animation):
+    if isinstance(animation, AnimationPlan) and animation.id == row.id:
+      return replace(animation, repeat=repeat)
+    return None
+  parts = ('image',) if isinstance(row, ColorAnimation) else ('size', 'left')
+  return _patch_parts(plan, parts, patch_part)[0]
+
+
+def _patch_clock(session, plan: ScenePlan, row: Clock) -> ScenePlan:
+  if not is_renderable_sensor(row):
+    raise Unpatchable()
+  sensor = compile_sensor(row)
+
+  def patch_part(animation):
+    if isinstance(animation, AnimationPlan) and animation.sensor.id == row.id:
+      return replace(animation, sensor=sensor)
+    return None
+  plan, found = _patch_parts(plan, ('image', 'size', 'left'), patch_part)
+  if not found:
+    raise Unpatchable()
+  return plan
+
+
+def _patch_nothing(session, plan: ScenePlan, row) -> ScenePlan:
+  return plan
+
+
+# Entity -> (model, fields that can be patched in place, patch function)
+# Changes to any other field (e.g. which image a layer shows) need the scene to
+# be compiled again. Changed collections (e.g. a gradient's colour stops) are
+# patched through the events of the rows added to or removed from them.
+UPDATE_PATCHES = {
+  'Scene': (Scene, {'name', 'layers'}, _patch_scene),
+  'Layer': (Layer, {'repeat'}, _patch_layer),
+  'Color': (Color, {'red', 'green', 'blue', 'white', 'opacity'}, _patch_color),
+  'Gradient': (Gradient, {'colorstops'}, _patch_nothing),
+  'StaticDimension': (StaticDimension, {'value'}, _patch_static_dimension),
+  'ColorAnimation': (ColorAnimation, {'repeat', 'keyframes'}, _patch_animation),
+  'DimensionAnimation': (DimensionAnimation, {'repeat', 'keyframes'}, _patch_animation),
+  'Clock': (Clock, {'name', 'start', 'duration'}, _patch_clock),
+}
+
+
+# Whether a deleted image, dimension or sensor is still part of the plan
+def _references(plan: ScenePlan, change) -> bool:
+  for layer in plan.layers:
+    if change.entity in ('Color', 'Gradient', 'ColorAnimation') and layer.image.id == change.id:
+      return True
+    if change.entity in ('StaticDimension', 'DimensionAnimation') and change.id in (layer.size.id, layer.left.id):
+      return True
+    if change.entity == 'Clock' and any(isinstance(part, AnimationPlan) and part.sensor.id == change.id
+                                        for part in (layer.image, layer.size, layer.left)):
+      return True
+  return False
+
+
+def _get(session, model, id):
+  return session.query(model).filter(model.id == id).one_or_none()
+
+
+def _patch_change(session, plan: ScenePlan, change) -> ScenePlan:
+  if change.entity in KEYFRAME_KINDS:
+    return _patch_keyframe(session, plan, change)
+  if change.entity in ('Scene', 'Layer') and change.action != UPDATED:
+    raise Unpatchable()
+  if change.action == CREATED:
+    # New images, dimensions and sensors show up as updates to what they are attached to
+    return plan
+  if change.action == DELETED:
+    if _references(plan, change):
+      raise Unpatchable()
+    return plan
+  if change.entity not in UPDATE_PATCHES:
+    if change.fields:
+      raise Unpatchable()
+    return plan
+  model, columns, patch = UPDATE_PATCHES[change.entity]
+  if not change.fields <= columns:
+    raise Unpatchable()
+  row = _get(session, model, change.id)
+  if row is None:
+    return plan
+  return patch(session, plan, row)
+
+
+"""
+Applies committed changes (events.ChangeEvent) to a compiled plan instead of
+compiling the scene again: only the rows that changed are read back, only the
+plan nodes above them are rebuilt, and every untouched layer stays the very
+same object, so whatever was cached for it stays valid.
+Returns None when the changes restructure the scene (e.g. a layer was added or
+shows a different image) and it has to be compiled again.
+"""
+def patch_scene_plan(session, plan: ScenePlan, changes) -> Optional[ScenePlan]:
+  try:
+    for change in changes:
+      if plan.id in change.scene_ids:
+        plan = _patch_change(session, plan, change)
+  except Unpatchable:
+    return None
+  return plan
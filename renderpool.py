@@ -0,0 +1,168 @@
+"""
+Process pool that renders devices in parallel
+Devices are sharded across worker processes so that several strips can be
+rendered at full frame rate without contending for one interpreter's GIL.
+Each worker keeps its own compiled copy of its devices' scene plans and is sent
+a new plan whenever a device's scene changes. Workers pack their frames straight
+into a shared memory buffer per device, so no pixel data is ever pickled: the
+only per-frame messages are the frame time and an acknowledgement (with the
+frame's timings when it is profiled).
+"""
+import logging
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from traceback import format_exc
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from output import pack_frame
+from profiler import RenderProfiler
+from renderer import CHANNELS, OPACITY, GradientLUTCache, render_frame
+from renderplan import ScenePlan
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_main(connection) -> None:
+  luts = GradientLUTCache()
+  # Device ID -> [plan, LED count, shared memory, packed frame view, static layers]
+  devices = {}
+  connection.send(('ready',))
+  try:
+    while True:
+      message = connection.recv()
+      kind = message[0]
+      if kind == 'render':
+        _, t, device_ids, profile = message
+        errors = []
+        profiler = RenderProfiler() if profile else None
+        for device_id in device_ids:
+          device = devices[device_id]
+          plan, led_count, memory, packed, static_layers = device
+          try:
+            if plan is None:
+              frame = _blank(led_count)
+            else:
+              frame = render_frame(plan, led_count, t, luts, profiler, static_layers=static_layers)
+          except Exception:
+            # One scene that can't be rendered mustn't stop the others; its
+            # device stays blank until it gets a new plan
+            errors.append((device_id, format_exc()))
+            device[0] = None
+            frame = _blank(led_count)
+          pack_frame(frame, out=packed)
+        connection.send(('done', errors, profiler.timings() if profiler is not None else None))
+      elif kind == 'plan':
+        _, device_id, led_count, name, plan = message
+        if device_id in devices and devices[device_id][2].name == name:
+          devices[device_id][0] = plan
+        else:
+          _release(devices.pop(device_id, None))
+          memory = SharedMemory(name=name)
+          packed = np.ndarray((led_count,), dtype=np.uint32, buffer=memory.buf)
+          devices[device_id] = [plan, led_count, memory, packed, {}]
+      elif kind == 'remove':
+        _release(devices.pop(message[1], None))
+      elif kind == 'stop':
+        break
+  finally:
+    for device in devices.values():
+      _release(device)
+    connection.close()
+
+
+def _blank(led_count: int) -> np.ndarray:
+  frame = np.zeros((led_count, CHANNELS))
+  frame[:, OPACITY] = 1.0
+  return frame
+
+
+def _release(device) -> None:
+  if device is not None:
+    # Drop the view before closing the buffer it points into
+    device[3] = None
+    device[2].close()
+
+
+class RenderPool:
+  def __init__(self, processes: int) -> None:
+    context = multiprocessing.get_context('spawn')
+    self._connections = []
+    self._processes = []
+    for i in range(processes):
+      parent, child = context.Pipe()
+      process = context.Process(target=_worker_main, args=(child,), name='render-worker-{}'.format(i), daemon=True)
+      process.start()
+      child.close()
+      self._connections.append(parent)
+      self._processes.append(process)
+    # Wait for the workers to finish importing before the first frame is due
+    for connection in self._connections:
+      connection.recv()
+    # Device ID -> (worker index, shared memory, packed frame view)
+    self._devices: Dict[int, tuple] = {}
+
+  def _worker_for(self, device_id: int) -> int:
+    if device_id in self._devices:
+      return self._devices[device_id][0]
+    # Least loaded worker
+    loads = [0] * len(self._connections)
+    for worker, _, _ in self._devices.values():
+      loads[worker] += 1
+    return loads.index(min(loads))
+
+  """
+  Hands a device (or a new plan for it) to its worker
+  """
+  def assign(self, device_id: int, led_count: int, plan: Optional[ScenePlan]) -> None:
+    current = self._devices.get(device_id)
+    if current is not None and len(current[2]) != led_count:
+      self.remove(device_id)
+      current = None
+    worker = self._worker_for(device_id)
+    if current is None:
+      memory = SharedMemory(create=True, size=max(led_count, 1) * 4)
+      packed = np.ndarray((led_count,), dtype=np.uint32, buffer=memory.buf)
+      packed[:] = 0
+      self._devices[device_id] = (worker, memory, packed)
+    self._connections[worker].send(('plan', device_id, led_count, self._devices[device_id][1].name, plan))
+
+  def remove(self, device_id: int) -> None:
+    device = self._devices.pop(device_id, None)
+    if device is None:
+      return
+    worker, memory, packed = device
+    self._connections[worker].send(('remove', device_id))
+    del packed
+    memory.close()
+    memory.unlink()
+
+  """
+  Renders the given devices (or every device) at time t in parallel
+  Returns the packed frame of each of them, as views into shared memory that
+  stay valid until the next call; the workers' timings are added to profiler
+  when one is given
+  """
+  def render(self, t: float, device_ids: Optional[Iterable[int]] = None, profiler: Optional[RenderProfiler] = None) -> Dict[int, np.ndarray]:
+    if device_ids is None:
+      device_ids = self._devices.keys()
+    shards: Dict[int, List[int]] = {}
+    for device_id in device_ids:
+      shards.setdefault(self._devices[device_id][0], []).append(device_id)
+    for worker, shard in shards.items():
+      self._connections[worker].send(('render', t, shard, profiler is not None))
+    for worker in shards:
+      _, errors, timings = self._connections[worker].recv()
+      if timings is not None:
+        profiler.merge(timings)
+      for device_id, error in errors:
+        logger.error('Rendering device %s failed, blanking it:\n%s', device_id, error)
+    return {device_id: self._devices[device_id][2] for shard in shards.values() for device_id in shard}
+
+  def close(self) -> None:
+    for device_id in list(self._devices):
+      self.remove(device_id)
+    for connection in self._connections:
+      connection.send(('stop',))
+      connection.close()
+    for process in self._processes:
+      process.join()
@@ -0,0 +1,239 @@
+"""
+Render service
+The RenderDaemon runs in a process of its own, so that frame pacing doesn't
+depend on what the API process is doing: GraphQL parsing, serialization and
+SQLite writes there no longer compete with the render loop for a GIL. The
+render process raises itself to a real-time scheduling priority when it's
+allowed to (or at least to a better nice level), which its render workers
+inherit.
+The API talks to it over a pipe: notify() forwards committed change events
+and reload() asks for a full reload. The process sends its frame counters back
+every status_interval, and status() answers from the latest ones it sent
+without waiting on the process (which would hold up gevent's loop).
+request_profile() has the process profile the frames it shows and send the
+breakdown back, which profile() answers from the same way.
+The process reads devices and scenes from the database itself when it starts,
+and is started again if it dies, after which it catches up the same way. The
+delay before a restart doubles with every crash of a process that didn't run
+for long (up to max_restart_delay), so a scene that keeps crashing it doesn't
+keep respawning it and its render workers.
+"""
+import logging
+import multiprocessing
+import os
+from dataclasses import asdict
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, Optional, Tuple
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from profiler import SceneProfile
+from renderdaemon import RenderDaemon, open_strip as open_ws281x_strip
+
+logger = logging.getLogger(__name__)
+
+
+def _raise_priority(priority: Optional[int]) -> None:
+  if priority is None:
+    return
+  try:
+    os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(priority))
+    return
+  except (AttributeError, OSError):
+    # Not on Linux, or not allowed to (needs CAP_SYS_NICE)
+    pass
+  try:
+    os.nice(-10)
+  except OSError:
+    logger.warning('Could not raise the priority of the render process')
+
+
+def _serve(connection, send: Callable, daemon: RenderDaemon) -> None:
+  try:
+    while True:
+      message = connection.recv()
+      kind = message[0]
+      if kind == 'changes':
+        daemon.notify(message[1])
+      elif kind == 'reload':
+        daemon.reload()
+      elif kind == 'profile':
+        daemon.profile(message[1], lambda profiles: send(('profile', profiles)))
+      elif kind == 'stop':
+        break
+  except EOFError:
+    # The API process is gone
+    pass
+  finally:
+    daemon.stop()
+
+
+def _report(send: Callable, daemon: RenderDaemon, interval: float) -> None:
+  try:
+    while True:
+      send(('status', asdict(daemon.frame_stats())))
+      sleep(interval)
+  except (OSError, EOFError):
+    pass
+
+
+# Status reports and profiles are sent from different threads
+def _sender(connection) -> Callable:
+  lock = Lock()
+
+  def send(message) -> None:
+    with lock:
+      connection.send(message)
+  return send
+
+
+def _service_main(connection, database_url: str, fps: float, processes: int, clip_dir: Optional[str], priority: Optional[int], status_interval: float, open_strip: Callable) -> None:
+  _raise_priority(priority)
+  engine = create_engine(database_url)
+  daemon = RenderDaemon(sessionmaker(bind=engine), fps=fps, open_strip=open_strip, processes=processes, clip_dir=clip_dir)
+  send = _sender(connection)
+  Thread(target=_serve, args=(connection, send, daemon), name='render-ipc', daemon=True).start()
+  Thread(target=_report, args=(send, daemon, status_interval), name='render-status', daemon=True).start()
+  daemon.run()
+
+
+class RenderService:
+  """
+  priority is the SCHED_RR priority of the render process (1-99), or None to
+  leave it as it is; open_strip must be picklable (a module-level function)
+  A process that ran for max_restart_delay seconds is started again after
+  restart_delay.
+  """
+  def __init__(self, database_url: str, fps: float = 60.0, processes: int = 0, clip_dir: Optional[str] = None, priority: Optional[int] = 10, restart_delay: float = 1.0, max_restart_delay: float = 60.0, status_interval: float = 0.5, open_strip: Callable = open_ws281x_strip) -> None:
+    self.database_url = database_url
+    self.fps = fps
+    self.processes = processes
+    self.clip_dir = clip_dir
+    self.priority = priority
+    self.restart_delay = restart_delay
+    self.max_restart_delay = max_restart_delay
+    self.status_interval = status_interval
+    self.open_strip = open_strip
+    # Times the render process had to be started again
+    self.restarts = 0
+    self._process = None
+    self._connection = None
+    # Held while sending on the connection, which the supervisor replaces on
+    # restarts
+    self._lock = Lock()
+    self._stopping = Event()
+    # (time received, frame counters) last sent by the render process
+    self._status: Optional[Tuple[float, dict]] = None
+    # Scene ID -> profile, from the last profile the render process sent
+    self._profiles: Dict[int, SceneProfile] = {}
+
+  def _spawn(self) -> None:
+    # Not daemonic: the render process starts render workers of its own
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=_service_main, name='render-service',
+                              args=(child, self.database_url, self.fps, self.processes, self.clip_dir, self.priority, self.status_interval, self.open_strip))
+    process.start()
+    child.close()
+    with self._lock:
+      if self._connection is not None:
+        self._connection.close()
+      self._process, self._connection = process, parent
+    Thread(target=self._receive, args=(parent,), name='render-status', daemon=True).start()
+
+  # The only reader of a connection, for as long as its process runs
+  def _receive(self, connection) -> None:
+    try:
+      while True:
+        kind, payload = connection.recv()
+        if kind == 'status':
+          self._status = (monotonic(), payload)
+        elif kind == 'profile':
+          self._profiles = payload
+    except (OSError, EOFError):
+      pass
+
+  def start(self) -> None:
+    self._stopping.clear()
+    self._spawn()
+    Thread(target=self._supervise, name='render-supervisor', daemon=True).start()
+
+  def _supervise(self) -> None:
+    delay = self.restart_delay
+    while True:
+      process = self._process
+      started = monotonic()
+      process.join()
+      if self._stopping.is_set():
+        return
+      if monotonic() - started >= self.max_restart_delay:
+        delay = self.restart_delay
+      logger.error('Render process exited with code %s, starting it again in %.1f s', process.exitcode, delay)
+      if self._stopping.wait(delay):
+        return
+      delay = min(delay * 2, self.max_restart_delay)
+      self.restarts += 1
+      self._spawn()
+
+  @property
+  def running(self) -> bool:
+    return self._process is not None and self._process.is_alive()
+
+  def _send(self, message) -> None:
+    with self._lock:
+      if self._connection is None:
+        return
+      try:
+        self._connection.send(message)
+      except (OSError, EOFError):
+        # The process is being restarted, and reloads everything when it starts
+        pass
+
+  """
+  Hands the render process a tuple of committed change events (see
+  events.commits)
+  """
+  def notify(self, changes) -> None:
+    self._send(('changes', changes))
+
+  def reload(self) -> None:
+    self._send(('reload',))
+
+  """
+  Latest frame counters of the render process (see renderdaemon.FrameStats)
+  and how many times it was restarted, or None when it hasn't sent any lately
+  """
+  def status(self) -> Optional[dict]:
+    status = self._status
+    if status is None or monotonic() - status[0] > 2 * self.status_interval + 1.0:
+      return None
+    return dict(status[1], restarts=self.restarts)
+
+  """
+  Has the render process profile the next frames it shows (see
+  RenderDaemon.profile) and send the breakdown back
+  """
+  def request_profile(self, frames: int) -> None:
+    self._send(('profile', frames))
+
+  """
+  Breakdown of a scene from the last profile the render process sent, or None
+  when it didn't show the scene then
+  """
+  def profile(self, scene_id: int) -> Optional[SceneProfile]:
+    return self._profiles.get(int(scene_id))
+
+  def stop(self, timeout: float = 5.0) -> None:
+    self._stopping.set()
+    self._send(('stop',))
+    process = self._process
+    if process is not None:
+      process.join(timeout)
+      if process.is_alive():
+        process.terminate()
+        process.join()
+    with self._lock:
+      if self._connection is not None:
+        self._connection.close()
+        self._connection = None
+    self._status = None
@@ -0,0 +1,103 @@
+"""
+Response cache for read queries
+Scenes are read far more often than they're edited, so the results of queries
+are kept and served again for as long as what they read stays the same.
+The RootQuery resolvers note the revision of what they read from the object
+store with depends_on() (or that their result can't be reused, with
+uncacheable()); a cached result is used for the same document and variables
+while all the revisions it noted are still current. Any commit, and any update
+the store shows before it's committed, gives the scenes and devices it touches
+new revisions, so results never outlive what they were read from.
+ResponseCache is a GraphQL backend wrapping the one that parses documents (a
+DocumentCache), and keeps the most recently used results up to a size.
+"""
+from collections import OrderedDict
+from functools import partial
+import json
+from threading import Lock
+from typing import Optional
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from querycache import document_hash
+
+
+"""
+Notes that a query result shows the object of model with an ID (or all of the
+model's objects, when id is None) as it is in the context's store
+"""
+def depends_on(context: dict, model, id=None) -> None:
+  revisions = context.get('revisions')
+  if revisions is None:
+    return
+  store = context.get('store')
+  if store is None:
+    # Read from the database, which has no revisions
+    context['revisions'] = None
+    return
+  revisions[(model, int(id) if id is not None else None)] = store.revision(model, id)
+
+
+"""
+Notes that a query result must not be reused (e.g. a measurement)
+"""
+def uncacheable(context: dict) -> None:
+  if 'revisions' in context:
+    context['revisions'] = None
+
+
+class ResponseCache(GraphQLBackend):
+  def __init__(self, backend: GraphQLBackend, store, size: int = 128) -> None:
+    self.backend = backend
+    self.store = store
+    self.size = size
+    # (document hash, operation name, variables) -> (revisions, result), least
+    # recently used first
+    self._results: OrderedDict = OrderedDict()
+    self._lock = Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def document_from_string(self, schema, document_string: str) -> GraphQLDocument:
+    document = self.backend.document_from_string(schema, document_string)
+    return GraphQLDocument(schema=document.schema, document_string=document.document_string,
+                           document_ast=document.document_ast, execute=partial(self._execute, document))
+
+  def query_for_hash(self, key: str) -> Optional[str]:
+    return self.backend.query_for_hash(key)
+
+  def _current(self, revisions: dict) -> bool:
+    return all(self.store.revision(model, id) == revision for (model, id), revision in revisions.items())
+
+  def _cached(self, key) -> Optional[object]:
+    with self._lock:
+      entry = self._results.get(key)
+      if entry is not None and self._current(entry[0]):
+        self._results.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+      return None
+
+  def _execute(self, document: GraphQLDocument, *args, **kwargs):
+    operation_name = kwargs.get('operation_name')
+    context = kwargs.get('context_value', kwargs.get('context'))
+    if not isinstance(context, dict) or document.get_operation_type(operation_name) != 'query':
+      return document.execute(*args, **kwargs)
+    variables = json.dumps(kwargs.get('variable_values') or {}, sort_keys=True, default=str)
+    key = (document_hash(document.document_string), operation_name, variables)
+    result = self._cached(key)
+    if result is not None:
+      return result
+    context['revisions'] = {}
+    result = document.execute(*args, **kwargs)
+    revisions = context.pop('revisions')
+    if revisions and not result.errors and not result.invalid:
+      with self._lock:
+        self._results[key] = (revisions, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.size:
+          self._results.popitem(last=False)
+    return result
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self._results)}
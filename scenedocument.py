@@ -0,0 +1,195 @@
+"""
+Nested scene documents
+A scene document describes a whole scene at once: its layers, their images
+(colours, gradients with their colour stops, colour animations with their
+keyframes and clock) and their size and left dimensions (static values or
+animations with their keyframes and clock).
+upsert_scene diffs a document against the stored scene and applies the
+difference in one flush and one commit:
+- objects with an ID update the stored object with that ID, which must be the
+  one already at that place in the scene
+- objects without an ID are created, replacing whatever was at that place
+- stored layers, colour stops and keyframes that the document leaves out are
+  deleted
+- fields left out of an object are left as they are
+Images and dimensions are given as {color | gradient | colorAnimation} and
+{static | animation} respectively, exactly one of which must be set.
+"""
+from controller import Keyframe, Animation, Scene, Layer, Color, Gradient, ColorStop, ColorAnimation, ColorKeyframe, StaticDimension, DimensionAnimation, DimensionKeyframe, Clock
+
+IMAGE_KINDS = {'color': Color, 'gradient': Gradient, 'color_animation': ColorAnimation}
+DIMENSION_KINDS = {'static': StaticDimension, 'animation': DimensionAnimation}
+
+
+def _id(document):
+  return int(document['id']) if document.get('id') is not None else None
+
+
+# Only sets what changed, so that unchanged rows aren't reported as updated
+def _assign(obj, document, keys) -> None:
+  for key in keys:
+    if key in document and getattr(obj, key) != document[key]:
+      setattr(obj, key, document[key])
+
+
+# Only replaces related objects that changed, for the same reason
+def _replace(obj, key: str, value) -> None:
+  current = getattr(obj, key)
+  if isinstance(value, list):
+    unchanged = len(value) == len(current) and all(new is old for new, old in zip(value, current))
+  else:
+    unchanged = value is current
+  if not unchanged:
+    setattr(obj, key, value)
+
+
+def _new(model):
+  # Keyframes and animations are dataclasses that take some fields up front
+  if issubclass(model, Keyframe):
+    return model(value=None, position=None)
+  if issubclass(model, Animation):
+    return model(keyframes=[])
+  return model()
+
+
+"""
+The object for a nested document: current if the document names it by ID, a
+new instance of model otherwise
+"""
+def _object_for(current, document, model, place: str):
+  id = _id(document)
+  if id is None:
+    return _new(model)
+  if current is None or current.id != id or not isinstance(current, model):
+    raise ValueError('{} {} is not the {} at {}'.format(model.__name__, id, model.__name__, place))
+  return current
+
+
+def _apply_one(current, document, model, apply, place: str):
+  obj = _object_for(current, document, model, place)
+  apply(obj, document, place)
+  return obj
+
+
+"""
+Brings a collection in line with a list of documents, keeping the stored
+objects the documents name by ID
+"""
+def _apply_many(current, documents, model, apply, place: str) -> list:
+  stored = {obj.id: obj for obj in current}
+  result = []
+  for i, document in enumerate(documents):
+    id = _id(document)
+    if id is not None and id not in stored:
+      raise ValueError('{} {} is not in {}'.format(model.__name__, id, place))
+    obj = stored.pop(id) if id is not None else _new(model)
+    apply(obj, document, '{}[{}]'.format(place, i))
+    result.append(obj)
+  return result
+
+
+# New objects have to come with everything needed to render them
+def _require(obj, keys, place: str) -> None:
+  for key in keys:
+    if getattr(obj, key) is None:
+      raise ValueError('{}.{} is required'.format(place, key))
+
+
+def _apply_color(color, document, place: str) -> None:
+  _assign(color, document, ('red', 'green', 'blue', 'white', 'opacity'))
+  _require(color, ('red', 'green', 'blue'), place)
+
+
+def _apply_clock(clock, document, place: str) -> None:
+  _assign(clock, document, ('name', 'start', 'duration'))
+  _require(clock, ('start', 'duration'), place)
+  if clock.duration <= 0:
+    raise ValueError('{}.duration must be positive'.format(place))
+
+
+def _apply_keyframe_value(keyframe, document, place: str) -> None:
+  _assign(keyframe, document, ('position',))
+  if 'value' in document:
+    _replace(keyframe, 'value', _apply_one(keyframe.value, document['value'], Color, _apply_color, place + '.value'))
+  _require(keyframe, ('position', 'value'), place)
+
+
+def _apply_dimension_keyframe(keyframe, document, place: str) -> None:
+  _assign(keyframe, document, ('position', 'value'))
+  _require(keyframe, ('position', 'value'), place)
+
+
+def _apply_animation(animation, document, place: str, keyframe_model, apply_keyframe) -> None:
+  _assign(animation, document, ('repeat',))
+  if 'sensor' in document:
+    _replace(animation, 'sensor', _apply_one(animation.sensor, document['sensor'], Clock, _apply_clock, place + '.sensor'))
+  if 'keyframes' in document:
+    _replace(animation, 'keyframes', _apply_many(animation.keyframes, document['keyframes'], keyframe_model, apply_keyframe, place + '.keyframes'))
+  _require(animation, ('repeat', 'sensor'), place)
+  if not animation.keyframes:
+    raise ValueError('{}.keyframes needs at least one keyframe'.format(place))
+
+
+def _apply_gradient(gradient, document, place: str) -> None:
+  if 'colorstops' in document:
+    _replace(gradient, 'colorstops', _apply_many(gradient.colorstops, document['colorstops'], ColorStop, _apply_keyframe_value, place + '.colorstops'))
+  if not gradient.colorstops:
+    raise ValueError('{}.colorstops needs at least one colour stop'.format(place))
+
+
+def _apply_color_animation(animation, document, place: str) -> None:
+  _apply_animation(animation, document, place, ColorKeyframe, _apply_keyframe_value)
+
+
+def _apply_static_dimension(dimension, document, place: str) -> None:
+  _assign(dimension, document, ('value',))
+  _require(dimension, ('value',), place)
+
+
+def _apply_dimension_animation(animation, document, place: str) -> None:
+  _apply_animation(animation, document, place, DimensionKeyframe, _apply_dimension_keyframe)
+
+
+IMAGE_APPLY = {Color: _apply_color, Gradient: _apply_gradient, ColorAnimation: _apply_color_animation}
+DIMENSION_APPLY = {StaticDimension: _apply_static_dimension, DimensionAnimation: _apply_dimension_animation}
+
+
+"""
+Applies a {kind: document} union document to the object at a place
+"""
+def _apply_union(current, document, kinds, apply, place: str):
+  given = [key for key in kinds if document.get(key) is not None]
+  if len(given) != 1:
+    raise ValueError('{} needs exactly one of {}'.format(place, ', '.join(kinds)))
+  model = kinds[given[0]]
+  return _apply_one(current, document[given[0]], model, apply[model], place)
+
+
+def _apply_layer(layer, document, place: str) -> None:
+  _assign(layer, document, ('repeat',))
+  if 'image' in document:
+    _replace(layer, 'image', _apply_union(layer.image, document['image'], IMAGE_KINDS, IMAGE_APPLY, place + '.image'))
+  for key in ('size', 'left'):
+    if key in document:
+      _replace(layer, key, _apply_union(getattr(layer, key), document[key], DIMENSION_KINDS, DIMENSION_APPLY, '{}.{}'.format(place, key)))
+  _require(layer, ('repeat', 'image', 'size', 'left'), place)
+
+
+"""
+Creates or updates a scene from a nested scene document and commits it
+Nothing is written if the document is invalid.
+"""
+def upsert_scene(session, document) -> Scene:
+  id = _id(document)
+  scene = session.query(Scene).filter(Scene.id == id).one() if id is not None else Scene()
+  try:
+    with session.no_autoflush:
+      _assign(scene, document, ('name',))
+      if 'layers' in document:
+        _replace(scene, 'layers', _apply_many(scene.layers, document['layers'], Layer, _apply_layer, 'layers'))
+    session.add(scene)
+    session.commit()
+  except Exception:
+    session.rollback()
+    raise
+  return scene
@@ -1,5 +1,6 @@
 from rpi_ws281x import Color, PixelStrip, ws
 from controller import Scene, Layer, Color
+from output import show_frame
 
 LED_COUNT = 150
 GPIO_PIN = 21
@@ -10,9 +11,6 @@ scene = Scene([Layer(Color(0, 255, 0, 255))])
 
 
 def drawFrame(strip: PixelStrip, scene: Scene, time: float) -> None:
-  for i in range(strip.numPixels()):
-    strip.setPixelColor(i, scene.getColorAtPositionAndTime(
-        (i + 0.5) / strip.numPixels(), time))
-  strip.show()
+  show_frame(strip, scene.render_frame(strip.numPixels(), time))
 
 drawFrame(strip, scene, 0.0)
\ No newline at end of file
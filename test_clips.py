@@ -0,0 +1,128 @@
+"""
+Baked clips against live rendering
+"""
+import os
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from clips import active_window, bake_clip, clip_key, open_clip
+from controller import Base, Scene, Layer, Color, Gradient, ColorStop, ColorAnimation, ColorKeyframe, StaticDimension, DimensionAnimation, DimensionKeyframe, Clock
+from output import pack_frame
+from renderer import GradientLUTCache, render_frame
+from renderplan import compile_scene
+
+START = 1000.0
+FPS = 30.0
+LEDS = 24
+
+
+@pytest.fixture
+def session():
+  engine = create_engine('sqlite://')
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  yield session
+  session.close()
+
+
+def color(red, green, blue, opacity=1.0) -> Color:
+  return Color(red=red, green=green, blue=blue, white=0.0, opacity=opacity)
+
+
+def animated_scene(session) -> Scene:
+  fade = ColorAnimation(keyframes=[ColorKeyframe(value=color(255.0, 0.0, 0.0), position=0.25),
+                                   ColorKeyframe(value=color(0.0, 0.0, 255.0), position=0.75)])
+  fade.sensor = Clock(start=START, duration=2.0)
+  fade.repeat = 1.0
+  slide = DimensionAnimation(keyframes=[DimensionKeyframe(value=0.0, position=0.0),
+                                        DimensionKeyframe(value=0.5, position=1.0)])
+  slide.sensor = Clock(start=START + 0.5, duration=1.0)
+  slide.repeat = 1.0
+  gradient = Gradient(colorstops=[ColorStop(value=color(0.0, 255.0, 0.0), position=0.0),
+                                  ColorStop(value=color(0.0, 0.0, 0.0, 0.0), position=1.0)])
+  scene = Scene(name='animated', layers=[
+    Layer(image=fade, size=StaticDimension(value=1.0), left=StaticDimension(value=0.0), repeat=1.0),
+    Layer(image=gradient, size=StaticDimension(value=0.25), left=slide, repeat=1.0),
+  ])
+  session.add(scene)
+  session.commit()
+  return scene
+
+
+def live_frame(plan, t: float) -> np.ndarray:
+  return pack_frame(render_frame(plan, LEDS, t, GradientLUTCache()))
+
+
+def test_active_window_spans_the_running_keyframes(session):
+  plan = compile_scene(animated_scene(session))
+  assert active_window(plan) == pytest.approx((START + 0.5, START + 1.5))
+
+
+def test_static_scenes_are_not_baked(session, tmp_path):
+  scene = Scene(name='static', layers=[
+    Layer(image=color(10.0, 20.0, 30.0), size=StaticDimension(value=1.0), left=StaticDimension(value=0.0), repeat=1.0)])
+  session.add(scene)
+  session.commit()
+  plan = compile_scene(scene)
+  path = str(tmp_path / 'static.clip')
+  assert active_window(plan) is None
+  assert not bake_clip(plan, LEDS, FPS, path)
+  assert not os.path.exists(path)
+
+
+def test_baked_frames_match_live_rendering(session, tmp_path):
+  plan = compile_scene(animated_scene(session))
+  path = str(tmp_path / 'animated.clip')
+  assert bake_clip(plan, LEDS, FPS, path)
+  clip = open_clip(path, clip_key(plan, LEDS, FPS))
+  assert clip is not None
+  assert not np.array_equal(clip.frames[0], clip.frames[-1])
+  start, end = active_window(plan)
+  # Every frame of the window, and times before and after it that clamp
+  times = [clip.start + i / FPS for i in range(len(clip.frames))] + [start - 5.0, start - 0.01, end + 0.1, end + 60.0]
+  for t in times:
+    assert np.array_equal(clip.frame(t), live_frame(plan, t)), t
+
+
+@pytest.mark.parametrize('positions, repeat', [
+  # Jumps to the last keyframe before the first one is reached
+  ((0.25, 0.75), 0.1),
+  # Jumps halfway through
+  ((0.25, 0.75), 0.5),
+  # Holds the last keyframe, then jumps back to the value at 1.0
+  ((0.0, 1.5), 2.0),
+  # Never jumps
+  ((0.25, 0.75), 1.5),
+])
+def test_baked_frames_match_live_rendering_around_the_repeat(session, tmp_path, positions, repeat):
+  fade = ColorAnimation(keyframes=[ColorKeyframe(value=color(255.0, 0.0, 0.0), position=positions[0]),
+                                   ColorKeyframe(value=color(0.0, 0.0, 255.0), position=positions[1])])
+  fade.sensor = Clock(start=START, duration=2.0)
+  fade.repeat = repeat
+  scene = Scene(name='repeat', layers=[Layer(image=fade, size=StaticDimension(value=1.0), left=StaticDimension(value=0.0), repeat=1.0)])
+  session.add(scene)
+  session.commit()
+  plan = compile_scene(scene)
+  path = str(tmp_path / 'repeat.clip')
+  assert bake_clip(plan, LEDS, FPS, path)
+  clip = open_clip(path, clip_key(plan, LEDS, FPS))
+  start, end = active_window(plan)
+  times = [clip.start + i / FPS for i in range(len(clip.frames))] + [START, start - 0.1, end + 0.1, START + 2.0 * repeat + 0.1, end + 60.0]
+  for t in times:
+    assert np.array_equal(clip.frame(t), live_frame(plan, t)), t
+
+
+def test_clips_of_something_else_are_not_opened(session, tmp_path):
+  plan = compile_scene(animated_scene(session))
+  path = str(tmp_path / 'animated.clip')
+  assert bake_clip(plan, LEDS, FPS, path)
+  assert open_clip(path, clip_key(plan, LEDS + 1, FPS)) is None
+  assert open_clip(str(tmp_path / 'missing.clip')) is None
+
+
+def test_clips_over_the_size_limit_are_not_baked(session, tmp_path):
+  plan = compile_scene(animated_scene(session))
+  path = str(tmp_path / 'animated.clip')
+  assert not bake_clip(plan, LEDS, FPS, path, max_bytes=LEDS * 4)
+  assert not os.path.exists(path)
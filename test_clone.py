@@ -0,0 +1,72 @@
+"""
+Set-based cloning
+"""
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import controller as c
+from clone import clone, duplicate_scene
+from renderer import render_frame
+from renderplan import load_scene_plan
+
+
+@pytest.fixture
+def session():
+  engine = create_engine('sqlite://')
+  c.Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  yield session
+  session.close()
+
+
+@pytest.fixture
+def scene(session):
+  gradient = c.Gradient(colorstops=[c.ColorStop(value=c.Color(red=255.0, green=0.0, blue=0.0), position=0.0),
+                                    c.ColorStop(value=c.Color(red=0.0, green=0.0, blue=255.0, opacity=1.0), position=1.0)])
+  fade = c.ColorAnimation(keyframes=[c.ColorKeyframe(value=c.Color(red=0.0, green=100.0, blue=0.0, opacity=0.5), position=0.0),
+                                     c.ColorKeyframe(value=c.Color(red=50.0, green=0.0, blue=0.0, opacity=1.0), position=1.0)])
+  fade.sensor = c.Clock(start=0.0, duration=10.0, name='fade')
+  fade.repeat = 3.0
+  slide = c.DimensionAnimation(keyframes=[c.DimensionKeyframe(value=0.1, position=0.0), c.DimensionKeyframe(value=0.4, position=1.0)])
+  slide.sensor = c.Clock(start=0.0, duration=5.0, name='slide')
+  slide.repeat = 1.0
+  scene = c.Scene(name='scene', layers=[
+    c.Layer(image=gradient, size=c.StaticDimension(value=0.5), left=c.StaticDimension(value=0.0), repeat=2.0),
+    c.Layer(image=fade, size=c.StaticDimension(value=0.3), left=slide, repeat=1.0),
+  ])
+  session.add(scene)
+  session.commit()
+  return scene
+
+
+def rows(session, model):
+  return {row.id for row in session.query(model)}
+
+
+def test_duplicate_renders_the_same(session, scene):
+  copy = duplicate_scene(session, scene.id, name='copy')
+  assert copy.id != scene.id
+  assert copy.name == 'copy'
+  original, duplicated = load_scene_plan(session, scene.id), load_scene_plan(session, copy.id)
+  assert len(duplicated.layers) == len(original.layers)
+  for t in (1.0, 4.0, 12.0):
+    assert np.array_equal(render_frame(duplicated, 60, t), render_frame(original, 60, t))
+
+
+def test_duplicate_shares_no_rows(session, scene):
+  before = {model: rows(session, model) for model in (c.Layer, c.Image, c.Dimension, c.Sensor, c.ColorStop, c.ColorKeyframe, c.DimensionKeyframe)}
+  copy = duplicate_scene(session, scene.id)
+  for model, ids in before.items():
+    added = rows(session, model) - ids
+    # Twice as many of everything, none of it taken from the original
+    assert len(added) == len(ids), model
+  assert {layer.scene_id for layer in session.query(c.Layer)} == {scene.id, copy.id}
+  assert copy.name == scene.name
+
+
+def test_clone_leaves_missing_ids_out(session, scene):
+  assert clone(session, c.Scene, [scene.id + 100]) == {}
+  with pytest.raises(ValueError):
+    duplicate_scene(session, scene.id + 100)
+  assert rows(session, c.Scene) == {scene.id}
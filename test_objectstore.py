@@ -0,0 +1,166 @@
+"""
+Resident object store
+"""
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import controller as c
+import events
+from graphqlserver import DuplicateScene, UpsertScene
+from objectstore import ObjectStore
+from writecoalescer import WriteCoalescer
+
+
+class Schedule:
+  def __init__(self) -> None:
+    self.calls = []
+
+  def __call__(self, delay: float, function) -> None:
+    self.calls.append(function)
+
+  def run(self) -> None:
+    calls, self.calls = self.calls, []
+    for function in calls:
+      function()
+
+
+@pytest.fixture
+def engine(tmp_path):
+  engine = create_engine('sqlite:///' + str(tmp_path / 'store.sqlite3'))
+  c.Base.metadata.create_all(engine)
+  return engine
+
+
+@pytest.fixture
+def factory(engine):
+  factory = sessionmaker(bind=engine)
+  events.track_changes(factory)
+  session = factory()
+  scene = c.Scene(name='scene', layers=[
+    c.Layer(image=c.Color(red=1.0, green=2.0, blue=3.0), size=c.StaticDimension(value=1.0), left=c.StaticDimension(value=0.0), repeat=1.0)])
+  session.add(c.Device(name='device', led_count=10, scene=scene))
+  session.commit()
+  session.close()
+  return factory
+
+
+@pytest.fixture
+def schedule():
+  return Schedule()
+
+
+@pytest.fixture
+def store(engine, factory, schedule):
+  writes = WriteCoalescer(factory, window=60.0, schedule=schedule)
+  store = ObjectStore(sessionmaker(bind=engine, expire_on_commit=False), writes)
+  store.load()
+  subscription = events.commits.subscribe(store.apply_changes)
+  yield store
+  subscription.dispose()
+
+
+def count_statements(engine):
+  statements = []
+  event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+  return statements
+
+
+def test_reads_come_from_memory(engine, store):
+  statements = count_statements(engine)
+  device = store.all(c.Device)[0]
+  layer = device.scene.layers[0]
+  assert store.get(c.Scene, device.scene.id) is device.scene
+  assert (layer.image.red, layer.size.value, layer.left.value, layer.repeat) == (1.0, 1.0, 0.0, 1.0)
+  assert statements == []
+
+
+def test_commits_are_reloaded(factory, store):
+  session = factory()
+  scene = session.query(c.Scene).one()
+  scene.name = 'renamed'
+  scene.layers[0].image.red = 100.0
+  session.add(c.Scene(name='new'))
+  session.commit()
+  assert [scene.name for scene in store.all(c.Scene)] == ['renamed', 'new']
+  assert store.all(c.Scene)[0].layers[0].image.red == 100.0
+  assert store.all(c.Device)[0].scene is store.all(c.Scene)[0]
+  session.delete(session.query(c.Scene).filter(c.Scene.name == 'new').one())
+  session.commit()
+  session.close()
+  assert [scene.name for scene in store.all(c.Scene)] == ['renamed']
+
+
+def test_updates_show_before_they_are_written(factory, store, schedule):
+  layer = store.all(c.Scene)[0].layers[0]
+  # The first update is written at once, the next one waits for the window
+  store.update(c.Layer, layer.id, {'repeat': 2.0})
+  store.update(c.Layer, layer.id, {'repeat': 3.0})
+  assert store.all(c.Scene)[0].layers[0].repeat == 3.0
+  # Reloading the scene for another commit keeps showing it
+  session = factory()
+  session.query(c.Scene).one().name = 'renamed'
+  session.commit()
+  assert store.all(c.Scene)[0].name == 'renamed'
+  assert store.all(c.Scene)[0].layers[0].repeat == 3.0
+  assert session.query(c.Layer).one().repeat == 2.0
+  session.close()
+  schedule.run()
+  session = factory()
+  assert session.query(c.Layer).one().repeat == 3.0
+  session.close()
+  assert store.all(c.Scene)[0].layers[0].repeat == 3.0
+
+
+def request(factory, store):
+  return SimpleNamespace(context={'session': factory(), 'store': store, 'writes': store})
+
+
+def stored_repeats(factory):
+  session = factory()
+  try:
+    return [layer.repeat for layer in session.query(c.Layer).order_by(c.Layer.id)]
+  finally:
+    session.close()
+
+
+def test_upserts_are_not_reverted_by_pending_updates(factory, store, schedule):
+  scene = store.all(c.Scene)[0]
+  layer_id = scene.layers[0].id
+  for repeat in (2.0, 3.0):
+    c.Layer.update(None, request(factory, store), layer_id, {'repeat': repeat})
+  UpsertScene.mutate(None, request(factory, store), {'id': scene.id, 'layers': [{'id': layer_id, 'repeat': 7.0}]})
+  assert stored_repeats(factory) == [7.0]
+  schedule.run()
+  assert stored_repeats(factory) == [7.0]
+  assert store.all(c.Scene)[0].layers[0].repeat == 7.0
+
+
+def test_copies_include_pending_updates(factory, store, schedule):
+  scene = store.all(c.Scene)[0]
+  for repeat in (2.0, 3.0):
+    c.Layer.update(None, request(factory, store), scene.layers[0].id, {'repeat': repeat})
+  DuplicateScene.mutate(None, request(factory, store), scene.id, 'copy')
+  assert stored_repeats(factory) == [3.0, 3.0]
+  assert [scene.layers[0].repeat for scene in store.all(c.Scene)] == [3.0, 3.0]
+
+
+def test_moved_colour_stops_are_kept_in_order(factory, store):
+  session = factory()
+  session.query(c.Layer).one().image = c.Gradient(colorstops=[
+    c.ColorStop(value=c.Color(red=red, green=0.0, blue=0.0), position=position) for red, position in ((0.0, 0.0), (1.0, 0.5), (2.0, 1.0))])
+  session.commit()
+  session.close()
+  gradient = store.all(c.Scene)[0].layers[0].image
+  first = gradient.colorstops[0]
+  # Written at once, then held back by the window
+  store.update(c.ColorStop, first.id, {'position': 0.2})
+  store.update(c.ColorStop, first.id, {'position': 0.9})
+  gradient = store.all(c.Scene)[0].layers[0].image
+  assert [stop.position for stop in gradient.colorstops] == [0.5, 0.9, 1.0]
+  session = factory()
+  session.query(c.Scene).one().name = 'renamed'
+  session.commit()
+  session.close()
+  gradient = store.all(c.Scene)[0].layers[0].image
+  assert [(stop.position, stop.value.red) for stop in gradient.colorstops] == [(0.5, 1.0), (0.9, 0.0), (1.0, 2.0)]
@@ -0,0 +1,76 @@
+"""
+Parsed document cache and persisted queries
+"""
+import json
+import graphene
+import pytest
+from flask import Flask
+from querycache import DocumentCache, PersistedQueryView, document_hash
+
+
+class Query(graphene.ObjectType):
+  hello = graphene.String(name=graphene.String(default_value='world'))
+
+  def resolve_hello(self, info, name):
+    return 'hello ' + name
+
+
+schema = graphene.Schema(query=Query)
+QUERY = '{ hello }'
+
+
+@pytest.fixture
+def backend():
+  return DocumentCache(2)
+
+
+@pytest.fixture
+def client(backend):
+  app = Flask(__name__)
+  app.add_url_rule('/graphql', view_func=PersistedQueryView.as_view('graphql', schema=schema, backend=backend))
+  return app.test_client()
+
+
+def persisted(key):
+  return {'persistedQuery': {'version': 1, 'sha256Hash': key}}
+
+
+def post(client, body):
+  response = client.post('/graphql', data=json.dumps(body), content_type='application/json')
+  return response.status_code, json.loads(response.data)
+
+
+def test_documents_are_parsed_once(backend):
+  document = backend.document_from_string(schema, QUERY)
+  assert backend.document_from_string(schema, '{ hello }') is document
+  assert document.execute().data == {'hello': 'hello world'}
+  assert backend.query_for_hash(document_hash(QUERY)) == QUERY
+
+
+def test_least_recently_used_documents_are_dropped(backend):
+  first = backend.document_from_string(schema, QUERY)
+  backend.document_from_string(schema, '{ a: hello }')
+  backend.document_from_string(schema, QUERY)
+  backend.document_from_string(schema, '{ b: hello }')
+  assert backend.query_for_hash(document_hash('{ a: hello }')) is None
+  assert backend.document_from_string(schema, QUERY) is first
+
+
+def test_invalid_documents_execute_to_their_errors(backend):
+  result = backend.document_from_string(schema, '{ goodbye }').execute()
+  assert result.invalid
+  assert 'goodbye' in str(result.errors[0])
+
+
+def test_persisted_queries(client):
+  key = document_hash(QUERY)
+  assert post(client, {'extensions': persisted(key)}) == (200, {'errors': [{'message': 'PersistedQueryNotFound'}]})
+  assert post(client, {'query': QUERY, 'extensions': persisted(key)}) == (200, {'data': {'hello': 'hello world'}})
+  assert post(client, {'extensions': persisted(key)}) == (200, {'data': {'hello': 'hello world'}})
+  response = client.get('/graphql', query_string={'extensions': json.dumps(persisted(key))})
+  assert json.loads(response.data) == {'data': {'hello': 'hello world'}}
+
+
+def test_persisted_query_hash_must_match(client):
+  status, _ = post(client, {'query': QUERY, 'extensions': persisted(document_hash('{ a: hello }'))})
+  assert status == 400
@@ -0,0 +1,74 @@
+"""
+Render daemon
+Strips are stand-ins that keep what they were last shown.
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import controller as c
+from renderdaemon import RenderDaemon
+
+
+class Strip:
+  def __init__(self, device) -> None:
+    self.pixels = [0] * device.led_count
+    self.shows = 0
+
+  def numPixels(self) -> int:
+    return len(self.pixels)
+
+  def setPixelColor(self, i: int, color: int) -> None:
+    self.pixels[i] = color
+
+  def show(self) -> None:
+    self.shows += 1
+
+
+@pytest.fixture
+def factory():
+  engine = create_engine('sqlite://')
+  c.Base.metadata.create_all(engine)
+  return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def scene_id(factory):
+  session = factory()
+  scene = c.Scene(name='scene', layers=[
+    c.Layer(image=c.Color(red=0.0, green=0.0, blue=255.0, opacity=1.0), size=c.StaticDimension(value=1.0), left=c.StaticDimension(value=0.0), repeat=1.0),
+    c.Layer(image=c.Color(red=255.0, green=0.0, blue=0.0, opacity=1.0), size=c.StaticDimension(value=0.5), left=c.StaticDimension(value=0.0), repeat=1.0),
+  ])
+  session.add(c.Device(name='device', led_count=10, gpio_pin=18, scene=scene))
+  session.commit()
+  yield scene.id
+  session.close()
+
+
+def test_static_scenes_are_shown_once(factory, scene_id):
+  daemon = RenderDaemon(factory, open_strip=Strip)
+  daemon.load()
+  for t in range(3):
+    daemon.render(float(t))
+  strip = daemon.outputs[1].strip
+  assert strip.shows == 1
+  assert strip.pixels[0] != strip.pixels[-1]
+  assert daemon.idle
+
+
+def test_profiles_the_frames_it_shows(factory, scene_id):
+  daemon = RenderDaemon(factory, open_strip=Strip)
+  daemon.load()
+  daemon.render(0.0)
+  profiles = []
+  daemon.profile(3, profiles.append)
+  assert not daemon.idle
+  for t in range(1, 5):
+    daemon.render(float(t))
+  assert len(profiles) == 1
+  profile = profiles[0][scene_id]
+  assert profile.pixels == 10
+  assert profile.total.calls == 3
+  assert [timing.calls for _, timing in profile.layers] == [3, 3]
+  # Static layers were rendered before, and are only composited again
+  assert profile.types == {}
+  assert daemon.idle
@@ -0,0 +1,116 @@
+"""
+Vectorized renderer against the ORM models
+Random scenes are rendered pixel by pixel through the models'
+getColorAtPosition and all at once by renderer.render_frame, which must agree.
+"""
+import random
+from time import time
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import controller
+from controller import blend, blend_many, Base, Scene, Layer, Color, Gradient, ColorStop, ColorAnimation, ColorKeyframe, StaticDimension, DimensionAnimation, DimensionKeyframe, Clock
+from renderer import GradientLUTCache, pixel_positions, render_frame
+from renderplan import compile_scene
+
+
+def random_color(rng: random.Random) -> Color:
+  return Color(red=rng.uniform(0, 255), green=rng.uniform(0, 255), blue=rng.uniform(0, 255),
+               white=rng.uniform(0, 255), opacity=rng.choice([0.0, 0.3, 1.0, rng.random()]))
+
+
+def random_clock(rng: random.Random, t: float) -> Clock:
+  return Clock(start=t - rng.uniform(0, 5), duration=rng.uniform(1, 10))
+
+
+KEYFRAMES = 4
+
+
+def random_positions(rng: random.Random) -> list:
+  return sorted(rng.random() for _ in range(rng.randint(1, KEYFRAMES)))
+
+
+def random_image(rng: random.Random, t: float):
+  kind = rng.choice(['color', 'gradient', 'animation'])
+  if kind == 'color':
+    return random_color(rng)
+  if kind == 'gradient':
+    return Gradient(colorstops=[ColorStop(value=random_color(rng), position=position)
+                                for position in random_positions(rng)])
+  animation = ColorAnimation(keyframes=[ColorKeyframe(value=random_color(rng), position=position)
+                                        for position in random_positions(rng)])
+  animation.sensor = random_clock(rng, t)
+  animation.repeat = rng.choice([1.0, 2.0, 0.5])
+  return animation
+
+
+def random_dimension(rng: random.Random, t: float, low: float, high: float):
+  if rng.random() < 0.5:
+    return StaticDimension(value=rng.uniform(low, high))
+  animation = DimensionAnimation(keyframes=[DimensionKeyframe(value=rng.uniform(low, high), position=position)
+                                            for position in random_positions(rng)])
+  animation.sensor = random_clock(rng, t)
+  animation.repeat = rng.choice([1.0, 3.0])
+  return animation
+
+
+def random_scene(rng: random.Random, t: float) -> Scene:
+  # Sizes stay positive: the models divide by them
+  return Scene(name='random', layers=[
+    Layer(image=random_image(rng, t), size=random_dimension(rng, t, 0.05, 1.0),
+          left=random_dimension(rng, t, -0.5, 1.0), repeat=rng.choice([0.5, 1.0, 2.0, 3.5]))
+    for _ in range(rng.randint(1, 5))
+  ])
+
+
+@pytest.fixture
+def session():
+  engine = create_engine('sqlite://')
+  Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  yield session
+  session.close()
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_render_frame_matches_models(session, monkeypatch, seed):
+  rng = random.Random(seed)
+  t = time()
+  # The models read the clock themselves
+  monkeypatch.setattr(controller, 'time', lambda: t)
+  scene = random_scene(rng, t)
+  session.add(scene)
+  session.commit()
+  n_pixels = rng.choice([1, 7, 60, 150])
+  colors = [scene.getColorAtPosition(position) for position in pixel_positions(n_pixels).tolist()]
+  expected = np.array([[color.red, color.green, color.blue, color.white, color.opacity] for color in colors])
+  assert np.allclose(render_frame(compile_scene(scene), n_pixels, t), expected)
+  assert np.allclose(scene.render_frame(n_pixels, t), expected)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_blend_many_matches_blend(seed):
+  rng = random.Random(seed)
+  keyframes = [DimensionKeyframe(value=rng.uniform(-1, 1), position=position) for position in random_positions(rng)]
+  positions = np.array([rng.uniform(-0.5, 1.5) for _ in range(50)] + [keyframe.position for keyframe in keyframes])
+  blended = blend_many(positions, np.array([keyframe.position for keyframe in keyframes]),
+                       np.array([keyframe.value for keyframe in keyframes]))
+  assert np.allclose(blended, [blend(keyframes, position) for position in positions.tolist()])
+
+
+def test_gradient_tables_follow_changed_stops(session):
+  scene = Scene(name='gradient', layers=[Layer(
+    image=Gradient(colorstops=[ColorStop(value=Color(red=255.0, green=0.0, blue=0.0, opacity=1.0), position=0.0),
+                               ColorStop(value=Color(red=0.0, green=0.0, blue=255.0, opacity=1.0), position=1.0)]),
+    size=StaticDimension(value=1.0), left=StaticDimension(value=0.0), repeat=1.0)])
+  session.add(scene)
+  session.commit()
+  luts = GradientLUTCache()
+  before = render_frame(compile_scene(scene), 30, 0.0, luts)
+  scene.layers[0].image.colorstops[1].value.green = 255.0
+  session.commit()
+  plan = compile_scene(scene)
+  after = render_frame(plan, 30, 0.0, luts)
+  assert not np.array_equal(after, before)
+  assert np.array_equal(after, render_frame(plan, 30, 0.0, GradientLUTCache()))
@@ -0,0 +1,126 @@
+"""
+Patching render plans from change events
+A plan patched with the events of a commit must equal the plan compiled again
+from the database, and keep every layer the commit didn't touch.
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import controller as c
+import events
+from renderplan import load_scene_plan, patch_scene_plan
+
+
+@pytest.fixture
+def session():
+  engine = create_engine('sqlite://')
+  c.Base.metadata.create_all(engine)
+  factory = sessionmaker(bind=engine)
+  events.track_changes(factory)
+  session = factory()
+  gradient = c.Gradient(colorstops=[c.ColorStop(value=c.Color(red=255.0, green=0.0, blue=0.0), position=0.0),
+                                    c.ColorStop(value=c.Color(red=0.0, green=0.0, blue=255.0, opacity=1.0), position=1.0)])
+  fade = c.ColorAnimation(keyframes=[c.ColorKeyframe(value=c.Color(red=0.0, green=100.0, blue=0.0, white=0.0, opacity=0.5), position=0.0),
+                                     c.ColorKeyframe(value=c.Color(red=50.0, green=0.0, blue=0.0, opacity=1.0), position=1.0)])
+  fade.sensor = c.Clock(start=0.0, duration=10.0, name='fade')
+  fade.repeat = 3.0
+  slide = c.DimensionAnimation(keyframes=[c.DimensionKeyframe(value=0.1, position=0.0), c.DimensionKeyframe(value=0.4, position=1.0)])
+  slide.sensor = c.Clock(start=0.0, duration=5.0, name='slide')
+  slide.repeat = 1.0
+  session.add(c.Scene(name='scene', layers=[
+    c.Layer(image=gradient, size=c.StaticDimension(value=0.5), left=c.StaticDimension(value=0.0), repeat=2.0),
+    c.Layer(image=fade, size=c.StaticDimension(value=0.3), left=slide, repeat=1.0),
+    c.Layer(image=c.Color(red=0.0, green=0.0, blue=20.0, white=10.0, opacity=0.25), size=c.StaticDimension(value=1.0),
+            left=c.StaticDimension(value=0.0), repeat=1.0),
+  ]))
+  session.commit()
+  yield session
+  session.close()
+
+
+def gradient(session):
+  return session.query(c.Gradient).one()
+
+
+def fade(session):
+  return session.query(c.ColorAnimation).one()
+
+
+def slide(session):
+  return session.query(c.DimensionAnimation).one()
+
+
+def layer(session, index):
+  return session.query(c.Scene).one().layers[index]
+
+
+# Mutation, and the index of the only layer it touches
+PATCHED = {
+  'colour stop position': (lambda s: setattr(gradient(s).colorstops[0], 'position', 0.7), 0),
+  'colour stop colour': (lambda s: setattr(gradient(s).colorstops[1].value, 'red', 99.0), 0),
+  'colour stop new colour': (lambda s: setattr(gradient(s).colorstops[1], 'value', c.Color(red=5.0, green=5.0, blue=5.0)), 0),
+  'colour stop added': (lambda s: gradient(s).colorstops.append(c.ColorStop(position=0.9, value=c.Color(red=1.0, green=2.0, blue=3.0))), 0),
+  'colour stop deleted': (lambda s: s.delete(gradient(s).colorstops[-1]), 0),
+  'colour keyframe added': (lambda s: fade(s).keyframes.append(c.ColorKeyframe(position=0.5, value=c.Color(red=1.0, green=2.0, blue=3.0))), 1),
+  'colour keyframe colour': (lambda s: setattr(fade(s).keyframes[0].value, 'green', 42.0), 1),
+  'animation repeat': (lambda s: setattr(fade(s), 'repeat', 2.0), 1),
+  'clock': (lambda s: setattr(fade(s).sensor, 'duration', 3.0), 1),
+  'dimension keyframe': (lambda s: setattr(slide(s).keyframes[0], 'value', 0.33), 1),
+  'dimension keyframe added': (lambda s: slide(s).keyframes.append(c.DimensionKeyframe(position=0.5, value=0.2)), 1),
+  'static dimension': (lambda s: setattr(layer(s, 0).size, 'value', 0.25), 0),
+  'layer repeat': (lambda s: setattr(layer(s, 0), 'repeat', 4.0), 0),
+  'colour': (lambda s: setattr(layer(s, 2).image, 'red', 7.0), 2),
+}
+
+def add_layer(session):
+  scene = session.query(c.Scene).one()
+  scene.layers.append(c.Layer(image=c.Color(red=1.0, green=1.0, blue=1.0), size=c.StaticDimension(value=1.0),
+                              left=c.StaticDimension(value=0.0), repeat=1.0))
+  return scene
+
+
+RECOMPILED = {
+  'layer added': add_layer,
+  'image swapped': lambda s: setattr(layer(s, 0), 'image', c.Color(red=1.0, green=1.0, blue=1.0)),
+  'layer deleted': lambda s: s.delete(layer(s, 0)),
+}
+
+
+def commit_and_patch(session, mutate):
+  plan = load_scene_plan(session, 1)
+  batches = []
+  subscription = events.commits.subscribe(batches.append)
+  try:
+    # Whatever the mutation returns is held on to until the commit, so that it
+    # isn't collected with its changes
+    changed = mutate(session)
+    session.commit()
+  finally:
+    subscription.dispose()
+  patched = plan
+  for batch in batches:
+    if patched is not None:
+      patched = patch_scene_plan(session, patched, batch)
+  return plan, patched
+
+
+@pytest.mark.parametrize('name', PATCHED)
+def test_patched_plan_matches_compiled_plan(session, name):
+  mutate, touched = PATCHED[name]
+  plan, patched = commit_and_patch(session, mutate)
+  assert patched is not None
+  assert patched == load_scene_plan(session, 1)
+  for index, (before, after) in enumerate(zip(plan.layers, patched.layers)):
+    assert (before is after) == (index != touched)
+
+
+def test_scene_name_is_patched(session):
+  plan, patched = commit_and_patch(session, lambda s: setattr(s.query(c.Scene).one(), 'name', 'renamed'))
+  assert patched == load_scene_plan(session, 1)
+  assert all(before is after for before, after in zip(plan.layers, patched.layers))
+
+
+@pytest.mark.parametrize('name', RECOMPILED)
+def test_restructured_scene_is_compiled_again(session, name):
+  _, patched = commit_and_patch(session, RECOMPILED[name])
+  assert patched is None
@@ -0,0 +1,95 @@
+"""
+Response cache for read queries
+"""
+from collections import Counter, defaultdict
+import graphene
+import pytest
+from querycache import DocumentCache
+from responsecache import ResponseCache, depends_on, uncacheable
+
+calls = Counter()
+
+
+class Store:
+  def __init__(self):
+    self.revisions = defaultdict(int)
+
+  def revision(self, model, id=None):
+    return self.revisions[(model, id)]
+
+
+class Query(graphene.ObjectType):
+  scene = graphene.Int(id=graphene.Int(required=True))
+  measured = graphene.Int()
+
+  def resolve_scene(self, info, id):
+    calls['scene'] += 1
+    depends_on(info.context, 'scene', id)
+    return id
+
+  def resolve_measured(self, info):
+    calls['measured'] += 1
+    uncacheable(info.context)
+    return calls['measured']
+
+
+class Mutation(graphene.ObjectType):
+  touch = graphene.Int()
+
+  def resolve_touch(self, info):
+    calls['touch'] += 1
+    return calls['touch']
+
+
+schema = graphene.Schema(query=Query, mutation=Mutation)
+
+
+@pytest.fixture
+def store():
+  calls.clear()
+  return Store()
+
+
+@pytest.fixture
+def cache(store):
+  return ResponseCache(DocumentCache(), store, size=2)
+
+
+def run(cache, store, query, **variables):
+  document = cache.document_from_string(schema, query)
+  return document.execute(context_value={'store': store}, variable_values=variables).data
+
+
+def test_results_are_reused(cache, store):
+  query = 'query ($id: Int!) { scene(id: $id) }'
+  assert run(cache, store, query, id=1) == {'scene': 1}
+  assert run(cache, store, query, id=1) == {'scene': 1}
+  assert run(cache, store, query, id=2) == {'scene': 2}
+  assert calls['scene'] == 2
+  assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 2}
+
+
+def test_new_revisions_invalidate(cache, store):
+  query = '{ scene(id: 1) }'
+  run(cache, store, query)
+  store.revisions[('scene', 2)] += 1
+  run(cache, store, query)
+  assert calls['scene'] == 1
+  store.revisions[('scene', 1)] += 1
+  run(cache, store, query)
+  assert calls['scene'] == 2
+
+
+def test_uncacheable_results_and_mutations_run_every_time(cache, store):
+  run(cache, store, '{ measured scene(id: 1) }')
+  assert run(cache, store, '{ measured scene(id: 1) }') == {'measured': 2, 'scene': 1}
+  run(cache, store, 'mutation { touch }')
+  assert run(cache, store, 'mutation { touch }') == {'touch': 2}
+  assert cache.stats()['size'] == 0
+
+
+def test_reads_without_a_store_are_not_cached(cache, store):
+  document = cache.document_from_string(schema, '{ scene(id: 1) }')
+  document.execute(context_value={})
+  document.execute(context_value={})
+  assert calls['scene'] == 2
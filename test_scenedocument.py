@@ -0,0 +1,96 @@
+"""
+Upserting nested scene documents
+"""
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import controller as c
+from renderplan import load_scene_plan
+from scenedocument import upsert_scene
+
+
+@pytest.fixture
+def session():
+  engine = create_engine('sqlite://')
+  c.Base.metadata.create_all(engine)
+  session = sessionmaker(bind=engine)()
+  yield session
+  session.close()
+
+
+def color(red):
+  return {'red': red, 'green': 0.0, 'blue': 0.0, 'opacity': 1.0}
+
+
+def static(value):
+  return {'static': {'value': value}}
+
+
+def document():
+  return {
+    'name': 'scene',
+    'layers': [
+      {'repeat': 1.0, 'image': {'color': color(10.0)}, 'size': static(1.0), 'left': static(0.0)},
+      {
+        'repeat': 2.0,
+        'image': {'gradient': {'colorstops': [{'position': 0.0, 'value': color(0.0)}, {'position': 1.0, 'value': color(255.0)}]}},
+        'size': static(0.5),
+        'left': {'animation': {'repeat': 1.0, 'sensor': {'start': 0.0, 'duration': 2.0},
+                               'keyframes': [{'position': 0.0, 'value': 0.0}, {'position': 1.0, 'value': 0.5}]}},
+      },
+    ],
+  }
+
+
+def test_creates_the_whole_scene(session):
+  scene = upsert_scene(session, document())
+  plan = load_scene_plan(session, scene.id)
+  assert plan.name == 'scene'
+  assert len(plan.layers) == 2
+  assert plan.layers[1].image.colorstops.positions == (0.0, 1.0)
+  assert plan.layers[1].left.keyframes.values == (0.0, 0.5)
+
+
+def test_updates_objects_by_id_and_deletes_what_is_left_out(session):
+  scene = upsert_scene(session, document())
+  layer = scene.layers[0]
+  layer_id, color_id = layer.id, layer.image.id
+  deleted_id = scene.layers[1].id
+  upsert_scene(session, {
+    'id': scene.id,
+    'layers': [{'id': layer_id, 'repeat': 3.0, 'image': {'color': {'id': color_id, 'red': 99.0}}}],
+  })
+  session.expire_all()
+  scene = session.query(c.Scene).get(scene.id)
+  assert [layer.id for layer in scene.layers] == [layer_id]
+  assert scene.layers[0].repeat == 3.0
+  assert scene.layers[0].image.id == color_id
+  assert scene.layers[0].image.red == 99.0
+  assert session.query(c.Layer).get(deleted_id) is None
+  assert session.query(c.Gradient).count() == 0
+
+
+@pytest.mark.parametrize('change', [
+  # A layer has to have everything needed to render it
+  lambda d: d['layers'][0].pop('size'),
+  # Images are exactly one kind
+  lambda d: d['layers'][0]['image'].update(gradient={'colorstops': []}),
+  lambda d: d['layers'][1]['image']['gradient'].update(colorstops=[]),
+  lambda d: d['layers'][1]['left']['animation']['sensor'].pop('duration'),
+])
+def test_invalid_documents_write_nothing(session, change):
+  invalid = document()
+  change(invalid)
+  with pytest.raises(ValueError):
+    upsert_scene(session, invalid)
+  assert session.query(c.Scene).count() == 0
+  assert session.query(c.Layer).count() == 0
+
+
+def test_ids_must_be_at_their_place(session):
+  first = upsert_scene(session, document())
+  second = upsert_scene(session, document())
+  with pytest.raises(ValueError):
+    upsert_scene(session, {'id': first.id, 'layers': [{'id': second.layers[0].id}]})
+  session.expire_all()
+  assert len(session.query(c.Scene).get(first.id).layers) == 2
@@ -0,0 +1,109 @@
+"""
+Coalesced writes
+Trailing commits are run by hand here: the schedule the coalescer is given only
+records them.
+"""
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+import controller as c
+from writecoalescer import WriteCoalescer
+
+
+class Schedule:
+  def __init__(self) -> None:
+    self.calls = []
+
+  def __call__(self, delay: float, function) -> None:
+    self.calls.append((delay, function))
+
+  def run(self) -> None:
+    calls, self.calls = self.calls, []
+    for _, function in calls:
+      function()
+
+
+@pytest.fixture
+def engine():
+  engine = create_engine('sqlite://')
+  c.Base.metadata.create_all(engine)
+  return engine
+
+
+@pytest.fixture
+def factory(engine):
+  return sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def commits(engine):
+  commits = []
+  event.listen(engine, 'commit', lambda connection: commits.append(connection))
+  return commits
+
+
+@pytest.fixture
+def layer_id(factory):
+  session = factory()
+  layer = c.Layer(repeat=1.0)
+  session.add(layer)
+  session.commit()
+  yield layer.id
+  session.close()
+
+
+def stored_repeat(factory, layer_id):
+  session = factory()
+  try:
+    return session.query(c.Layer).get(layer_id).repeat
+  finally:
+    session.close()
+
+
+def test_first_update_is_committed_at_once(factory, commits, layer_id):
+  schedule = Schedule()
+  writes = WriteCoalescer(factory, window=60.0, schedule=schedule)
+  commits.clear()
+  writes.update(c.Layer, layer_id, {'repeat': 2.0})
+  assert stored_repeat(factory, layer_id) == 2.0
+  assert len(commits) == 1
+  assert not schedule.calls
+
+
+def test_updates_in_a_window_are_merged_into_one_commit(factory, commits, layer_id):
+  schedule = Schedule()
+  writes = WriteCoalescer(factory, window=60.0, schedule=schedule)
+  writes.update(c.Layer, layer_id, {'repeat': 2.0})
+  commits.clear()
+  for repeat in (3.0, 4.0, 5.0):
+    writes.update(c.Layer, layer_id, {'repeat': repeat})
+  assert stored_repeat(factory, layer_id) == 2.0
+  assert writes.pending == 1
+  assert len(schedule.calls) == 1
+  schedule.run()
+  assert stored_repeat(factory, layer_id) == 5.0
+  assert len(commits) == 1
+  assert writes.pending == 0
+
+
+def test_close_writes_what_is_pending(factory, layer_id):
+  writes = WriteCoalescer(factory, window=60.0, schedule=Schedule())
+  writes.update(c.Layer, layer_id, {'repeat': 2.0})
+  writes.update(c.Layer, layer_id, {'repeat': 3.0})
+  writes.close()
+  assert stored_repeat(factory, layer_id) == 3.0
+
+
+def test_rows_deleted_in_the_meantime_are_skipped(factory, layer_id):
+  schedule = Schedule()
+  writes = WriteCoalescer(factory, window=60.0, schedule=schedule)
+  writes.update(c.Layer, layer_id, {'repeat': 2.0})
+  writes.update(c.Layer, layer_id, {'repeat': 3.0})
+  session = factory()
+  session.delete(session.query(c.Layer).get(layer_id))
+  session.commit()
+  session.close()
+  schedule.run()
+  session = factory()
+  assert session.query(c.Layer).get(layer_id) is None
+  session.close()
@@ -0,0 +1,119 @@
+"""
+Coalesced writes
+Dragging a colour stop or a keyframe in the editor sends a stream of update
+mutations, and committing each of them on its own costs a commit (and its disk
+writes) per mouse event. Updates handed to a WriteCoalescer are merged per row
+and written in one commit at most once per window: the first update after a
+quiet period is committed right away, so the strips follow the first move at
+once, and the ones that arrive during the following window are merged and
+committed when it is over.
+Call close() on shutdown to write what is still pending.
+"""
+import logging
+from threading import Lock, Timer
+from time import monotonic
+from typing import Callable, Dict, Optional, Tuple
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+
+"""
+Puts a SQLite database in write-ahead log mode
+Commits then append to the log instead of rewriting pages through a rollback
+journal, and with synchronous=NORMAL only checkpoints wait for the disk.
+"""
+def enable_wal(engine) -> None:
+  @event.listens_for(engine, 'connect')
+  def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def _schedule_with_timer(delay: float, function: Callable) -> None:
+  timer = Timer(delay, function)
+  timer.daemon = True
+  timer.start()
+
+
+class WriteCoalescer:
+  """
+  schedule(delay, function) runs the trailing commit of a window; it defaults to
+  a timer thread, servers running on an event loop should pass its own (e.g.
+  gevent.spawn_later) so that change events are published on it, along with
+  locks that wait on that loop (e.g. lock=gevent.lock.BoundedSemaphore): a
+  thread lock held by one greenlet while it commits would block every other
+  greenlet's loop waiting for it
+  """
+  def __init__(self, session_factory: Callable, window: float = 0.1, schedule: Optional[Callable] = None, lock: Callable = Lock) -> None:
+    self.session_factory = session_factory
+    self.window = window
+    self.schedule = schedule if schedule is not None else _schedule_with_timer
+    # (model, ID) -> column values to write
+    self._pending: Dict[Tuple[type, int], dict] = {}
+    self._lock = lock()
+    # Held while writing, so commits land in the order their updates came in
+    self._flush_lock = lock()
+    self._scheduled = False
+    self._last_flush = float('-inf')
+
+  """
+  Queues new column values for a row; later values for the same row replace
+  earlier ones
+  """
+  def update(self, model: type, id: int, values: dict) -> None:
+    with self._lock:
+      self._pending.setdefault((model, id), {}).update(values)
+      if self._scheduled:
+        return
+      delay = self._last_flush + self.window - monotonic()
+      if delay > 0:
+        self._scheduled = True
+        self.schedule(delay, self._flush_scheduled)
+        return
+    self.flush()
+
+  def _flush_scheduled(self) -> None:
+    with self._lock:
+      self._scheduled = False
+    try:
+      self.flush()
+    except Exception:
+      # Nobody is waiting on a trailing commit to report its failure to
+      logger.exception('Coalesced commit failed')
+
+  @property
+  def pending(self) -> int:
+    with self._lock:
+      return len(self._pending)
+
+  """
+  Writes every pending update in one commit
+  Rows deleted in the meantime are skipped.
+  """
+  def flush(self) -> None:
+    with self._flush_lock:
+      with self._lock:
+        pending, self._pending = self._pending, {}
+        self._last_flush = monotonic()
+      if not pending:
+        return
+      session = self.session_factory()
+      try:
+        for (model, id), values in pending.items():
+          orm_object = session.query(model).get(id)
+          if orm_object is None:
+            continue
+          for key, value in values.items():
+            setattr(orm_object, key, value)
+        session.commit()
+      except Exception:
+        session.rollback()
+        raise
+      finally:
+        session.close()
+
+  def close(self) -> None:
+    self.flush()